@@ -16,15 +16,56 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import flystick_boot
+
+if __name__ == '__main__':
+    # the failsafe frame goes out before the config opens the devices
+    flystick_boot.start()
+
 from flystick_config import (
-    CHANNELS, DISPLAY, DISPLAY_BRIGHTNESS, PPM_OUTPUT_PIN, PWM_INITIAL_TRIM, PWM_DIFF, JOYSTICK_ROLL_TRIM_CHANNEL, JOYSTICK_PITCH_TRIM_CHANNEL, isLcd)
+    CHANNELS, FAILSAFE, DISPLAY, DISPLAY_BRIGHTNESS, PPM_OUTPUT_PIN, OUTPUT, SERIAL_OUTPUT_PORT, PPM_FRAME_US, PPM_FRAME_PHASE_US, PPM_WAVE_CACHE_SIZE, PIGPIOD_PIPELINED, PPM_DEADBAND_US, PWM_INITIAL_TRIM, PWM_DIFF, JOYSTICK_ROLL_TRIM_CHANNEL, JOYSTICK_PITCH_TRIM_CHANNEL, LCD_MAX_REFRESH_HZ, DISPLAY_MAX_REFRESH_HZ, INPUT_BACKEND, STATS_SOCKET, CONFIG_RELOAD_INTERVAL, RECORDER_PATH, RECORDER_FRAMES, MIX_MATRIX, AXIS_SAMPLE_HZ, REALTIME_PRIORITY, REALTIME_CPUS, MULTIPROCESS, SHARED_OUTPUT, MIX_PHASE_US, isLcd)
 
 import logging
-import pygame
+import multiprocessing
 import signal
+import socket
+import sys
 import threading
 import time
-from lcd import LCD
+from flystick_display import ScrollPhatWriter
+from flystick_filter import oversampler
+from flystick_mixer import compile_channels, failsafe_mix
+from flystick_network import receiver as network
+from flystick_pigpiod import PipelinedPi
+from flystick_pipeline import FramePipeline, TrimText, trim_percent
+from flystick_ppm import PpmTemplate, PulseConditioner, WaveCache, start_ppm
+from flystick_recorder import Recorder, input_labels
+from flystick_reload import ConfigReloader
+from flystick_scheduler import FrameScheduler
+from flystick_serial import SerialOutput
+from flystick_shm import ChannelBuffer
+from flystick_stats import Stats, StatsServer
+
+import flystick_config
+import flystick_realtime
+
+flystick_boot.timer.mark('config')
+
+try:
+    from lcd import LCD, LCDWriter
+    # lcd imports smbus2 only once an LCD is opened, without it there is
+    # no LCD to open
+    import smbus2
+    del smbus2
+except ImportError as e:
+    logging.warn("Failed to load LCD support: %s", e)
+    LCD = None
+
+try:
+    import scrollphat
+except (ImportError, IOError) as e:
+    logging.info("No Scroll pHAT: %s", e)
+    scrollphat = None
 
 try:
     import pigpio
@@ -35,6 +76,11 @@ except ImportError as e:
 
 _running = False
 
+_clock = getattr(time, 'monotonic', time.time)
+
+# frames without new values before the output process sends FAILSAFE
+STALE_FRAMES = 50
+
 _output = ()
 
 def shutdown(signum, frame):
@@ -42,14 +88,10 @@ def shutdown(signum, frame):
     _running = False
 
 
-def main():
-    global _output
-    try:
-        global lcd
-        lcd = LCD()
-    except:
-        print("could not init lcd")
-
+def pygame_input():
+    """Returns the (events, sleep) of pygame input."""
+    import pygame
+    from flystick_conf_models import router
     pygame.init()
 
     # Reading only "clicks" via events. These are used for advanced
@@ -58,26 +100,13 @@ def main():
     pygame.event.set_allowed([pygame.JOYBUTTONDOWN,
                               pygame.JOYHATMOTION])
 
-    pi_gpio = 1 << PPM_OUTPUT_PIN
-
-    if pigpio:
-        pi = pigpio.pi()
-        pi.set_mode(PPM_OUTPUT_PIN, pigpio.OUTPUT)
-        pi.wave_add_generic([pigpio.pulse(pi_gpio, 0, 2000)])
-        # padding to make deleting logic easier
-        waves = [None, None, pi.wave_create()]
-        pi.wave_send_repeat(waves[-1])
-    else:
-        pi = None
+    # reused every frame
+    clicks, hats = [], []
 
-    prev = None
-    prev_rll_trim = None
-    prev_ptch_trim = None
-    
-    counter = 0
-    while _running:
+    def events():
         # clicks for advanced mapping
-        clicks, hats = [], []
+        del clicks[:]
+        del hats[:]
         for evt in pygame.event.get():
             if evt.type == pygame.JOYBUTTONDOWN:
                 # print "JOYBUTTONDOWN: %r\n%s" % (evt, dir(evt))
@@ -85,70 +114,421 @@ def main():
             elif evt.type == pygame.JOYHATMOTION and any(evt.value):
                 # print "JOYHATMOTION: %r\n%s" % (evt, dir(evt))
                 hats.append(evt)
+        return router.route((clicks, hats))
 
-        # tuple to enforce immutability
-        _output = tuple(max(min(ch((clicks, hats)), 1.), -1.)
-                        for ch in CHANNELS)
-        # rll_trim = _output[0] * PWM_DIFF + PWM_INITIAL_TRIM
-        # ptch_trim = _output[1] * PWM_DIFF + PWM_INITIAL_TRIM
-        rll_trim = int((_output[0] - _output[JOYSTICK_ROLL_TRIM_CHANNEL]) * 100) # convert to %
-        ptch_trim = int((_output[1] - _output[JOYSTICK_PITCH_TRIM_CHANNEL]) * 100)
+    def sleep(timeout):
+        time.sleep(timeout)
+        # updates the joystick state, for oversampled axes
+        pygame.event.pump()
+
+    return events, sleep
+
+
+def evdev_input():
+    """Returns the (events, sleep) of evdev input: sleeping reads events
+    as they arrive."""
+    from flystick_evdev import poller
+    return poller.events, poller.wait
+
+
+def virtual_input():
+    """Returns the (events, sleep) of the generated virtual joysticks."""
+    from flystick_virtual import virtual_input as source
+    return source.events, source.wait
 
-        # Update if changed trim
-        try:
-            if prev_rll_trim != rll_trim or prev_ptch_trim != ptch_trim:
-                lcd.lcd_string("rll " + str(int(rll_trim)) + "%", lcd.LCD_LINE_1)
-                lcd.lcd_string("ptch " + str(int(ptch_trim)) + "%", lcd.LCD_LINE_2)
-        except:
-            pass
-        # if _output == prev:
-        #     # do nothing
-        #     pass
-        #
-        # elif pigpio:
-        if pigpio:
-            pulses, pos = [], 0
-            index_tuple = 0
-            for value in _output:
-                # exclude 5,6 channels from being pwm channel
-                if index_tuple == JOYSTICK_ROLL_TRIM_CHANNEL or index_tuple == JOYSTICK_PITCH_TRIM_CHANNEL and 0:
-                    # do nothing, exclude 6th and 7th channels
-                    pass
-                else:
-                    # calibrated with Taranis to [-99.6..0..99.4]
-                    # us = int(round(750 + 300 * value))
-                    us = int(round(PWM_INITIAL_TRIM/2 + PWM_DIFF/2 * value))
-                    pulses += [pigpio.pulse(0, pi_gpio, 300),
-                               pigpio.pulse(pi_gpio, 0, us - 300)]
-                    pos += us
-                index_tuple += 1
-
-            # subcycle_time_us = 20k
-            pulses += [pigpio.pulse(0, pi_gpio, 300),
-                       pigpio.pulse(pi_gpio, 0, 20000 - 300 - pos - 1)]
-
-            pi.wave_add_generic(pulses)
-            waves.append(pi.wave_create())
-            pi.wave_send_using_mode(waves[-1], pigpio.WAVE_MODE_REPEAT_SYNC)
-
-            last, waves = waves[0], waves[1:]
-            if last:
-                pi.wave_delete(last)
-
-        prev = _output
-        prev_rll_trim = rll_trim
-        prev_ptch_trim = ptch_trim
-        # NO BUSYLOOPING. And locking with ``pygame.event.wait`` doesn't sound
-        # very sophisticated. (At this point, at least.)
-        # time.sleep(.02)
 
+def open_output(failsafe=None):
+    """Opens the configured output, or takes it over from the startup
+    ``failsafe`` output. Returns (serial, pi, waves, when the PPM wave
+    started), all None in debug mode."""
+    serial = pi = waves = idle = started = None
+    if failsafe:
+        serial, pi, idle, started = failsafe.handover()
+    if OUTPUT != 'ppm':
+        serial = serial or SerialOutput(SERIAL_OUTPUT_PORT, OUTPUT)
+    elif pigpio:
+        pi_gpio = 1 << PPM_OUTPUT_PIN
+        if not pi:
+            pi = PipelinedPi() if PIGPIOD_PIPELINED else pigpio.pi()
+            idle, started = start_ppm(
+                pi, PPM_OUTPUT_PIN, flystick_boot.failsafe_widths(
+                    FAILSAFE, (JOYSTICK_ROLL_TRIM_CHANNEL,),
+                    PWM_INITIAL_TRIM/2, PWM_DIFF/2), PPM_FRAME_US)
+        waves = WaveCache(pi, PpmTemplate(pi_gpio, PPM_FRAME_US),
+                          capacity=PPM_WAVE_CACHE_SIZE, idle=idle)
+    return serial, pi, waves, started
+
+
+def close_output(serial, pi, waves):
+    if serial:
+        serial.stop()
     if pi:
+        logging.info("wave cache: %r", waves.stats())
         pi.stop()
 
 
-if __name__ == '__main__':
+def output_pipeline(events, mix, serial, pi, waves):
+    return FramePipeline(
+        events, mix,
+        # calibrated with Taranis to [-99.6..0..99.4]
+        None if serial else PulseConditioner(PWM_INITIAL_TRIM/2, PWM_DIFF/2,
+                                             deadband=PPM_DEADBAND_US),
+        # reuses the already uploaded wave if this frame was seen before
+        send=serial.send if serial else waves.send if pi else None,
+        # exclude the roll trim reference channel from the PPM frame
+        excluded=(JOYSTICK_ROLL_TRIM_CHANNEL,))
+
+
+def output_counters(stats, serial, pi, waves):
+    if pi:
+        stats.counter('waves_created', lambda: waves.created)
+        stats.counter('waves_deleted', lambda: waves.deleted)
+        stats.counter('wave_cache_hits', lambda: waves.hits)
+    if serial:
+        stats.counter('serial_frames', lambda: serial.frames)
+
+
+def serve_stats(stats, path):
+    """Serves ``stats`` on ``path``. Returns the server, or None."""
+    if not path:
+        return None
+    try:
+        server = StatsServer(stats, path)
+        server.start()
+        return server
+    except socket.error as e:
+        logging.warn("Failed to serve stats: %s", e)
+
+
+roll_text, pitch_text = TrimText("rll"), TrimText("ptch")
+
+
+def show_trims(display, lcd, output, shown):
+    """Posts the trims of ``output`` to the LCD if they aren't the
+    ``shown`` ones, a [roll, pitch] list updated in place."""
+    roll = trim_percent(output, 0, JOYSTICK_ROLL_TRIM_CHANNEL)
+    pitch = trim_percent(output, 1, JOYSTICK_PITCH_TRIM_CHANNEL)
+    # written in the background
+    if roll != shown[0]:
+        shown[0] = roll
+        display.post(roll_text(roll), lcd.LCD_LINE_1)
+    if pitch != shown[1]:
+        shown[1] = pitch
+        display.post(pitch_text(pitch), lcd.LCD_LINE_2)
+
+
+def scrollphat_writer():
+    """Starts drawing ``DISPLAY`` on the Scroll pHAT in the background.
+    Returns the writer, or None without a Scroll pHAT."""
+    if not scrollphat or not DISPLAY:
+        return None
+    try:
+        scrollphat.set_brightness(DISPLAY_BRIGHTNESS)
+    except IOError as e:
+        logging.warn("Failed to init Scroll pHAT: %s", e)
+        return None
+    writer = ScrollPhatWriter(scrollphat, DISPLAY,
+                              max_rate=DISPLAY_MAX_REFRESH_HZ)
+    writer.start()
+    return writer
+
+
+def realtime_loop(stats):
+    """Makes the calling thread's loop real-time, see flystick_realtime.
+    Returns the ``GcControl`` to call between frames."""
+    applied = flystick_realtime.enable(REALTIME_PRIORITY, REALTIME_CPUS)
+    logging.warn("Realtime mode: %s", ", ".join(applied) or "not permitted")
+    control = flystick_realtime.GcControl(stats.histogram('gc'))
+    stats.counter('gc_collections', lambda: control.collections)
+    stats.counter('gc_deferred', lambda: control.deferred)
+    control.start()
+    return control
+
+
+def output_main(path, epoch, realtime=False):
+    """Output process of the multi-process mode: sends the latest values
+    published in ``path`` every frame. The frame boundaries are counted
+    from the start of the PPM wave, made the shared ``epoch`` for the
+    input process, or else from ``epoch``."""
+    setup_signals()
+    shared = ChannelBuffer(path)
+    serial, pi, waves, started = open_output()
+    if started is not None:
+        epoch.value = started
+    published = [0, 0]
+
+    def latest(evts):
+        seq, stamp, values = shared.read()
+        if seq != published[0]:
+            if published[0] and published[1] >= STALE_FRAMES:
+                logging.warn("Input process is back")
+            published[:] = seq, 0
+        elif seq:
+            published[1] += 1
+            if published[1] == STALE_FRAMES:
+                logging.warn("Input process stopped publishing, "
+                             "failsafe")
+        # failsafe until the input is ready, and once it stopped
+        return values if seq and published[1] < STALE_FRAMES else FAILSAFE
+
+    pipeline = output_pipeline(lambda: None, latest, serial, pi, waves)
+    scheduler = FrameScheduler(PPM_FRAME_US, PPM_FRAME_PHASE_US)
+    stats = Stats(pipeline.STAGES + ('frame',))
+    stats.counter('frames', lambda: pipeline.frames)
+    stats.counter('overruns', lambda: scheduler.overruns)
+    stats.counter('shared_retries', lambda: shared.retries)
+    output_counters(stats, serial, pi, waves)
+    server = serve_stats(stats, STATS_SOCKET and STATS_SOCKET + '-output')
+    wakeup = stats.histogram('wakeup')
+    control = realtime and realtime_loop(stats)
+
+    scheduler.follow(epoch.value)
+    while _running:
+        scheduler.wait()
+        wakeup.add(scheduler.late)
+        pipeline.run()
+        stats.record(pipeline.STAGES, pipeline.timings)
+        if control:
+            control.idle(scheduler.remaining())
+
+    if control:
+        control.stop()
+    if server:
+        server.stop()
+    close_output(serial, pi, waves)
+    shared.close()
+
+
+def display_main(path):
+    """Display process of the multi-process mode: shows the trims of the
+    values published in ``path`` on the LCD, and the values on the Scroll
+    pHAT."""
+    setup_signals()
+    shared = ChannelBuffer(path)
+    display = None
+    try:
+        lcd = LCD()
+        display = LCDWriter(lcd, max_rate=LCD_MAX_REFRESH_HZ)
+        display.start()
+    except:
+        print("could not init lcd")
+    scroll = scrollphat_writer()
+    trims = [None, None]
+    while _running and (display or scroll):
+        output = shared.read()[2]
+        if display:
+            show_trims(display, lcd, output, trims)
+        if scroll:
+            scroll.post(output)
+        time.sleep(1. / max(LCD_MAX_REFRESH_HZ, DISPLAY_MAX_REFRESH_HZ))
+    if display:
+        display.stop()
+    if scroll:
+        scroll.stop()
+    shared.close()
+
+
+def start_process(name, target, *args):
+    process = multiprocessing.Process(target=target, name=name, args=args)
+    process.daemon = True
+    process.start()
+    return process
+
+
+def main(realtime=False):
+    """The flight loop. ``realtime`` runs it in real-time mode, see
+    flystick_realtime."""
+    global _output, lcd
+    shared = None
+    processes = []
+    if MULTIPROCESS:
+        # multiprocessing reaps its children itself
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # before opening any devices, the children open their own
+        shared = ChannelBuffer(SHARED_OUTPUT, len(CHANNELS))
+        if flystick_boot.failsafe:
+            # keeps repeating until the output process takes over
+            flystick_boot.failsafe.release()
+        # the output process sets it to when its wave started
+        epoch = multiprocessing.RawValue('d', _clock())
+        processes.append(start_process("flystick-output", output_main,
+                                       SHARED_OUTPUT, epoch, realtime))
+        if LCD or scrollphat:
+            processes.append(start_process("flystick-display", display_main,
+                                           SHARED_OUTPUT))
+
+    if INPUT_BACKEND == 'evdev':
+        events, sleep = evdev_input()
+    elif INPUT_BACKEND == 'virtual':
+        events, sleep = virtual_input()
+    else:
+        events, sleep = pygame_input()
+    # network joysticks, the newest packets right before mixing
+    events = network.wrap(events)
+    # filtered axes are sampled while waiting for the next frame
+    oversampler.interval = 1. / AXIS_SAMPLE_HZ
+    sleep = oversampler.wrap(sleep)
+
+    # one flat function instead of a closure chain per channel, holding
+    # the failsafe values of channels of unplugged joysticks. The inputs
+    # are kept for the recorder. The values go to the same array every
+    # frame.
+    mixing = dict(inputs='keep' if RECORDER_PATH else None, matrix=MIX_MATRIX,
+                  out=True)
+    mix = failsafe_mix(compile_channels(CHANNELS, **mixing), CHANNELS,
+                       FAILSAFE)
+    if MULTIPROCESS:
+        serial = pi = waves = None
+        pipeline = FramePipeline(events, mix, None, send=shared.publish)
+        scheduler = FrameScheduler(PPM_FRAME_US, MIX_PHASE_US, sleep=sleep)
+        followed = epoch.value
+        scheduler.follow(followed)
+    else:
+        serial, pi, waves, started = open_output(flystick_boot.failsafe)
+        pipeline = output_pipeline(events, mix, serial, pi, waves)
+        scheduler = FrameScheduler(PPM_FRAME_US, PPM_FRAME_PHASE_US,
+                                   sleep=sleep)
+        if started is None:
+            scheduler.start()
+        else:
+            # on the frame boundaries of the running wave
+            scheduler.follow(started)
+
+    display = scroll = None
+    if not MULTIPROCESS:
+        try:
+            # the config already initialized it
+            lcd = getattr(flystick_config, 'lcd', None) or LCD()
+            display = LCDWriter(lcd, max_rate=LCD_MAX_REFRESH_HZ)
+            display.start()
+        except:
+            print("could not init lcd")
+        scroll = scrollphat_writer()
+
+    stats = Stats(pipeline.STAGES + ('frame', 'lcd', 'scrollphat'))
+    stats.counter('frames', lambda: pipeline.frames)
+    stats.counter('overruns', lambda: scheduler.overruns)
+    output_counters(stats, serial, pi, waves)
+    if INPUT_BACKEND == 'evdev':
+        from flystick_evdev import hotplug_monitor
+        monitor = hotplug_monitor()
+        if monitor:
+            stats.counter('joystick_reattaches',
+                          lambda: len(monitor.reattached))
+            stats.counter('last_reattach_ms', lambda: int(
+                monitor.reattached[-1][2] * 1e3 if monitor.reattached
+                else 0))
+    if oversampler.filters:
+        stats.counter('axis_samples', lambda: oversampler.samples)
+        stats.counter('axis_filter_added_us', lambda: int(
+            oversampler.added_latency()[0] * 1e6))
+        stats.counter('axis_filter_max_added_us', lambda: int(
+            oversampler.added_latency()[1] * 1e6))
+    if network.devices:
+        for name in ('packets', 'reordered', 'stale', 'malformed', 'losses'):
+            stats.counter('network_%s' % (name,),
+                          lambda name=name: network.counters()[name])
+        stats.counter('network_age_us', lambda: int(
+            max(device.age for device in network.devices) * 1e6))
+    if display:
+        display.histogram = stats.histogram('lcd')
+        stats.counter('lcd_refreshes', lambda: display.refreshes)
+    if scroll:
+        scroll.histogram = stats.histogram('scrollphat')
+        stats.counter('scrollphat_refreshes', lambda: scroll.refreshes)
+    recorder = None
+    if RECORDER_PATH:
+        try:
+            recorder = Recorder(RECORDER_PATH, RECORDER_FRAMES, len(CHANNELS),
+                                mix.inputs, input_labels(mix.input_keys),
+                                pipeline.STAGES)
+            stats.counter('recorded_frames', lambda: recorder.count)
+        except (EnvironmentError, ValueError) as e:
+            logging.warn("Not recording: %s", e)
+    reloader = None
+    if CONFIG_RELOAD_INTERVAL:
+        reloader = ConfigReloader(flystick_boot.CONFIG, CHANNELS,
+                                  CONFIG_RELOAD_INTERVAL, **mixing)
+        reloader.start()
+        stats.counter('config_reloads', lambda: reloader.reloads)
+        stats.counter('config_reload_failures', lambda: reloader.failures)
+    for phase in ('failsafe frame', 'config', 'first live frame'):
+        stats.counter('startup_%s_ms' % (phase.replace(' ', '_'),),
+                      lambda phase=phase: int(
+                          (flystick_boot.timer.elapsed(phase) or 0) * 1e3))
+    server = serve_stats(stats, STATS_SOCKET)
+    stats.counter('realtime', lambda: int(realtime))
+    wakeup = stats.histogram('wakeup')
+    # last, the helper threads stay out of it
+    control = realtime and realtime_loop(stats)
+
+    trims = [None, None]
+    while _running:
+        if MULTIPROCESS and epoch.value != followed:
+            # the output process started its wave
+            followed = epoch.value
+            scheduler.follow(followed)
+        # sleep until just before the next frame boundary
+        missed = scheduler.wait()
+        wakeup.add(scheduler.late)
+
+        # a changed config goes live between frames
+        update = reloader and reloader.take()
+        if update:
+            pipeline.mix = update.mix
+            if pipeline.condition:
+                pipeline.condition.deadband = update.deadband
+            if scroll:
+                scroll.components = update.display
+            if recorder:
+                recorder.attach(update.mix,
+                                input_labels(update.mix.input_keys))
+
+        _output = pipeline.run()
+        stats.record(pipeline.STAGES, pipeline.timings)
+        if recorder:
+            recorder.record(time.time(), pipeline.frames, missed,
+                            pipeline.timings, _output, pipeline.widths)
+        if pipeline.frames == 1:
+            flystick_boot.timer.mark('first live frame')
+            print(flystick_boot.timer.report())
+        if display:
+            show_trims(display, lcd, _output, trims)
+        if scroll:
+            scroll.post(_output)
+        if control:
+            # the frame is out, collect until the next one
+            control.idle(scheduler.remaining())
+
+    if control:
+        control.stop()
+    if reloader:
+        reloader.stop()
+    if recorder:
+        recorder.close()
+    if server:
+        server.stop()
+    if display:
+        display.stop()
+    if scroll:
+        scroll.stop()
+    close_output(serial, pi, waves)
+    for process in processes:
+        process.terminate()
+        process.join(1)
+    if shared:
+        shared.close()
+        shared.unlink()
+
+
+def setup_signals():
+    global _running
     _running = True
-    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
     signal.signal(signal.SIGTERM, shutdown)
     signal.signal(signal.SIGINT, shutdown)
-    main()
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    setup_signals()
+    main(realtime='--realtime' in sys.argv[1:])
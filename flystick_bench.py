@@ -0,0 +1,1335 @@
+#!/usr/bin/python
+"""
+Benchmarks for the flystick frame pipeline. Runs on a dev box, no
+joysticks or pigpiod needed.
+
+    python flystick_bench.py [allocations] [curves] [display] [evdev]
+        [filter] [hotplug] [lcd] [matrix] [mixer] [network] [pigpiod]
+        [pipeline] [realtime] [recorder] [router] [scheduler] [serial] ...
+"""
+from __future__ import print_function
+
+import collections
+import gc
+import itertools
+import sys
+import time
+
+from flystick_virtual import VirtualInput, VirtualJoystick
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def demo_channels(throttles=None, joystick=None):
+    """The mixes of the demo ``flystick_config``, on virtual sticks."""
+    throttles = throttles or VirtualJoystick(0)
+    joystick = joystick or VirtualJoystick(1)
+    roll_trim = joystick.hat_switch(hat=0, axis=0, positions=41, initial=20)
+    pitch_trim = joystick.hat_switch(hat=0, axis=1, positions=41, initial=20)
+    return (
+        joystick.axis(0) + roll_trim * 0.2,
+        joystick.axis(1) + pitch_trim * 0.2,
+        -throttles.axis(3),
+        throttles.button(23),
+        throttles.button(24) * 0.3 + throttles.button(15) * 0.3
+        + throttles.button(16) * 0.3,
+        throttles.button(19),
+        joystick.button(11) * 0.5 + joystick.button(13) * -0.5,
+        joystick.button(10) * -0.5 + joystick.button(12) * 0.5,
+        joystick.axis(0),
+        joystick.axis(1),
+    )
+
+
+def synthetic_channels(stick, count, complexity):
+    """``count`` channels on ``stick`` of the given mix ``complexity``:
+    'direct' axes, 'mixed' weighted sums with offsets, or 'trimmed' mixes
+    with a hat trim each."""
+    axes = len(stick._joy.axes)
+    channels = []
+    for i in range(count):
+        ch = stick.axis(i % axes)
+        if complexity in ('mixed', 'trimmed'):
+            ch = (ch * 0.7 + stick.axis((i + 1) % axes) * 0.3 - 0.05
+                  + stick.button(i % 32) * 0.1)
+        if complexity == 'trimmed':
+            ch = ch + stick.hat_switch(hat=0, axis=i % 2, positions=41,
+                                       initial=20) * 0.2
+        channels.append(ch)
+    return channels
+
+
+def bench_matrix():
+    from flystick_mixer import compile_channels, numpy
+    if numpy is None:
+        print("numpy not installed")
+        return
+    frames = 5000
+    evts = ([], [])
+    print("%-4s %-8s %12s %12s %8s" % ("ch", "mix", "compiled us",
+                                       "matrix us", "speedup"))
+    for count in (4, 8, 16, 32, 64, 128):
+        for complexity in ('mixed', 'trimmed'):
+            stick = VirtualJoystick(0, axes=16, buttons=64)
+            channels = synthetic_channels(stick, count, complexity)
+            result = []
+            for matrix in (False, True):
+                mix = compile_channels(channels, matrix=matrix)
+                mix(evts)
+                start = _clock()
+                for _ in range(frames):
+                    mix(evts)
+                result.append((_clock() - start) / frames)
+            print("%-4d %-8s %12.1f %12.1f %7.2fx" % (
+                count, complexity, result[0] * 1e6, result[1] * 1e6,
+                result[0] / result[1]))
+
+
+def bench_mixer():
+    from flystick_mixer import benchmark
+    result = benchmark(demo_channels())
+    for name in ('closures', 'compiled'):
+        print("%-10s %8.2f us/frame" % (name, result[name] * 1e6))
+    print("speedup    %8.2fx" % (result['closures'] / result['compiled']))
+
+
+def bench_curves():
+    from flystick_conf_models import (
+        Ch, expo_curve, points_curve, rates_curve)
+    from flystick_mixer import compile_channels
+    frames = 2000
+    evts = ([], [])
+    curves = (expo_curve(.4), rates_curve(1., .6, .2),
+              points_curve((-1., -.3, 0., .3, 1.)), expo_curve(.2))
+    print("%-4s %-7s %12s %12s %12s" % ("ch", "curves", "float us",
+                                        "closures us", "compiled us"))
+    for count in (4, 16, 64):
+        for stacked in (0, 1, 2, 4):
+            stick = VirtualJoystick(0, axes=8)
+            floats, tables = [], []
+            for i in range(count):
+                ch = stick.axis(i % 8) * .8 + stick.axis((i + 1) % 8) * .2
+                fch, tch = ch, ch
+                for curve in curves[:stacked]:
+                    # the nested lambdas of float math we had before
+                    fch = Ch(lambda evts, fn=fch, curve=curve:
+                             curve(max(min(fn(evts), 1.), -1.)))
+                    tch = tch.apply(curve)
+                floats.append(fch)
+                tables.append(tch)
+            result = []
+            for mix in (lambda evts: tuple(ch(evts) for ch in floats),
+                        lambda evts: tuple(ch(evts) for ch in tables),
+                        compile_channels(tables)):
+                mix(evts)
+                start = _clock()
+                for _ in range(frames):
+                    mix(evts)
+                result.append((_clock() - start) / frames * 1e6)
+            print("%-4d %-7d %12.1f %12.1f %12.1f" % (
+                (count, stacked) + tuple(result)))
+
+
+def bench_filter():
+    import math
+    import random
+    from flystick_filter import MovingAverage, Median, OneEuro, Oversampler
+    frames, period, rate = 3000, .02, 500.
+    print("%-8s %10s %10s %10s %10s" % (
+        "filter", "rms error", "jitter", "added ms", "max added"))
+    print("%-8s %10s %10s" % ("", "(moving)", "(at rest)"))
+    for name, make in (('raw', None),
+                       ('average', lambda: MovingAverage(.004)),
+                       ('median', lambda: Median(.004)),
+                       ('1euro', lambda: OneEuro(.004))):
+        now = [0.]
+        rnd = random.Random(1)
+
+        def stick(t):
+            # a slow sweep, then held still
+            return .5 * math.sin(math.pi * t) if t < frames * period / 2 \
+                else .3
+
+        def read():
+            # gimbal noise, and a spike now and then
+            spike = .2 if rnd.random() < .01 else 0.
+            return stick(now[0]) + rnd.gauss(0, .005) + spike
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        sampler = Oversampler(rate, clock=lambda: now[0])
+        filter = make() if make else None
+        value = filter.attach(read, sampler) if filter else read
+        wait = sampler.wrap(sleep)
+        moving, still = [], []
+        for frame in range(frames):
+            wait(period)
+            x = value()
+            if frame < frames / 2:
+                moving.append(x - stick(now[0]))
+            elif frame > frames / 2 + 10:
+                still.append(x)
+        rms = math.sqrt(sum(e * e for e in moving) / len(moving))
+        mean = sum(still) / len(still)
+        # in output steps (+-200 per PulseConditioner(750, 200))
+        jitter = 200 * math.sqrt(sum((x - mean) ** 2 for x in still) /
+                                 len(still))
+        print("%-8s %10.4f %10.2f %10.2f %10.2f" % (
+            name, rms, jitter,
+            filter.mean_added() * 1e3 if filter else 0.,
+            filter.max_added * 1e3 if filter else 0.))
+
+
+def demo_display():
+    """The ``DISPLAY`` of the demo ``flystick_config``."""
+    from flystick_conf_models import Block, XYDot, YBar, YDot
+    stick_dot = XYDot(col=5)
+    return (stick_dot.horizontal(), stick_dot.vertical(),
+            YBar(col=0, width=2), YDot(col=9),
+            Block(corner=(10, 0)), Block(corner=(10, 1)),
+            Block(corner=(10, 2)), Block(corner=(10, 3)))
+
+
+class _PushedColumns(object):
+    """Passes the columns set on to the ``device``, keeping their x in
+    ``pushed``."""
+    def __init__(self, device):
+        self.device = device
+        self.pushed = []
+
+    def set_col(self, x, value):
+        self.pushed.append(x)
+        self.device.set_col(x, value)
+
+    def update(self):
+        self.device.update()
+
+
+def bench_display():
+    """Scroll pHAT pushes of the demo display against pushing every
+    frame, checking that the pushed columns are the ones that changed and
+    the display shows what ``render()`` draws."""
+    from flystick_display import Bitmap, FakeScrollPhat, ScrollPhatWriter, \
+        render
+    from flystick_mixer import compile_channels
+    failed = []
+    frames = 5000
+    # events at flight rates: 20 ms simulated per frame
+    now = [0.]
+    source = VirtualInput(clock=lambda: now[0])
+    sticks = VirtualJoystick(0, seed=1), VirtualJoystick(1, seed=2)
+    for stick in sticks:
+        source.register(stick._joy)
+    mix = compile_channels(demo_channels(*sticks))
+    device = FakeScrollPhat()
+    columns = _PushedColumns(device)
+    pushed = columns.pushed
+    writer = ScrollPhatWriter(columns, demo_display())
+    expected = Bitmap()
+    spent = 0.
+    wrong_pixels = wrong_columns = 0
+    for frame in range(frames):
+        now[0] += .02
+        values = mix(source.events())
+        shown = device.shown
+        del pushed[:]
+        start = _clock()
+        writer.draw(values)
+        spent += _clock() - start
+        render(writer.components, values, expected)
+        wrong_pixels += device.shown != expected.columns
+        wrong_columns += frame and pushed != [
+            x for x in range(len(shown)) if expected.columns[x] != shown[x]]
+    # every frame pushed whole: 11 columns and an update
+    print("legacy     %6d pushes  %6d columns" % (frames, frames * 11))
+    print("diffed     %6d pushes, %.1f us/render"
+          % (writer.refreshes, spent / frames * 1e6))
+    _check(failed, not wrong_pixels, "%d frames shown as rendered"
+           % (frames - wrong_pixels,))
+    _check(failed, not wrong_columns, "only changed columns pushed")
+    if failed:
+        sys.exit(1)
+
+
+class _RecordingBus(object):
+    """Fake ``smbus2.SMBus`` recording the I2C transactions, each a list of
+    (address, bytes) messages. Passed as the ``i2c_msg`` of ``LCD`` too."""
+    def __init__(self):
+        self.transactions = []
+
+    def write(self, addr, data):
+        return addr, list(data)
+
+    def i2c_rdwr(self, *msgs):
+        self.transactions.append(msgs)
+
+
+def _lcd_lines(transactions, enable=0b100, chars=1):
+    """The two lines an HD44780 behind a PCF8574 expander shows after
+    ``transactions``, decoded from the nibbles latched on enable."""
+    ddram, address, nibbles = {}, 0, []
+    for msgs in transactions:
+        for addr, data in msgs:
+            for value in data:
+                if value & enable:
+                    nibbles.append(value)
+                    continue
+                if len(nibbles) < 2:
+                    continue
+                high, low = nibbles[:2]
+                del nibbles[:]
+                byte = (high & 0xF0) | (low >> 4)
+                if high & chars:
+                    ddram[address] = chr(byte)
+                    address += 1
+                elif byte & 0x80:
+                    address = byte & 0x7F
+                elif byte == 0x01:
+                    ddram, address = {}, 0
+    return tuple("".join(ddram.get(start + col, " ") for col in range(16))
+                 for start in (0x00, 0x40))
+
+
+def bench_lcd():
+    """I2C traffic of the trim display against a full rewrite of both
+    lines, and what it shows, decoded from the bytes sent. Then trims
+    posted to an ``LCDWriter`` faster than its refresh rate."""
+    from lcd import LCD, LCDWriter
+    failed = []
+    bus = _RecordingBus()
+    lcd = LCD(bus=bus, i2c_msg=bus)
+    _check(failed, _lcd_lines(bus.transactions) == (" " * 16,) * 2,
+           "blank after initializing")
+    # trim clicking through the range, as in the main loop
+    updates = [("rll %d%%" % trim, "ptch %d%%" % (trim // 2))
+               for trim in range(-20, 21)]
+    shown = []
+    del bus.transactions[:]
+    for rll, ptch in updates:
+        lcd.lcd_string(rll, lcd.LCD_LINE_1)
+        lcd.lcd_string(ptch, lcd.LCD_LINE_2)
+        shown.append(_lcd_lines(bus.transactions))
+    sent = sum(len(data) for msgs in bus.transactions for addr, data in msgs)
+    # full rewrite of both lines, one write_byte per expander update
+    legacy = 2 * (1 + lcd.LCD_WIDTH) * 2 * 3
+    print("legacy     %6d transactions %6d bytes per update"
+          % (legacy, legacy))
+    print("diffed     %6.1f transactions %6.1f bytes per update"
+          % (len(bus.transactions) / float(len(updates)),
+             sent / float(len(updates))))
+    _check(failed, shown == [(rll.ljust(16), ptch.ljust(16))
+                             for rll, ptch in updates],
+           "every update shows its text")
+    bus = _RecordingBus()
+    writer = LCDWriter(LCD(bus=bus, i2c_msg=bus), max_rate=20.)
+    writer.start()
+    start = time.time()
+    for rll, ptch in updates:
+        writer.post(rll, lcd.LCD_LINE_1)
+        writer.post(ptch, lcd.LCD_LINE_2)
+        time.sleep(.005)
+    # the last ones are written after at most one interval
+    time.sleep(2 * writer.interval)
+    writer.stop()
+    writer.join()
+    elapsed = time.time() - start
+    print("writer     %6d refreshes for %d updates in %.0f ms"
+          % (writer.refreshes, len(updates), elapsed * 1e3))
+    _check(failed, _lcd_lines(bus.transactions) == tuple(
+        text.ljust(16) for text in updates[-1]), "writer shows the latest")
+    _check(failed, 1 < writer.refreshes <= elapsed / writer.interval + 1,
+           "writer refreshes at most 20 times a second")
+    if failed:
+        sys.exit(1)
+
+
+class FakePigpio(object):
+    """Stand-in for the ``pigpio`` module, when it's not installed."""
+    OUTPUT = 1
+    WAVE_MODE_REPEAT_SYNC = 3
+
+    class pulse(object):
+        def __init__(self, gpio_on, gpio_off, delay):
+            self.gpio_on = gpio_on
+            self.gpio_off = gpio_off
+            self.delay = delay
+
+    # the base of PigpiodError without pigpio
+    error = Exception
+
+
+class FakePi(object):
+    """In-process stand-in for ``pigpio.pi()``, counting the calls and
+    the time spent in them. ``latency`` simulates the pigpiod round-trip
+    of every call."""
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.time = collections.Counter()
+        self._next_id = 0
+        self._waves = set()
+
+    def _call(self, name, start):
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls[name] += 1
+        self.time[name] += _clock() - start
+
+    def set_mode(self, gpio, mode):
+        self._call('set_mode', _clock())
+
+    def wave_add_new(self):
+        self._call('wave_add_new', _clock())
+
+    def wave_add_generic(self, pulses):
+        start = _clock()
+        # copied, like pigpio does
+        self._pulses = [(pulse.gpio_on, pulse.gpio_off, pulse.delay)
+                        for pulse in pulses]
+        self._call('wave_add_generic', start)
+        return len(pulses)
+
+    def wave_create(self):
+        start = _clock()
+        wave_id = self._next_id
+        self._next_id += 1
+        self._waves.add(wave_id)
+        self._call('wave_create', start)
+        return wave_id
+
+    def wave_send_repeat(self, wave_id):
+        self._call('wave_send_repeat', _clock())
+
+    def wave_send_using_mode(self, wave_id, mode):
+        start = _clock()
+        assert wave_id in self._waves
+        self._call('wave_send_using_mode', start)
+
+    def wave_delete(self, wave_id):
+        start = _clock()
+        self._waves.remove(wave_id)
+        self._call('wave_delete', start)
+
+    def stop(self):
+        pass
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return (samples[len(samples) // 2],
+            samples[min(len(samples) - 1, int(len(samples) * .99))],
+            samples[-1])
+
+
+def run_pipeline(channels, source, pi, frames=2000, cache_size=32):
+    """Drives ``frames`` frames of the main loop's per-frame work. Returns
+    per-stage latency samples (seconds) and net gc objects per frame."""
+    import flystick_ppm
+    from flystick_mixer import compile_channels
+    from flystick_pipeline import FramePipeline, trim_percent
+    from flystick_ppm import PpmTemplate, PulseConditioner, WaveCache
+    if flystick_ppm.pigpio is None:
+        flystick_ppm.pigpio = FakePigpio
+    waves = WaveCache(pi, PpmTemplate(1 << 18, 20000), capacity=cache_size)
+    pipeline = FramePipeline(source.events, compile_channels(channels),
+                             PulseConditioner(750, 200, deadband=1),
+                             send=waves.send)
+    stages = pipeline.STAGES + ('trim',)
+    samples = dict((stage, []) for stage in stages + ('total',))
+    gc.collect()
+    gc.disable()
+    try:
+        objects = gc.get_count()[0]
+        for _ in range(frames):
+            start = _clock()
+            output = pipeline.run()
+            trim_percent(output, 0, len(output) - 1)
+            end = _clock()
+            for stage, spent in zip(pipeline.STAGES, pipeline.timings):
+                samples[stage].append(spent)
+            samples['trim'].append(end - start - sum(pipeline.timings))
+            samples['total'].append(end - start)
+        objects = (gc.get_count()[0] - objects) / float(frames)
+    finally:
+        gc.enable()
+    return samples, objects, waves.stats()
+
+
+def bench_pipeline():
+    frames = 2000
+    print("%-3s %-8s %-10s %9s %9s %9s" % ("ch", "mix", "stage", "p50 us",
+                                         "p99 us", "max us"))
+    for count in (4, 8, 16):
+        for complexity in ('direct', 'mixed', 'trimmed'):
+            # events at flight rates: 20 ms simulated per frame
+            frame = itertools.count()
+            source = VirtualInput(clock=lambda: next(frame) * .02)
+            stick = VirtualJoystick(0, axes=8, buttons=32, rate=500., seed=1)
+            source.register(stick._joy)
+            pi = FakePi()
+            samples, objects, cache = run_pipeline(
+                synthetic_channels(stick, count, complexity), source, pi,
+                frames=frames)
+            for stage in ('input', 'mix', 'condition', 'trim', 'output',
+                          'total'):
+                print("%-3d %-8s %-10s %9.1f %9.1f %9.1f"
+                      % ((count, complexity, stage) + tuple(
+                          t * 1e6 for t in _percentiles(samples[stage]))))
+            print("    %.2f gc objects/frame, pigpio calls/frame: %s, "
+                  "wave cache: %r" % (
+                      objects,
+                      ", ".join("%s %.2f" % (name, n / float(frames))
+                                for name, n in sorted(pi.calls.items())),
+                      cache))
+
+
+def bench_pigpiod():
+    import random
+    import flystick_ppm
+    from flystick_pigpiod import FakePigpiod, PipelinedPi
+    from flystick_ppm import PpmTemplate, WaveCache
+    if flystick_ppm.pigpio is None:
+        flystick_ppm.pigpio = FakePigpio
+    frames = 2000
+    # a few recurring frames (cache hits) among moving sticks (misses)
+    rnd = random.Random(1)
+    keys = [tuple(750 + rnd.randrange(-2, 3) if rnd.random() < .5
+                  else 750 + rnd.randrange(-200, 200) for _ in range(8))
+            for _ in range(frames)]
+    for name, pipelined in (('sequential', False), ('pipelined', True)):
+        server = FakePigpiod()
+        server.start()
+        pi = PipelinedPi(port=server.port, pipelined=pipelined)
+        pi.wave_clear()
+        waves = WaveCache(pi, PpmTemplate(1 << 18, 20000))
+        pi.writes = pi.commands = 0
+        samples = []
+        for key in keys:
+            start = _clock()
+            waves.send(key)
+            samples.append(_clock() - start)
+        print("%-10s %6.2f round-trips/frame %6.2f commands/frame, "
+              "p50 %.1f us p99 %.1f us max %.1f us"
+              % ((name, pi.writes / float(frames),
+                  pi.commands / float(frames)) +
+                 tuple(t * 1e6 for t in _percentiles(samples))))
+        pi.stop()
+        server.stop()
+    # wave memory for 6 frames of 8 channels, under the cache capacity
+    server = FakePigpiod(max_pulses=6 * 18)
+    server.start()
+    pi = PipelinedPi(port=server.port)
+    pi.wave_clear()
+    waves = WaveCache(pi, PpmTemplate(1 << 18, 20000))
+    pi.writes = 0
+    try:
+        for key in keys:
+            waves.send(key)
+        error = None
+    except Exception as e:
+        error = e
+    ok = error is None and waves.evictions
+    print("%-4s out of wave memory: %s, %d evictions, %.2f round-trips/"
+          "frame" % ("ok" if ok else "FAIL", error or "no errors",
+                     waves.evictions, pi.writes / float(frames)))
+    pi.stop()
+    server.stop()
+    if not ok:
+        sys.exit(1)
+
+
+def _hat_values(joy, hat, axis):
+    """The per-switch event scan ``Joystick.hat_switch`` used before
+    ``EventRouter``."""
+    def hat_values(evts):
+        for evt in evts[1]:
+            if evt.joy == joy and evt.hat == hat:
+                yield evt.value[axis]
+    return hat_values
+
+
+def bench_router():
+    import random
+    from flystick_conf_models import EventRouter, InputEvent, Switch
+    frames = 5000
+    rnd = random.Random(1)
+    print("%8s %10s %10s %8s" % ("switches", "scan us", "routed us",
+                                 "speedup"))
+    for joysticks, hats in ((1, 1), (2, 4), (4, 8), (8, 16)):
+        keys = [(joy, hat, axis) for joy in range(joysticks)
+                for hat in range(hats) for axis in (0, 1)]
+        # mostly quiet, with bursts of clicking through trims
+        frame_evts = []
+        for _ in range(frames):
+            count = rnd.randrange(10, 30) if rnd.random() < .1 else \
+                rnd.randrange(2)
+            frame_evts.append(([], [
+                InputEvent(rnd.randrange(joysticks), None,
+                           rnd.randrange(hats),
+                           rnd.choice(((1, 0), (-1, 0), (0, 1), (0, -1))),
+                           0.) for _ in range(count)]))
+        scanned = [Switch(_hat_values(*key), positions=41, initial=20)
+                   for key in keys]
+        router = EventRouter()
+        routed = []
+        for joy, hat, axis in keys:
+            switch = Switch(None, positions=41, initial=20)
+            router.subscribe(joy, 'hat', hat, switch.move, axis=axis)
+            routed.append(switch)
+        start = _clock()
+        for evts in frame_evts:
+            for switch in scanned:
+                switch(evts)
+        scan = (_clock() - start) / frames
+        start = _clock()
+        for evts in frame_evts:
+            router.route(evts)
+            for switch in routed:
+                switch.value()
+        route = (_clock() - start) / frames
+        assert [s.pos for s in scanned] == [s.pos for s in routed]
+        print("%8d %10.1f %10.1f %7.1fx" % (len(keys), scan * 1e6,
+                                            route * 1e6, scan / route))
+
+
+def _input_events(*events):
+    """Recorded evdev events, (type, code, value) 1 ms apart."""
+    from flystick_evdev import INPUT_EVENT
+    return b''.join(INPUT_EVENT.pack(0, i * 1000, type_, code, value)
+                    for i, (type_, code, value) in enumerate(events))
+
+
+def _pipe_device(joy_id, name="Pipe Stick", path=None):
+    """An ``EvdevDevice`` of two axes (0 to 1023) and two buttons reading
+    a pipe, and the write end of the pipe."""
+    import fcntl
+    import os
+    from flystick_evdev import BTN_JOYSTICK, EvdevDevice
+    read, write = os.pipe()
+    fcntl.fcntl(read, fcntl.F_SETFL,
+                fcntl.fcntl(read, fcntl.F_GETFL) | os.O_NONBLOCK)
+    device = EvdevDevice(read, joy_id, name, (0, 1),
+                         (BTN_JOYSTICK, BTN_JOYSTICK + 1),
+                         {0: (0, 1023), 1: (0, 1023)}, path)
+    return device, write
+
+
+def bench_evdev():
+    """Recorded evdev events fed through a pipe: decoding (also of events
+    split across reads), routing, EOF as unplugging, and a joystick
+    constructed twice (the config swapping the sticks) reading its device
+    once."""
+    import os
+    import flystick_evdev
+    from flystick_conf_models import Joystick
+    from flystick_evdev import (ABS_HAT0X, BTN_JOYSTICK, EV_ABS, EV_KEY,
+                                EV_SYN, EvdevJoystick, EvdevPoller)
+    failed = []
+    poller = EvdevPoller()
+    device, write = _pipe_device(80)
+    poller.register(device)
+    data = _input_events((EV_ABS, 0, 1023), (EV_ABS, 1, 0),
+                         (EV_KEY, BTN_JOYSTICK, 1),
+                         (EV_ABS, ABS_HAT0X + 1, -1), (EV_SYN, 0, 0),
+                         (EV_KEY, BTN_JOYSTICK, 0))
+    os.write(write, data[:40])
+    clicks, hats = poller.events()
+    _check(failed, device.axes == [1., 0.] and not clicks and not hats,
+           "first event decoded, the rest of the read kept")
+    os.write(write, data[40:])
+    clicks, hats = poller.events()
+    _check(failed, device.axes == [1., -1.] and device.buttons == [False] * 2
+           and [(evt.joy, evt.button) for evt in clicks] == [(80, 0)]
+           and [(evt.joy, evt.hat, evt.value) for evt in hats]
+           == [(80, 0, (0, 1))] and device.get_hat(0) == (0, 1),
+           "axes, click and hat (up positive) after the split event")
+    frames, burst = 2000, 64
+    data = _input_events(*[(EV_ABS, i % 2, i % 1024) for i in range(burst)])
+    samples = []
+    for _ in range(frames):
+        os.write(write, data)
+        start = _clock()
+        poller.events()
+        samples.append(_clock() - start)
+    print("     decoding %d axis events p50 %.1f us p99 %.1f us max "
+          "%.1f us" % ((burst,) +
+                       tuple(t * 1e6 for t in _percentiles(samples))))
+    os.close(write)
+    poller.events()
+    _check(failed, not device.connected and not poller.devices,
+           "EOF is unplugging")
+    device.close()
+    # the config constructs the sticks again to swap them
+    writes = {}
+
+    class PipeDevice(flystick_evdev.EvdevDevice):
+        @classmethod
+        def open(cls, path, joy_id):
+            device, writes[joy_id] = _pipe_device(joy_id, path=path)
+            return device
+    patched = dict((name, getattr(flystick_evdev, name)) for name in
+                   ('EvdevDevice', 'joystick_paths', 'poller', '_monitor'))
+    flystick_evdev.EvdevDevice = PipeDevice
+    flystick_evdev.joystick_paths = lambda: ['pipe0', 'pipe1']
+    flystick_evdev.poller = poller
+    flystick_evdev._monitor = False
+    try:
+        throttles, joystick = EvdevJoystick(0), EvdevJoystick(1)
+        swapped = EvdevJoystick(1), EvdevJoystick(0)
+        os.write(writes[0], _input_events((EV_ABS, ABS_HAT0X, 1),
+                                          (EV_SYN, 0, 0)))
+        clicks, hats = poller.events()
+        _check(failed, len(poller.devices) == 2
+               and swapped == (joystick, throttles) and len(hats) == 1,
+               "constructed again, %d devices open, a hat move routed %d "
+               "times" % (len(poller.devices), len(hats)))
+    finally:
+        for name, value in patched.items():
+            setattr(flystick_evdev, name, value)
+        for joy_id, write in writes.items():
+            os.close(write)
+            Joystick.instances.pop((EvdevJoystick, joy_id), None)
+        for device in list(poller.devices.values()):
+            poller.unregister(device)
+            device.close()
+    if failed:
+        sys.exit(1)
+
+
+def bench_hotplug():
+    """Unplugging and plugging back the sticks of the config (swapped
+    like it does), as FIFOs in a temporary directory watched by a
+    ``HotplugMonitor``: the joysticks in use come back, under a new
+    device node too, and how long reattaching takes."""
+    import os
+    import shutil
+    import tempfile
+    import flystick_evdev
+    from flystick_conf_models import Joystick
+    from flystick_evdev import (EV_ABS, EV_SYN, EvdevJoystick, EvdevPoller,
+                                HotplugMonitor)
+    failed = []
+    directory = tempfile.mkdtemp()
+    names = {'event0': "Stick", 'event1': "Throttle", 'event2': "Throttle"}
+    writes = {}
+
+    class FifoDevice(flystick_evdev.EvdevDevice):
+        @classmethod
+        def open(cls, path, joy_id):
+            device = _pipe_device(joy_id, names[os.path.basename(path)],
+                                  path)[0]
+            os.close(device.fd)
+            device.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            writes[path] = os.open(path, os.O_WRONLY)
+            return device
+
+    def plug(name):
+        path = os.path.join(directory, name)
+        os.mkfifo(path)
+        return path
+
+    def unplug(path):
+        os.close(writes.pop(path))
+        os.unlink(path)
+
+    def settle(until):
+        end = _clock() + 1.
+        while not until() and _clock() < end:
+            poller.wait(.005)
+        return until()
+    poller = EvdevPoller()
+    monitor = HotplugMonitor(directory)
+    poller.register(monitor)
+    paths = [plug('event0'), plug('event1')]
+    patched = dict((name, getattr(flystick_evdev, name)) for name in
+                   ('EvdevDevice', 'joystick_paths', 'poller', '_monitor'))
+    flystick_evdev.EvdevDevice = FifoDevice
+    flystick_evdev.joystick_paths = lambda: paths
+    flystick_evdev.poller = poller
+    flystick_evdev._monitor = monitor
+    try:
+        throttles, joystick = EvdevJoystick(0), EvdevJoystick(1)
+        if throttles.get_name() != "Throttle":
+            throttles, joystick = EvdevJoystick(1), EvdevJoystick(0)
+        _check(failed, len(monitor.joysticks) == 2,
+               "%d joysticks watched" % (len(monitor.joysticks),))
+        unplug(paths[1])
+        _check(failed, settle(lambda: not throttles.connected)
+               and joystick.connected, "throttle unplugged")
+        path = plug('event2')
+        if settle(lambda: throttles.connected):
+            os.write(writes[path], _input_events((EV_ABS, 0, 1023),
+                                                 (EV_SYN, 0, 0)))
+        _check(failed, settle(lambda: throttles._joy.get_axis(0) == 1.),
+               "throttle back as event2, reading")
+        unplug(paths[0])
+        settle(lambda: not joystick.connected)
+        plug('event0')
+        _check(failed, settle(lambda: joystick.connected)
+               and throttles.connected, "stick back as event0")
+        for name, gone, bind in monitor.reattached:
+            print("     %s reattached after %.0f ms, bound %.1f ms after "
+                  "its node appeared" % (name, gone * 1e3, bind * 1e3))
+    finally:
+        for name, value in patched.items():
+            setattr(flystick_evdev, name, value)
+        for joy_id in (0, 1):
+            Joystick.instances.pop((EvdevJoystick, joy_id), None)
+        for device in list(poller.devices.values()):
+            poller.unregister(device)
+            device.close()
+        for write in writes.values():
+            os.close(write)
+        shutil.rmtree(directory)
+    if failed:
+        sys.exit(1)
+
+
+def bench_realtime():
+    """Frame wake-up jitter with garbage-making frames, in the default and
+    the real-time mode (as root), in a child process each. Checks that a
+    full collection too slow for any frame still runs."""
+    import multiprocessing
+    import flystick_realtime
+    failed = []
+    control = flystick_realtime.GcControl()
+    control.start()
+    try:
+        limit = flystick_realtime.DEFER_LIMIT * control.thresholds[2]
+        highest = 0
+        for frame in range(5000):
+            for i in range(200):
+                node = {'frame': frame}
+                node['self'] = node
+            # full collections take longer than the time left
+            control.durations[2] = 1.
+            control.idle(.001)
+            highest = max(highest, gc.get_count()[2])
+    finally:
+        control.stop()
+    _check(failed, 0 < control.deferred and highest <= limit,
+           "full collection put off until count %d (limit %d)"
+           % (highest, limit))
+    frames = 1000
+    print("%-9s %8s %8s %8s %8s %6s  %s" % (
+        "mode", "p50 us", "p99 us", "max us", "gc max", "gcs", "applied"))
+    for realtime in (False, True):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_jitter_loop,
+                                          args=(realtime, frames, queue))
+        process.start()
+        samples, gc_max, collections, applied = queue.get()
+        process.join()
+        print("%-9s %8.1f %8.1f %8.1f %8.1f %6s  %s" % (
+            (("realtime" if realtime else "default",) +
+             tuple(t * 1e6 for t in _percentiles(samples)) +
+             (gc_max * 1e6, collections if collections >= 0 else "-",
+              ", ".join(applied)))))
+    if failed:
+        sys.exit(1)
+
+
+def _jitter_loop(realtime, frames, queue):
+    import flystick_realtime
+    from flystick_scheduler import FrameScheduler
+    from flystick_stats import Histogram
+    scheduler = FrameScheduler(5000, 1000)
+    histogram = Histogram()
+    # long-lived objects, like a loaded config
+    kept = [{'value': [i]} for i in range(50000)]
+    applied, control = [], None
+    if realtime:
+        applied = flystick_realtime.enable()
+        control = flystick_realtime.GcControl(histogram)
+        control.start()
+    samples = []
+    scheduler.start()
+    for frame in range(frames):
+        scheduler.wait()
+        samples.append(scheduler.late)
+        # cyclic garbage, like closures and frames of a busy loop
+        for i in range(200):
+            node = {'frame': frame}
+            node['self'] = node
+        if control:
+            control.idle(scheduler.remaining())
+    if control:
+        control.stop()
+    queue.put((samples, histogram.max,
+               control.collections if control else -1, applied))
+    del kept
+
+
+def bench_recorder():
+    """Record time and size, and what is read back, for a few numbers of
+    channels, inputs and stage timings."""
+    import os
+    import tempfile
+    from flystick_recorder import Recorder, Recording
+    failed = []
+    frames = 5000
+    print("%-3s %-6s %-6s %10s %10s %12s" % (
+        "ch", "inputs", "stages", "record us", "bytes", "gc obj/frame"))
+    for channels, inputs, stages in ((4, 4, 4), (10, 14, 5), (16, 32, 3)):
+        path = os.path.join(tempfile.mkdtemp(), 'recorder.bin')
+        values = [.5] * inputs
+        recorder = Recorder(path, 1000, channels, values,
+                            ['in%d' % (i,) for i in range(inputs)],
+                            ['stage%d' % (i,) for i in range(stages)])
+        output = (.25,) * channels
+        widths = (1550,) * channels
+        timings = [.5 ** i for i in range(stages)]
+        gc.collect()
+        gc.disable()
+        try:
+            objects = gc.get_count()[0]
+            start = _clock()
+            for frame in range(frames):
+                recorder.record(1.5, frame, 0, timings, output, widths)
+            spent = (_clock() - start) / frames
+            objects = (gc.get_count()[0] - objects) / float(frames)
+        finally:
+            gc.enable()
+        recorder.close()
+        recording = Recording(path)
+        records = list(recording)
+        print("%-3d %-6d %-6d %10.2f %10d %12.2f" % (
+            channels, inputs, stages, spent * 1e6, recorder.layout.size,
+            objects))
+        _check(failed, len(records) == 1000 and
+               records[-1] == (1.5, frames - 1, 0, tuple(timings),
+                               tuple(values), output, widths),
+               "%d stage timings read back" % (stages,))
+        recording.map.close()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+    if failed:
+        sys.exit(1)
+
+
+class _Posts(object):
+    """Fake ``LCDWriter``, keeping the latest text of each line."""
+    def __init__(self):
+        self.lines = {}
+
+    def post(self, message, line):
+        self.lines[line] = message
+
+
+class _Cycle(VirtualInput):
+    """Event source replaying the same ``moves`` of the virtual devices
+    over and over, one list of (device, kind, index, value) per frame,
+    so that the state the frame loop keeps comes back every cycle."""
+    def __init__(self, moves):
+        VirtualInput.__init__(self)
+        self.moves = moves
+        self.frame = 0
+
+    def collect(self):
+        moves = self.moves[self.frame % len(self.moves)]
+        for device, kind, index, value in moves:
+            device._apply(self, 0., kind, index, value)
+        self.frame += 1
+
+
+def _cycle_moves(sticks, frames):
+    """Every axis of ``sticks`` swinging once through ``frames``, their
+    buttons each clicked once and their hats clicked each way."""
+    import math
+    moves = [[] for _ in range(frames)]
+    for stick in sticks:
+        device = stick._joy
+        for axis in range(len(device.axes)):
+            for frame in range(frames):
+                moves[frame].append((device, 'axis', axis, math.sin(
+                    2 * math.pi * frame / frames + axis)))
+        for button in range(len(device.buttons)):
+            frame = button * frames // len(device.buttons)
+            moves[frame].append((device, 'button', button, True))
+            moves[frame + 1].append((device, 'button', button, False))
+        for hat in range(len(device.hats)):
+            for k, value in enumerate(((1, 0), (-1, 0), (0, 1), (0, -1))):
+                frame = (2 * k + 1) * frames // 8
+                moves[frame].append((device, 'hat', hat, value))
+                moves[frame + 1].append((device, 'hat', hat, (0, 0)))
+    return moves
+
+
+def bench_allocations():
+    """Checks that the steady-state frame loop (input, mixing into the
+    output array, pulses, waves, stats, recorder, LCD trims) leaves no
+    memory allocated behind: the sticks replay a cycle of moves, on a
+    stepped clock, so every block the loop keeps is replaced by one of
+    the same cycle and exactly as many are allocated after a whole number
+    of cycles. Exits with 1 otherwise. Without tracemalloc (python 2) it
+    counts the objects the gc tracks instead.
+
+    Changed frames do allocate their widths tuple and, with ``excluded``
+    channels, the tuple sent, both kept as wave cache keys while cached:
+    they replace evicted ones."""
+    import os
+    import tempfile
+    import flystick_pipeline
+    import flystick_ppm
+    from flystick_mixer import compile_channels, failsafe_mix
+    from flystick_pipeline import FramePipeline, TrimText, trim_percent
+    from flystick_ppm import PpmTemplate, PulseConditioner, WaveCache
+    from flystick_recorder import Recorder, input_labels
+    from flystick_stats import Stats
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if flystick_ppm.pigpio is None:
+        flystick_ppm.pigpio = FakePigpio
+    cycle = 500
+    warmup, frames = 10 * cycle, 10 * cycle
+    sticks = VirtualJoystick(0, seed=1), VirtualJoystick(1, seed=2)
+    source = _Cycle(_cycle_moves(sticks, cycle))
+    channels = demo_channels(*sticks)
+    mix = failsafe_mix(compile_channels(channels, inputs='keep', out=True),
+                       channels, (0.,) * len(channels))
+    waves = WaveCache(FakePi(), PpmTemplate(1 << 18, 20000))
+    pipeline = FramePipeline(source.events, mix,
+                             PulseConditioner(750, 200, deadband=1),
+                             send=waves.send, excluded=(8,))
+    stats = Stats(pipeline.STAGES + ('frame',))
+    path = os.path.join(tempfile.mkdtemp(), 'recorder.bin')
+    recorder = Recorder(path, 1000, len(channels), mix.inputs,
+                        input_labels(mix.input_keys), pipeline.STAGES)
+    lcd, texts, shown = _Posts(), (TrimText("rll"), TrimText("ptch")), \
+        [None, None]
+    # the same stage timings every frame, in the same stats buckets
+    clock, ticks = flystick_pipeline._clock, itertools.count()
+    flystick_pipeline._clock = lambda: next(ticks) * 1e-5
+
+    def run(frames):
+        for _ in range(frames):
+            output = pipeline.run()
+            stats.record(pipeline.STAGES, pipeline.timings)
+            recorder.record(1.5, pipeline.frames, 0, pipeline.timings,
+                            output, pipeline.widths)
+            for line in (0, 1):
+                trim = trim_percent(output, line, 8 + line)
+                if trim != shown[line]:
+                    shown[line] = trim
+                    lcd.post(texts[line](trim), line)
+
+    try:
+        if tracemalloc:
+            # before anything is cached, so that what replaces cached
+            # things doesn't look new
+            tracemalloc.start()
+        # caches filled, wave cache full
+        run(warmup)
+        if tracemalloc:
+            # a full collection empties the free lists too
+            gc.collect()
+            before = tracemalloc.take_snapshot()
+            run(frames)
+            gc.collect()
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            growth = [stat for stat in after.compare_to(before, 'lineno')
+                      if stat.traceback[0].filename != tracemalloc.__file__]
+            net = sum(stat.count_diff for stat in growth)
+            size = sum(stat.size_diff for stat in growth)
+            left = "%.3f blocks (%.3f bytes)" % (net / float(frames),
+                                                 size / float(frames))
+        else:
+            gc.collect()
+            objects = len(gc.get_objects())
+            run(frames)
+            gc.collect()
+            net = len(gc.get_objects()) - objects
+            growth = []
+            left = "%.3f gc objects" % (net / float(frames),)
+    finally:
+        flystick_pipeline._clock = clock
+        recorder.close()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+    print("%d frames, %d new waves: %s per frame left allocated"
+          % (frames, waves.misses, left))
+    if net:
+        for stat in growth[:10]:
+            print("  %s" % (stat,))
+        sys.exit(1)
+
+
+def bench_network():
+    """Loopback: the packet trip into a ``NetworkJoystick``, the age of
+    the values frames get from a sender process at 250 Hz, and what is
+    dropped."""
+    import multiprocessing
+    import socket
+    import flystick_network
+    from flystick_mixer import compile_channels, failsafe_mix
+    from flystick_network import NetworkJoystick, Sender, pack, receiver
+    from flystick_network import _clock as stamp_clock
+    failed = []
+    ground = NetworkJoystick(90, port=0, host='127.0.0.1', timeout=.05)
+    device = ground._joy
+    channels = (ground.axis(0), ground.button(0))
+    mix = failsafe_mix(compile_channels(channels), channels, (0., -1.))
+    before = mix(([], []))
+    sender = Sender('127.0.0.1', device.port)
+    trips, polls = [], []
+    for i in range(2000):
+        start = _clock()
+        sender.send((i % 100 / 100.,), (True,))
+        while device.packets <= i:
+            receiver.events()
+        trips.append(_clock() - start)
+        start = _clock()
+        receiver.events()
+        polls.append(_clock() - start)
+    print("%-22s p50 %7.1f us p99 %7.1f us max %7.1f us" % (
+        ("send to mixable",) + tuple(t * 1e6 for t in _percentiles(trips))))
+    print("%-22s p50 %7.1f us p99 %7.1f us max %7.1f us" % (
+        ("read, nothing new",) +
+        tuple(t * 1e6 for t in _percentiles(polls))))
+    # frames at 50 Hz, the sender not in step with them
+    frames, period, rate = 200, .02, 250.
+    process = multiprocessing.Process(
+        target=_send_loop,
+        args=(device.port, rate, frames * period + 1.))
+    process.start()
+    first = device.packets
+    while device.packets == first:
+        time.sleep(.001)
+        receiver.events()
+    ages = []
+    for frame in range(frames):
+        time.sleep(period)
+        receiver.events()
+        ages.append(stamp_clock() - device.stamp)
+    process.join()
+    receiver.events()
+    print("%-22s p50 %7.1f us p99 %7.1f us max %7.1f us  (%.0f Hz sender, "
+          "%.0f ms frames)" % (
+              ("value age at frame",) +
+              tuple(t * 1e6 for t in _percentiles(ages)) +
+              (rate, period * 1e3)))
+    # out of order, duplicated, 1 s late and garbage
+    dropped = ('reordered', 'stale', 'malformed')
+    counts = [getattr(device, name) for name in dropped]
+    raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    seq = sender.seq + 1000
+    now = stamp_clock()
+    for packet in (pack(seq + 2, now, (.5,)),
+                   pack(seq + 1, now, (.1,)),
+                   pack(seq + 2, now, (.1,)),
+                   pack(seq + 3, now - 1., (.1,)),
+                   b'\x00' * 30):
+        raw.sendto(packet, ('127.0.0.1', device.port))
+    time.sleep(.01)
+    receiver.events()
+    live = mix(([], []))
+    time.sleep(.1)
+    receiver.events()
+    print("%-22s %s (sent 2 out of order, 1 late, 1 garbage), axis "
+          "%.2f" % ("dropped", ", ".join(
+              "%d %s" % (getattr(device, name) - count, name)
+              for name, count in zip(dropped, counts)), device.axes[0]))
+    print("%-22s before packets %s, receiving %s, %d ms without %s" % (
+        ("failsafe",) + tuple(" ".join("%+.2f" % (value,) for value in values)
+                              for values in (before, live)) +
+        (device.timeout * 1e3,
+         " ".join("%+.2f" % (value,) for value in mix(([], []))))))
+    # headers of a new layout with a bad magic, too many buttons or the
+    # wrong size, dropped without keeping a struct for the layout
+    layouts, malformed = len(flystick_network._bodies), device.malformed
+    magic, header = flystick_network.MAGIC, flystick_network.HEADER
+    # 100 axes, 50 hats: 2 * 100 + 4 + 2 * 50 bytes of body
+    for packet in (header.pack(b'JUNK', seq + 4, now, 100, 0, 50),
+                   header.pack(magic, seq + 4, now, 100, 33, 50),
+                   header.pack(magic, seq + 4, now, 100, 0, 50)[:-1]):
+        raw.sendto(packet + b'\0' * 304, ('127.0.0.1', device.port))
+    time.sleep(.01)
+    receiver.events()
+    _check(failed, device.malformed - malformed == 3 and
+           len(flystick_network._bodies) == layouts,
+           "malformed headers dropped, no layout kept")
+    # its clock and sequence numbers starting over
+    raw.sendto(pack(1, stamp_clock() - 1000., (.75,)),
+               ('127.0.0.1', device.port))
+    time.sleep(.01)
+    receiver.events()
+    print("%-22s %s, axis %.2f" % (
+        "restarted sender", "taken" if device.connected else "dropped",
+        device.axes[0]))
+    raw.close()
+    sender.close()
+    device.close()
+    receiver.devices.remove(device)
+    if failed:
+        sys.exit(1)
+
+
+def _send_loop(port, rate, seconds):
+    from flystick_network import Sender
+    sender = Sender('127.0.0.1', port)
+    end = _clock() + seconds
+    deadline = _clock()
+    while deadline < end:
+        sender.send((.25, -.25), (True,))
+        deadline += 1. / rate
+        time.sleep(max(deadline - _clock(), 0))
+
+
+def _check(failed, ok, what):
+    print("%-4s %s" % ("ok" if ok else "FAIL", what))
+    if not ok:
+        failed.append(what)
+
+
+def bench_scheduler():
+    """The length of the PPM frames, and the overruns ``FrameScheduler``
+    counts against the frames that really went out with a stale wave,
+    with stalls of up to three frames on a simulated clock."""
+    import random
+    import flystick_ppm
+    from flystick_ppm import PpmTemplate, ppm_pulses
+    from flystick_scheduler import FrameScheduler
+    if flystick_ppm.pigpio is None:
+        flystick_ppm.pigpio = FakePigpio
+    failed = []
+    widths = (1500,) * 8
+    template = PpmTemplate(1, 20000)
+    lengths = sorted(set(sum(pulse.delay for pulse in pulses) for pulses in
+                         (ppm_pulses(widths, 1, 20000), template(widths),
+                          template((1000, 2000) * 4))))
+    _check(failed, lengths == [20000], "PPM frames %s us long, of 20000 "
+           "us" % (", ".join(str(length) for length in lengths),))
+    rnd = random.Random(1)
+    # microseconds
+    now = [rnd.randrange(20000)]
+
+    def sleep(seconds):
+        now[0] += int(round(seconds * 1e6))
+    scheduler = FrameScheduler(20000, 4000, report_every=0,
+                               clock=lambda: now[0] / 1e6, sleep=sleep)
+    epoch = now[0]
+    scheduler.start()
+    # the boundaries frames were done before, numbered from the epoch
+    fresh = set()
+    for _ in range(20000):
+        scheduler.wait()
+        fresh.add((now[0] - epoch) // 20000 + 1)
+        # the frame is out, then the rest of the loop, stalling at times
+        now[0] += rnd.randrange(60001) if rnd.random() < .02 else \
+            rnd.randrange(1, 2000)
+    stale = max(fresh) - min(fresh) + 1 - len(fresh)
+    _check(failed, scheduler.overruns == stale,
+           "%d overruns counted, %d frames stale" % (scheduler.overruns,
+                                                      stale))
+    if failed:
+        sys.exit(1)
+
+
+def _unpack_channels(data):
+    """The 16 11-bit channels packed LSB first in ``data``."""
+    bits = sum(byte << (8 * i) for i, byte in enumerate(bytearray(data)))
+    return [(bits >> (11 * i)) & 0x7ff for i in range(16)]
+
+
+def _channel_us(channel):
+    """Pulse width of an 11-bit channel value, 0.625 us steps."""
+    return 1500 + (channel - 992) * 5 / 8.
+
+
+def bench_serial():
+    import os
+    import random
+    import select
+    from flystick_serial import SerialOutput, crc8_dvb_s2, crsf_frame, \
+        sbus_frame
+    failed = []
+    # 1000/1500/2000 us in [-1..1], 1 being 512.5 us off center
+    widths = [1000, 1500, 2000] + [1500] * 13
+    values = [(us - 1500) / 512.5 for us in widths]
+    frame = bytearray(sbus_frame(values))
+    _check(failed, len(frame) == 25 and frame[0] == 0x0f
+           and frame[-1] == 0x00, "sbus 25 bytes, header 0x0f footer 0x00")
+    _check(failed, [_channel_us(channel)
+                    for channel in _unpack_channels(frame[1:23])] == widths,
+           "sbus 1000/1500/2000 us decode back")
+    _check(failed, frame[23] == 0 and
+           bytearray(sbus_frame(values, failsafe=True))[23] == 0x0c,
+           "sbus flags 0, frame lost and failsafe 0x0c")
+    full = [-1, 1, -2, 2] + [0] * 12
+    _check(failed, _unpack_channels(bytearray(sbus_frame(full))[1:23]) ==
+           [172, 1811, 172, 1811] + [992] * 12,
+           "sbus full scale 172..1811, clamped beyond")
+    frame = bytearray(crsf_frame(values))
+    _check(failed, len(frame) == 26 and frame[0] == 0xc8 and frame[1] == 24
+           and frame[2] == 0x16, "crsf address 0xc8, length 24, type 0x16")
+    _check(failed, [_channel_us(channel)
+                    for channel in _unpack_channels(frame[3:25])] == widths,
+           "crsf 1000/1500/2000 us decode back")
+    # CRC-8/DVB-S2 check value, and the frame of all channels centered
+    _check(failed, crc8_dvb_s2(b"123456789") == 0xbc and
+           frame[25] == crc8_dvb_s2(frame[2:25]) and
+           bytearray(crsf_frame([0] * 16)) == bytearray.fromhex(
+               "c8 18 16 e0 03 1f f8 c0 07 3e f0 81 0f 7c e0 03 1f f8 c0 07"
+               " 3e f0 81 0f 7c ad"), "crsf crc8 dvb-s2, centered frame")
+    frames = 2000
+    rnd = random.Random(1)
+    values = [tuple(rnd.uniform(-1, 1) for _ in range(16))
+              for _ in range(frames)]
+    for protocol in ('sbus', 'crsf'):
+        master, slave = os.openpty()
+        output = SerialOutput(os.ttyname(slave), protocol)
+        start = _clock()
+        for frame in values:
+            output.encode(frame)
+        encode = (_clock() - start) / frames
+        samples = []
+        size = len(output.encode(values[0]))
+        for frame in values:
+            start = _clock()
+            output.send(frame)
+            received = 0
+            while received < size:
+                select.select([master], [], [])
+                received += len(os.read(master, size - received))
+            samples.append(_clock() - start)
+        print("%-5s %2d bytes, encode %6.1f us (%6d frames/s), "
+              "encode+pty p50 %.1f us p99 %.1f us max %.1f us"
+              % ((protocol, size, encode * 1e6, 1 / encode) +
+                 tuple(t * 1e6 for t in _percentiles(samples))))
+        output.stop()
+        os.close(slave)
+        os.close(master)
+    if failed:
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    'allocations': bench_allocations,
+    'curves': bench_curves,
+    'display': bench_display,
+    'evdev': bench_evdev,
+    'filter': bench_filter,
+    'hotplug': bench_hotplug,
+    'lcd': bench_lcd,
+    'matrix': bench_matrix,
+    'mixer': bench_mixer,
+    'network': bench_network,
+    'pigpiod': bench_pigpiod,
+    'pipeline': bench_pipeline,
+    'realtime': bench_realtime,
+    'recorder': bench_recorder,
+    'router': bench_router,
+    'scheduler': bench_scheduler,
+    'serial': bench_serial,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print("== %s" % (name,))
+        BENCHMARKS[name]()
@@ -0,0 +1,185 @@
+"""
+Fast startup: the failsafe frame goes out right after power-up, before
+``flystick_config`` is imported (which opens the joysticks and the LCD,
+and may take seconds), and the main loop takes the output over once the
+inputs are ready.
+
+The output settings are read from the config file without running it, so
+they (and ``FAILSAFE``) must be literals there. Otherwise the failsafe
+frame only starts with the main loop.
+"""
+import ast
+import logging
+import os
+import threading
+import time
+
+from flystick_pigpiod import PipelinedPi
+from flystick_ppm import PulseConditioner, start_ppm
+from flystick_serial import SerialOutput
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+_clock = getattr(time, 'monotonic', time.time)
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'flystick_config.py')
+
+# what the failsafe output needs from the config
+SETTINGS = ('OUTPUT', 'SERIAL_OUTPUT_PORT', 'PPM_OUTPUT_PIN', 'PPM_FRAME_US',
+            'PIGPIOD_PIPELINED', 'PWM_INITIAL_TRIM', 'PWM_DIFF',
+            'JOYSTICK_ROLL_TRIM_CHANNEL', 'FAILSAFE')
+
+
+def _process_start():
+    """When this process started, on ``_clock``, from /proc."""
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+        return _clock() - (uptime - started)
+    except (IOError, OSError, IndexError, ValueError):
+        return _clock()
+
+
+class BootTimer(object):
+    """Startup phases, in time since the process started."""
+    def __init__(self):
+        self.start = _process_start()
+        self.marks = []
+
+    def mark(self, phase):
+        self.marks.append((phase, _clock()))
+
+    def elapsed(self, phase):
+        """Seconds from process start to ``phase``, or None."""
+        for name, at in self.marks:
+            if name == phase:
+                return at - self.start
+
+    def report(self):
+        last = self.start
+        parts = []
+        for phase, at in self.marks:
+            parts.append("%s %.0f ms (+%.0f)"
+                         % (phase, (at - self.start) * 1e3,
+                            (at - last) * 1e3))
+            last = at
+        return "startup: " + ", ".join(parts)
+
+
+timer = BootTimer()
+
+
+def literal_settings(path, names):
+    """The top-level assignments of ``names`` in the python file
+    ``path`` that are literals, without running it."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    settings = {}
+    for stmt in tree.body:
+        if not isinstance(stmt, ast.Assign):
+            continue
+        for target in stmt.targets:
+            if isinstance(target, ast.Name) and target.id in names:
+                try:
+                    settings[target.id] = ast.literal_eval(stmt.value)
+                except ValueError:
+                    # computed, the last assignment wins
+                    settings.pop(target.id, None)
+    return settings
+
+
+def failsafe_values(values, excluded):
+    """``values`` of all channels without the ``excluded`` ones."""
+    return tuple(value for i, value in enumerate(values)
+                 if i not in excluded)
+
+
+def failsafe_widths(values, excluded, center_us, range_us):
+    """PPM widths of the failsafe channel ``values``."""
+    return PulseConditioner(center_us, range_us)(
+        failsafe_values(values, excluded))[0]
+
+
+class FailsafeOutput(object):
+    """Sends the failsafe frame from the given config ``settings`` until
+    ``handover()``: PPM repeats the frame on its own in pigpiod, serial
+    frames are sent from a thread. The first frame sent is marked on the
+    ``timer``; without pigpio there is none."""
+    def __init__(self, settings):
+        excluded = (settings['JOYSTICK_ROLL_TRIM_CHANNEL'],)
+        self.serial = self.pi = self.wave = self.started = None
+        self._stopped = threading.Event()
+        self._sender = None
+        if settings['OUTPUT'] != 'ppm':
+            self.serial = SerialOutput(settings['SERIAL_OUTPUT_PORT'],
+                                       settings['OUTPUT'])
+            self._sender = threading.Thread(
+                target=self._send, name="failsafe-sender",
+                args=(failsafe_values(settings['FAILSAFE'], excluded),
+                      settings['PPM_FRAME_US'] / 1e6))
+            self._sender.daemon = True
+            self._sender.start()
+        elif pigpio:
+            self.pi = (PipelinedPi() if settings['PIGPIOD_PIPELINED']
+                       else pigpio.pi())
+            self.wave, self.started = start_ppm(
+                self.pi, settings['PPM_OUTPUT_PIN'],
+                failsafe_widths(settings['FAILSAFE'], excluded,
+                                settings['PWM_INITIAL_TRIM'] / 2,
+                                settings['PWM_DIFF'] / 2),
+                settings['PPM_FRAME_US'])
+            timer.mark('failsafe frame')
+
+    def _send(self, values, interval):
+        self.serial.send(values)
+        timer.mark('failsafe frame')
+        while not self._stopped.wait(interval):
+            self.serial.send(values)
+
+    def handover(self):
+        """Stops sending. Returns the (serial, pi, wave, when the wave
+        started) to continue with; the wave keeps repeating until
+        replaced."""
+        self._stopped.set()
+        if self._sender:
+            self._sender.join()
+        return self.serial, self.pi, self.wave, self.started
+
+    def release(self):
+        """Closes the output for another process to take it over. The
+        PPM frame keeps repeating meanwhile."""
+        serial, pi, wave, started = self.handover()
+        if serial:
+            serial.stop()
+        if pi:
+            pi.stop()
+
+
+failsafe = None
+
+
+def start(path=CONFIG):
+    """Starts the failsafe output, if the config allows. Sets
+    ``failsafe``."""
+    global failsafe
+    timer.mark('interpreter')
+    try:
+        settings = literal_settings(path, SETTINGS)
+        missing = [name for name in SETTINGS if name not in settings]
+        if missing:
+            logging.warn("Not literals in %s: %s, no failsafe frame "
+                         "before the config is loaded", path,
+                         ", ".join(missing))
+            return
+        failsafe = FailsafeOutput(settings)
+    except Exception as e:
+        logging.warn("Failed to start the failsafe output: %s", e,
+                     exc_info=True)
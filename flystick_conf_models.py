@@ -1,4 +1,62 @@
-import pygame.joystick
+import collections
+
+# Steps of the curve tables over [-1..1]: the output's resolution, one
+# per unit of the pulse width range (PWM_DIFF / 2 each way).
+CURVE_STEPS = 400
+
+
+class Curve(object):
+    """``fn`` over [-1..1], precomputed at ``steps`` + 1 points and looked
+    up at the nearest one. Input outside [-1..1] is limited to it."""
+    def __init__(self, fn, steps=CURVE_STEPS):
+        self.fn = fn
+        self.steps = steps
+        self.scale = steps / 2.
+        self.table = tuple(float(fn(2. * i / steps - 1))
+                           for i in range(steps + 1))
+
+    def __call__(self, x):
+        return self.table[int((max(min(x, 1.), -1.) + 1.) * self.scale + .5)]
+
+    def then(self, curve):
+        """This curve followed by ``curve``, as one table."""
+        fn, after = self.fn, curve.fn
+        return Curve(lambda x: after(max(min(fn(x), 1.), -1.)),
+                     max(self.steps, curve.steps))
+
+
+def expo_curve(expo):
+    """The RC expo curve: ``expo`` 0 is linear, 1 cubic (softest in the
+    center)."""
+    return lambda x: (1 - expo) * x + expo * x ** 3
+
+
+def rates_curve(rate=1., super_rate=0., expo=0.):
+    """Betaflight style rates: ``expo`` softens the center, ``super_rate``
+    [0..1) sharpens the ends, and ``rate`` is the value at full stick."""
+    def rates(x):
+        x = (1 - expo) * x + expo * x * abs(x) ** 3
+        return rate * x * (1 - super_rate) / (1 - abs(x) * super_rate)
+    return rates
+
+
+def points_curve(points):
+    """Linear interpolation of ``points``: (x, y) pairs, or y values evenly
+    spaced over [-1..1] like the curves of RC transmitters."""
+    points = list(points)
+    if not all(isinstance(p, (tuple, list)) for p in points):
+        step = 2. / (len(points) - 1)
+        points = [(i * step - 1, y) for i, y in enumerate(points)]
+    points.sort()
+
+    def curve(x):
+        if x <= points[0][0]:
+            return points[0][1]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if x <= x1:
+                return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+        return points[-1][1]
+    return curve
 
 
 class Ch(object):
@@ -27,105 +85,305 @@ class Ch(object):
     Also a shortcut to scale the output to range [0..1]
     instead of the normal [-1..1]:
         +stick.axis(0)
+
+    Curves, looked up in tables computed at startup (see ``Curve``), so
+    they cost the same however complex, and stacked ones are merged:
+        stick.axis(0).expo(0.4)
+        stick.axis(0).rates(1., super_rate=0.5, expo=0.2)
+        stick.axis(2).curve((-1., -0.2, 0.2, 0.6, 1.))
+
+    Every operator also records an expression node (``self.node``) so
+    that the whole of ``CHANNELS`` can be compiled into a single flat
+    function, see ``flystick_mixer.compile_channels``. Nodes are tuples:
+
+        ('const', value)
+        ('input', key, reader)   stateless read, ``reader()``; deduped by key
+        ('event', key, fn)       opaque/stateful, ``fn(evts)``; deduped by key
+        ('neg', node), ('pos', node)
+        ('add', node, node), ('sub', node, node), ('mul', node, node)
+        ('curve', node, curve)   ``Curve`` of the node
     """
-    def __init__(self, fn):
+    def __init__(self, fn, node=None):
         self.fn = fn
+        self.node = node if node is not None else ('event', fn, fn)
 
     def __call__(self, evts):
-        # if self.fn(evts) > 1900:
-        #     return 1900
-        # print "debugggg" 
-        # print self.fn(evts) 
-        # if self.fn(evts) > 1900:
-        #     return 1900
         return self.fn(evts)
 
     def __neg__(self):
-        return Ch(lambda evts: -self.fn(evts))
+        return Ch(lambda evts: -self.fn(evts), ('neg', self.node))
 
     def __add__(self, x):
         if isinstance(x, float):
-            return Ch(lambda evts: self.fn(evts) + x)
+            return Ch(lambda evts: self.fn(evts) + x,
+                      ('add', self.node, ('const', x)))
         elif isinstance(x, Ch):
-            # print Ch(lambda evts: self.fn(evts) - x(evts))
-            # f = lambda x: if x==2 print x else raise Exception()
-            return Ch(lambda evts: self.fn(evts) + x(evts))
+            return Ch(lambda evts: self.fn(evts) + x(evts),
+                      ('add', self.node, x.node))
         else:
             raise ValueError("Invalid positive offset %r" % (x,))
 
     def __sub__(self, x):
         if isinstance(x, float):
-            return Ch(lambda evts: self.fn(evts) - x)
-            print "debug", x(evts)
+            return Ch(lambda evts: self.fn(evts) - x,
+                      ('sub', self.node, ('const', x)))
         elif isinstance(x, Ch):
-            # return Ch(lambda evts: self.fn(evts) - x(evts))
-            print "debug", x(evts)
+            return Ch(lambda evts: self.fn(evts) - x(evts),
+                      ('sub', self.node, x.node))
         else:
             raise ValueError("Invalid negative offset %r" % (x,))
 
     def __mul__(self, x):
         if isinstance(x, float):
-            return Ch(lambda evts: self.fn(evts) * x)
-            print "debug", x(evts)
+            return Ch(lambda evts: self.fn(evts) * x,
+                      ('mul', self.node, ('const', x)))
         elif isinstance(x, Ch):
-            return Ch(lambda evts: self.fn(evts) * x(evts))
-            print "debug", x(evts)
+            return Ch(lambda evts: self.fn(evts) * x(evts),
+                      ('mul', self.node, x.node))
         else:
             raise ValueError("Invalid weight %r" % (x,))
 
     def __pos__(self):
-        return Ch(lambda evts: .5 + self.fn(evts) / 2)
+        return Ch(lambda evts: .5 + self.fn(evts) / 2, ('pos', self.node))
+
+    def apply(self, curve):
+        """The channel through ``curve``, a ``Curve`` or a function of
+        [-1..1] to precompute as one."""
+        if not isinstance(curve, Curve):
+            curve = Curve(curve)
+        return Ch(lambda evts: curve(self.fn(evts)),
+                  ('curve', self.node, curve))
+
+    def expo(self, expo):
+        return self.apply(expo_curve(expo))
+
+    def rates(self, rate=1., super_rate=0., expo=0.):
+        if not 0 <= super_rate < 1:
+            raise ValueError("Invalid super rate %r" % (super_rate,))
+        return self.apply(rates_curve(rate, super_rate, expo))
+
+    def curve(self, points):
+        if len(points) < 2:
+            raise ValueError("A curve needs at least 2 points")
+        return self.apply(points_curve(points))
+
+
+# Input event for backends other than pygame, with the attributes of the
+# pygame events used.
+InputEvent = collections.namedtuple('InputEvent',
+                                    'joy button hat value time')
+
+
+class InputDevice(object):
+    """Base of the devices of backends other than pygame, in the
+    interface of ``pygame.joystick.Joystick``. Subclasses keep ``joy_id``,
+    ``name`` and the current ``axes``, ``buttons`` and ``hats`` (x, y)
+    lists."""
+    def init(self):
+        pass
+
+    def get_id(self):
+        return self.joy_id
+
+    def get_name(self):
+        return self.name
+
+    def get_axis(self, axis):
+        return self.axes[axis]
+
+    def get_button(self, button):
+        return self.buttons[button]
+
+    def get_hat(self, hat):
+        return self.hats[hat]
+
+
+class EventRouter(object):
+    """Delivers hat moves and button clicks straight to their subscribers
+    (e.g. ``Switch.move``), from a dispatch table keyed by (joystick id,
+    'hat'/'button', index) built as the config is loaded. Routing costs
+    one lookup per event, however many switches there are.
+
+    The input backends route every frame's events before returning them.
+    Between ``stage()`` and ``staged()`` subscriptions go to a new table
+    instead, for replacing ``table`` at once on config reload.
+    """
+    def __init__(self):
+        self.table = {}
+        self.routed = 0
+        self._staging = None
+
+    def stage(self):
+        self._staging = {}
+
+    def staged(self):
+        """Returns the table built since ``stage()``."""
+        table, self._staging = self._staging, None
+        return table
+
+    def subscribe(self, joy, kind, index, handler, axis=None):
+        """Calls ``handler(value)`` for every ``kind`` ('hat' or 'button')
+        event of ``index`` on joystick ``joy``, with the ``axis`` value of
+        hat moves."""
+        table = self.table if self._staging is None else self._staging
+        table.setdefault((joy, kind, index), []).append((axis, handler))
+
+    def route(self, evts):
+        """Dispatches the (clicks, hats) of a frame. Returns ``evts``."""
+        clicks, hats = evts
+        table = self.table
+        for evt in hats:
+            for axis, handler in table.get((evt.joy, 'hat', evt.hat), ()):
+                handler(evt.value[axis])
+                self.routed += 1
+        for evt in clicks:
+            for axis, handler in table.get((evt.joy, 'button', evt.button),
+                                           ()):
+                # presses only
+                handler(1)
+                self.routed += 1
+        return evts
+
+
+router = EventRouter()
+
+
+class EventSource(object):
+    """Base of the event sources of backends other than pygame.
+    ``collect()`` has the devices append their button presses and hat
+    moves to ``clicks``/``hats``, reused alternating between two frames.
+    """
+    def __init__(self):
+        self._evts, self._spare = ([], []), ([], [])
+        self.clicks, self.hats = self._evts
+
+    def collect(self):
+        raise NotImplementedError
+
+    def events(self):
+        """Returns the (clicks, hats) since the previous call, routed.
+        They are valid until the next call."""
+        self.collect()
+        evts = self._evts
+        self._evts, self._spare = self._spare, evts
+        self.clicks, self.hats = self._evts
+        del self.clicks[:]
+        del self.hats[:]
+        return router.route(evts)
 
 
 class Joystick(object):
     """A base class for setting up mapping of different axes and buttons
     of a joystick.
     """
+    # the latest instance by (class, joystick id)
+    instances = {}
+    # set while the config is reloaded: constructing a joystick again
+    # returns the existing instance, with its device already open
+    reuse = False
+
+    def __new__(cls, joy_id, *args, **kwargs):
+        joystick = Joystick.instances.get((cls, joy_id)) \
+            if Joystick.reuse else None
+        if joystick is None:
+            joystick = object.__new__(cls)
+            Joystick.instances[(cls, joy_id)] = joystick
+        return joystick
+
     def __init__(self, joy_id):
+        if hasattr(self, '_joy'):
+            # reused
+            return
+        # imported here so that other input backends don't need pygame
+        import pygame.joystick
         pygame.joystick.init()
         self._joy = pygame.joystick.Joystick(joy_id)
         self._joy.init()
 
-    def axis(self, axis):
-        return Ch(lambda evts: self._joy.get_axis(axis))
+    def axis(self, axis, filter=None):
+        """``filter`` (see flystick_filter) oversamples the axis between
+        frames and smooths it, e.g. ``joystick.axis(0, Median(.004))``."""
+        def read():
+            return self._joy.get_axis(axis)
+        key = (self, 'axis', axis)
+        if filter is not None:
+            read = filter.attach(read)
+            key += (filter,)
+        return Ch(lambda evts: read(), ('input', key, read))
 
     def button(self, button):
-        return Ch(lambda evts: 1. if self._joy.get_button(button) else -1.)
+        def read():
+            return 1. if self._joy.get_button(button) else -1.
+        return Ch(lambda evts: read(),
+                  ('input', (self, 'button', button), read))
 
     def hat_switch(self, hat, axis, **switch):
-        def hat_values(hats):
-            for evt in hats:
-                if evt.joy == self._joy.get_id() \
-                   and evt.hat == hat:
-                    yield evt.value[axis]
-        return Ch(Switch(evt_map=lambda (clicks, hats): hat_values(hats),
-                         **switch))
+        switch = Switch(None, **switch)
+        switch.key = (self._joy.get_id(), 'hat', hat, axis)
+        router.subscribe(self._joy.get_id(), 'hat', hat, switch.move,
+                         axis=axis)
+        return switch.channel()
+
+    def button_switch(self, button, **switch):
+        """A switch stepping to the next position on every click of
+        ``button``, back to the first after the last."""
+        switch = Switch(None, **switch)
+        switch.key = (self._joy.get_id(), 'button', button)
+        router.subscribe(self._joy.get_id(), 'button', button,
+                         lambda value: switch.cycle())
+        return switch.channel()
+
     def get_name(self):
         return self._joy.get_name()
 
+    @property
+    def connected(self):
+        """False while the device is unplugged (for backends that can
+        tell)."""
+        return getattr(self._joy, 'connected', True)
+
 
 class Switch(object):
     """Models a virtual multi-position switch. Excellent for example
     trims and flight mode control.
+
+    ``evt_map(evts)`` yields the moves in the events of a frame. Switches
+    subscribed to ``router`` have no ``evt_map`` and are moved by it.
     """
     def __init__(self, evt_map, positions, initial=0):
         self.evt_map = evt_map
         self.positions = positions
         self.pos = initial
+        # what it's subscribed to, to find it again in a reloaded config
+        self.key = None
 
-    def __call__(self, evts):
-        for value in self.evt_map(evts):
-            if value >= 1 or value <= -1:
-                pass
-            if value > 0:
-                self.pos += 1
-            elif value < 0:
-                self.pos -= 1
-                # if self.pos < 0:
-                #     self.pos += self.positions
-            # ignore zero
+    def move(self, value):
+        if value > 0:
+            self.pos += 1
+        elif value < 0:
+            self.pos -= 1
+            # if self.pos < 0:
+            #     self.pos += self.positions
+        # ignore zero
+
+    def cycle(self):
+        self.pos = (self.pos + 1) % self.positions
+
+    def value(self):
         return 2. * self.pos / (self.positions - 1) - 1
 
+    def channel(self):
+        """``Ch`` of the switch value, without ``evt_map``: a plain read
+        of the position (the router moves it)."""
+        return Ch(lambda evts: self.value(),
+                  ('input', (self, 'value'), self.value))
+
+    def __call__(self, evts):
+        if self.evt_map is not None:
+            for value in self.evt_map(evts):
+                self.move(value)
+        return self.value()
+
 
 def XDot(center):
     """A dot moving horizontally."""
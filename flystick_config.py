@@ -4,17 +4,41 @@ This "demo" configuration is for the most spartanly-named
 It was the cheapest joystick in my local electronics shop, and - as an added
 bonus - it had just the throttle lever I wanted.
 """
+import os
 from flystick_conf_models import *
 isLcd = True
-try:
-    from lcd import LCD
-    lcd = LCD()
-except:
-    print("could not init display")
+# Joystick input: 'pygame', 'evdev' to read /dev/input/event* directly
+# without SDL, or 'virtual' for generated input without any joysticks
+# (e.g. FLYSTICK_INPUT=virtual ./flystick.py on a dev box).
+INPUT_BACKEND = os.environ.get('FLYSTICK_INPUT', 'pygame')
+if INPUT_BACKEND == 'evdev':
+    from flystick_evdev import EvdevJoystick as Joystick
+elif INPUT_BACKEND == 'virtual':
+    from flystick_virtual import VirtualJoystick as Joystick
+# LCD is written in the background at most this many times a second.
+LCD_MAX_REFRESH_HZ = 10
+# Unix socket serving live stats (read with flystick_stats.py), or None.
+STATS_SOCKET = '/tmp/flystick-stats.sock'
+# Reload CHANNELS, FAILSAFE, PPM_DEADBAND_US and DISPLAY when this file
+# changes, checking every this many seconds (0 to disable). This file is
+# run again for that, reusing the open joysticks.
+CONFIG_RELOAD_INTERVAL = 1.
+# Flight data recorder: the inputs, outputs and timing of the last
+# RECORDER_FRAMES frames (10 min at 50 Hz) are kept in RECORDER_PATH, on
+# a tmpfs or writable partition, for flystick_recorder.py to export or
+# replay. None to disable.
+RECORDER_PATH = '/tmp/flystick-recorder.bin'
+RECORDER_FRAMES = 30000
 try:
     throttles = Joystick(0)
     joystick = Joystick(1)
 except:
+    # only now, so that reloading doesn't reset the LCD in use
+    try:
+        from lcd import LCD
+        lcd = LCD()
+    except:
+        print("could not init display")
     if (isLcd):
         lcd.lcd_string("UNPLUGGED", lcd.LCD_LINE_1)
         lcd.lcd_string("PLUG JS & REBOOT", lcd.LCD_LINE_2)
@@ -23,6 +47,13 @@ if throttles.get_name() != "Thrustmaster Throttle - HOTAS Warthog":
     throttles = Joystick(1)
     joystick = Joystick(0)
 
+# A stick at the ground station, sent over UDP with
+# "python flystick_network.py send <pi address>", usable in CHANNELS like
+# the others. Its channels output FAILSAFE while no packets arrive. The id
+# must differ from the local joysticks'.
+# from flystick_network import NetworkJoystick
+# ground = NetworkJoystick(10, port=5005)
+
 # aileron trim, hat side-to-side axis
 roll_trim = joystick.hat_switch(hat=0, axis=0, positions=41, initial=20)
 pitch_trim = joystick.hat_switch(hat=0, axis=1, positions=41, initial=20)
@@ -31,8 +62,44 @@ pitch_trim = joystick.hat_switch(hat=0, axis=1, positions=41, initial=20)
 # Pin map: http://wiki.mchobby.be/images/3/31/RASP-PIZERO-Correspondance-GPIO.jpg
 # (Connect this pin to the RC transmitter trainer port.)
 PPM_OUTPUT_PIN = 18
+# Output: 'ppm' on PPM_OUTPUT_PIN, or 'sbus'/'crsf' serial frames on
+# SERIAL_OUTPUT_PORT, sent every PPM_FRAME_US. (SBUS needs an inverter.)
+OUTPUT = 'ppm'
+SERIAL_OUTPUT_PORT = '/dev/serial0'
+# PPM frame (subcycle) length, and how long before each frame boundary
+# the loop wakes up to sample the sticks and build the next frame.
+# Shorter phase = less latency, but the frame must be ready in time.
+PPM_FRAME_US = 20000
+PPM_FRAME_PHASE_US = 4000
+# How many distinct PPM frames to keep uploaded to pigpiod for reuse.
+PPM_WAVE_CACHE_SIZE = 32
+# Talk to pigpiod with pipelined batches, two round-trips per new frame
+# and one per cached frame, instead of the pigpio module's round-trip per
+# command.
+PIGPIOD_PIPELINED = True
+# Run input/mixing and output in separate processes, so that input, GC or
+# LCD stalls don't delay frames (FLYSTICK_MULTIPROCESS=1). The input
+# process publishes the values MIX_PHASE_US before each frame boundary in
+# SHARED_OUTPUT, where the output and display processes read them.
+# Output stats are served on STATS_SOCKET + '-output'.
+MULTIPROCESS = bool(os.environ.get('FLYSTICK_MULTIPROCESS'))
+SHARED_OUTPUT = '/dev/shm/flystick-output'
+MIX_PHASE_US = 8000
 PWM_INITIAL_TRIM = 1500
 PWM_DIFF = 400
+# Compute the linear CHANNELS (weighted sums of axes, buttons and
+# switches plus offsets) as one numpy matrix product. Faster from about
+# 16-32 channels, see flystick_bench.py matrix. Ignored without numpy.
+MIX_MATRIX = False
+# Real-time mode (flystick.py --realtime, as root): the frame loop gets
+# this SCHED_FIFO priority and these CPUs (None: the last one), its memory
+# is locked and the garbage is collected between frames.
+REALTIME_PRIORITY = 50
+REALTIME_CPUS = None
+# How often axes with a filter are sampled between frames. The filters
+# for the commented-out example in CHANNELS:
+# from flystick_filter import MovingAverage, Median, OneEuro
+AXIS_SAMPLE_HZ = 500
 # Output (PPM) channels.
 JOYSTICK_ROLL_TRIM_CHANNEL = 8
 JOYSTICK_PITCH_TRIM_CHANNEL = 9
@@ -43,6 +110,12 @@ CHANNELS = (
     joystick.axis(1) + pitch_trim * 0.2, # pitch
     # a more elaborate example with reverse, offset, weight and trim:
     # (-joystick.axis(0) + 0.1) * 0.7 + ail_trim * 0.5,
+    # oversampled and smoothed against a jittery gimbal, lagging ~4 ms
+    # (see flystick_filter: MovingAverage, Median, OneEuro):
+    # joystick.axis(0, Median(0.004)) + roll_trim * 0.2,
+    # softer around the center, with expo or rates (see Ch):
+    # joystick.axis(0).expo(0.3) + roll_trim * 0.2,
+    # joystick.axis(0).rates(1., super_rate=0.5, expo=0.2) + roll_trim * 0.2,
     # channel 2: elevator (reversed)
     -throttles.axis(3), # throttle
     # -joystick.axis(1),
@@ -66,6 +139,14 @@ CHANNELS = (
     joystick.axis(0),
     joystick.axis(1)
 )
+# Per-channel deadband (us) against stick jitter, one-to-one with CHANNELS.
+# A channel's pulse changes only when it moves more than this.
+PPM_DEADBAND_US = (1, 1, 1, 0, 0, 0, 0, 0, 1, 1)
+# Channel values sent from power-up until the joysticks are ready, and once
+# the input process stopped publishing, one-to-one with CHANNELS: sticks
+# centered, throttle low, buttons released. Read before this file runs (see
+# flystick_boot), like the output settings above, so these must stay literals.
+FAILSAFE = (0., 0., -1., -1., -.9, -1., 0., 0., 0., 0.)
 
 # dual-channel display component
 stick_dot = XYDot(col=5)
@@ -89,3 +170,6 @@ DISPLAY = (
 
 # TODO what's the range? 128? http://www.issi.com/WW/pdf/31FL3730.pdf
 DISPLAY_BRIGHTNESS = 10
+# The Scroll pHAT is redrawn in the background at most this many times a
+# second, and only written to when pixels change.
+DISPLAY_MAX_REFRESH_HZ = 20
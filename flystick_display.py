@@ -0,0 +1,141 @@
+"""
+Scroll pHAT visualization of the channels (``DISPLAY`` in
+flystick_config).
+
+The ``DISPLAY`` components draw into an in-memory 11x5 ``Bitmap``, in the
+``scrollphat`` interface they were written against. Only the columns that
+differ from what the device already shows are pushed, from a background
+thread at a limited rate, so the I2C writes never delay a frame.
+"""
+import logging
+import threading
+import time
+
+WIDTH = 11
+HEIGHT = 5
+
+
+class Bitmap(object):
+    """11x5 pixels as one 5-bit int per column, bit 0 the top row, drawn
+    through the subset of the ``scrollphat`` module the components use.
+    Pixels outside the display are ignored."""
+    def __init__(self):
+        self.columns = [0] * WIDTH
+
+    def clear(self):
+        columns = self.columns
+        for x in range(WIDTH):
+            columns[x] = 0
+
+    def set_pixel(self, x, y, value):
+        if 0 <= x < WIDTH and 0 <= y < HEIGHT:
+            if value:
+                self.columns[x] |= 1 << y
+            else:
+                self.columns[x] &= ~(1 << y)
+
+    def set_col(self, x, value):
+        if 0 <= x < WIDTH:
+            self.columns[x] = value & ((1 << HEIGHT) - 1)
+
+
+def render(components, values, bitmap):
+    """Draws ``values`` with the one-to-one ``components`` on the cleared
+    ``bitmap``."""
+    bitmap.clear()
+    for component, value in zip(components, values):
+        component(value, bitmap)
+
+
+class FakeScrollPhat(object):
+    """Stand-in for the ``scrollphat`` module, keeping the shown columns
+    and counting the I2C writes the real one would do."""
+    def __init__(self):
+        self.buffer = [0] * WIDTH
+        self.shown = [0] * WIDTH
+        self.brightness = None
+        self.writes = 0
+
+    def set_brightness(self, brightness):
+        self.brightness = brightness
+        self.writes += 1
+
+    def set_col(self, x, value):
+        self.buffer[x] = value
+
+    def update(self):
+        self.shown = list(self.buffer)
+        self.writes += 1
+
+    def clear(self):
+        self.buffer = [0] * WIDTH
+        self.update()
+
+
+class ScrollPhatWriter(threading.Thread):
+    """Renders the latest posted channel values with ``components`` and
+    pushes the changed columns to ``scrollphat`` in the background, at
+    most ``max_rate`` times a second. Like ``lcd.LCDWriter``, values
+    posted in between replace each other. They're copied, so the caller
+    can reuse its values (``compile_channels(out=True)``).
+    """
+    def __init__(self, scrollphat, components, max_rate=20.,
+                 histogram=None):
+        threading.Thread.__init__(self, name="scrollphat-writer")
+        self.daemon = True
+        self.scrollphat = scrollphat
+        self.components = components
+        self.interval = 1. / max_rate
+        self.histogram = histogram
+        self.bitmap = Bitmap()
+        self.renders = self.refreshes = 0
+        # unknown, so that the first render is pushed whole
+        self._shown = [None] * WIDTH
+        # posted, and being drawn: swapped, not reallocated
+        self._values, self._drawn = [], []
+        self._posted = False
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def post(self, values):
+        with self._cond:
+            self._values[:] = values
+            self._posted = True
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._posted and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._values, self._drawn = self._drawn, self._values
+                values, self._posted = self._drawn, False
+            start = time.time()
+            try:
+                self.draw(values)
+            except IOError as e:
+                logging.warn("Scroll pHAT write failed: %s", e)
+            if self.histogram is not None:
+                self.histogram.add(time.time() - start)
+            time.sleep(self.interval)
+
+    def draw(self, values):
+        """Renders ``values`` and pushes the changed columns, if any."""
+        render(self.components, values, self.bitmap)
+        self.renders += 1
+        columns, shown = self.bitmap.columns, self._shown
+        changed = [x for x in range(WIDTH) if columns[x] != shown[x]]
+        if not changed:
+            return
+        for x in changed:
+            self.scrollphat.set_col(x, columns[x])
+        self.scrollphat.update()
+        self._shown = list(columns)
+        self.refreshes += 1
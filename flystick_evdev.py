@@ -0,0 +1,414 @@
+"""
+Joystick input straight from the kernel evdev interface
+(``/dev/input/event*``), without pygame/SDL.
+
+Devices are read non-blocking and in bulk, and all of them are waited on
+with one ``select.epoll``, so the main loop can sleep until input arrives
+(see ``EvdevPoller.wait``). Axis, button and hat numbering follows SDL, so
+``EvdevJoystick`` is a drop-in replacement for ``Joystick`` in
+``flystick_config``.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import glob
+import logging
+import os
+import select
+import struct
+import time
+
+from flystick_conf_models import (EventSource, InputDevice, InputEvent,
+                                   Joystick)
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_DROPPED = 0x03
+
+BTN_MISC = 0x100
+BTN_JOYSTICK = 0x120
+KEY_MAX = 0x2ff
+ABS_HAT0X = 0x10
+ABS_HAT3Y = 0x17
+ABS_MISC = 0x28
+ABS_MAX = 0x3f
+
+# sys/inotify.h
+IN_ATTRIB = 0x004
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# struct inotify_event: wd, mask, cookie, len, then the name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# struct input_event: timeval (two longs), type, code, value
+INPUT_EVENT = struct.Struct('llHHi')
+# struct input_absinfo: value, minimum, maximum, fuzz, flat, resolution
+INPUT_ABSINFO = struct.Struct('6i')
+
+
+def _ioc_read(nr, size):
+    return (2 << 30) | (size << 16) | (ord('E') << 8) | nr
+
+
+def EVIOCGNAME(length):
+    return _ioc_read(0x06, length)
+
+
+def EVIOCGKEY(length):
+    return _ioc_read(0x18, length)
+
+
+def EVIOCGBIT(ev, length):
+    return _ioc_read(0x20 + ev, length)
+
+
+def EVIOCGABS(abs_code):
+    return _ioc_read(0x40 + abs_code, INPUT_ABSINFO.size)
+
+
+def _bits(data):
+    return set(i for i in range(len(data) * 8)
+               if ord(data[i // 8:i // 8 + 1]) & (1 << (i % 8)))
+
+
+class EvdevDevice(InputDevice):
+    """One evdev device, in the interface of ``pygame.joystick.Joystick``.
+
+    ``axes`` and ``buttons`` are the evdev codes in SDL index order,
+    ``ranges`` maps axis codes to their (min, max).
+    """
+    def __init__(self, fd, joy_id, name, axes, buttons, ranges, path=None):
+        self.fd = fd
+        self.joy_id = joy_id
+        self.name = name
+        self.path = path
+        self.connected = True
+        self.axis_index = dict((code, i) for i, code in enumerate(axes))
+        self.button_index = dict((code, i) for i, code in enumerate(buttons))
+        self.scale = [(ranges[code][0], ranges[code][1] - ranges[code][0]
+                       or 1) for code in axes]
+        self.axes = [0.] * len(axes)
+        self.buttons = [False] * len(buttons)
+        # ABS_HAT0X to ABS_HAT3Y
+        self.hats = [(0, 0)] * 4
+        self.last_event_time = None
+        self._partial = b''
+
+    @classmethod
+    def open(cls, path, joy_id):
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            name = fcntl.ioctl(fd, EVIOCGNAME(256), b'\0' * 256)
+            name = name.split(b'\0', 1)[0].decode('utf-8', 'replace')
+            keys = _bits(fcntl.ioctl(fd, EVIOCGBIT(EV_KEY, KEY_MAX // 8 + 1),
+                                     b'\0' * (KEY_MAX // 8 + 1)))
+            abses = _bits(fcntl.ioctl(fd, EVIOCGBIT(EV_ABS, ABS_MAX // 8 + 1),
+                                      b'\0' * (ABS_MAX // 8 + 1)))
+            buttons = ([code for code in sorted(keys) if code >= BTN_JOYSTICK]
+                       + [code for code in sorted(keys)
+                          if BTN_MISC <= code < BTN_JOYSTICK])
+            axes = [code for code in sorted(abses) if code < ABS_MISC
+                    and not ABS_HAT0X <= code <= ABS_HAT3Y]
+            ranges = {}
+            for code in axes:
+                info = INPUT_ABSINFO.unpack(fcntl.ioctl(
+                    fd, EVIOCGABS(code), b'\0' * INPUT_ABSINFO.size))
+                ranges[code] = info[1:3]
+            device = cls(fd, joy_id, name, axes, buttons, ranges, path)
+            device.sync()
+            return device
+        except:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def is_joystick(path):
+        """Whether ``path`` has buttons and axes, like udev's joystick
+        classification."""
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return False
+        try:
+            evs = _bits(fcntl.ioctl(fd, EVIOCGBIT(0, 4), b'\0' * 4))
+            return EV_KEY in evs and EV_ABS in evs
+        except IOError:
+            return False
+        finally:
+            os.close(fd)
+
+    def sync(self):
+        """Reads the current axis and button state from the kernel, e.g.
+        after the event queue overflowed."""
+        for code, i in self.axis_index.items():
+            self._set_axis(i, INPUT_ABSINFO.unpack(fcntl.ioctl(
+                self.fd, EVIOCGABS(code), b'\0' * INPUT_ABSINFO.size))[0])
+        keys = _bits(fcntl.ioctl(self.fd, EVIOCGKEY(KEY_MAX // 8 + 1),
+                                 b'\0' * (KEY_MAX // 8 + 1)))
+        for code, i in self.button_index.items():
+            self.buttons[i] = code in keys
+
+    def _set_axis(self, i, value):
+        low, span = self.scale[i]
+        self.axes[i] = 2. * (value - low) / span - 1.
+
+    def read(self, sink):
+        """Decodes all pending events, updating the state and appending
+        button presses and hat moves to ``sink.clicks``/``sink.hats``.
+        Returns False once the device (or pipe) is gone."""
+        chunks = [self._partial]
+        alive = True
+        while True:
+            try:
+                data = os.read(self.fd, INPUT_EVENT.size * 64)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno != errno.ENODEV:
+                    raise
+                # unplugged
+                data = b''
+            if not data:
+                alive = self.connected = False
+                break
+            chunks.append(data)
+        data = b''.join(chunks)
+        end = len(data) - len(data) % INPUT_EVENT.size
+        self._partial = data[end:]
+        unpack_from = INPUT_EVENT.unpack_from
+        for offset in range(0, end, INPUT_EVENT.size):
+            sec, usec, type_, code, value = unpack_from(data, offset)
+            if type_ == EV_ABS:
+                i = self.axis_index.get(code)
+                if i is not None:
+                    self._set_axis(i, value)
+                elif ABS_HAT0X <= code <= ABS_HAT3Y:
+                    hat, axis = divmod(code - ABS_HAT0X, 2)
+                    x, y = self.hats[hat]
+                    if axis:
+                        # SDL has up positive
+                        y = -value
+                    else:
+                        x = value
+                    self.hats[hat] = (x, y)
+                    if x or y:
+                        sink.hats.append(InputEvent(
+                            self.joy_id, None, hat, (x, y), sec + usec / 1e6))
+            elif type_ == EV_KEY:
+                i = self.button_index.get(code)
+                if i is not None:
+                    self.buttons[i] = bool(value)
+                    if value == 1:
+                        sink.clicks.append(InputEvent(
+                            self.joy_id, i, None, 1, sec + usec / 1e6))
+            elif type_ == EV_SYN and code == SYN_DROPPED:
+                try:
+                    self.sync()
+                except IOError:
+                    pass
+            self.last_event_time = sec + usec / 1e6
+        return alive
+
+    def close(self):
+        os.close(self.fd)
+
+
+class EvdevPoller(EventSource):
+    """Waits for input on all registered devices with one epoll."""
+    def __init__(self):
+        EventSource.__init__(self)
+        self.epoll = select.epoll()
+        self.devices = {}
+
+    def register(self, device):
+        self.devices[device.fd] = device
+        self.epoll.register(device.fd, select.EPOLLIN)
+
+    def unregister(self, device):
+        if self.devices.pop(device.fd, None) is not None:
+            self.epoll.unregister(device.fd)
+
+    def wait(self, timeout):
+        """Reads input as it arrives for ``timeout`` seconds. Usable as
+        ``FrameScheduler`` sleep."""
+        deadline = _clock() + timeout
+        while True:
+            self._poll(timeout)
+            timeout = deadline - _clock()
+            if timeout <= 0:
+                return
+
+    def _poll(self, timeout):
+        for fd, _ in self.epoll.poll(max(timeout, 0)):
+            # None if the hot-plug monitor closed it earlier in this poll
+            device = self.devices.get(fd)
+            if device is not None and not device.read(self):
+                self.unregister(device)
+
+    def collect(self):
+        self._poll(0)
+
+
+poller = EvdevPoller()
+
+
+class HotplugMonitor(object):
+    """Watches ``directory`` with inotify for joysticks being unplugged
+    and plugged back in. A returning device is bound to the ``watch()``ed
+    joystick it was lost from, matched by name, keeping the joystick id.
+
+    Registered with ``poller``, so the main loop notices within its wait.
+    ``reattached`` holds (name, seconds gone, seconds from the device
+    node appearing to binding it) of every reattachment.
+    """
+    def __init__(self, directory='/dev/input', clock=_clock):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, directory.encode(),
+                                  IN_CREATE | IN_ATTRIB | IN_DELETE) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(),
+                          "Failed to watch %s" % (directory,))
+        self.directory = directory
+        self.clock = clock
+        self.joysticks = []
+        # joystick -> when it was lost
+        self.lost = {}
+        # path -> when its node appeared
+        self.appeared = {}
+        self.reattached = []
+
+    def watch(self, joystick):
+        if joystick not in self.joysticks:
+            self.joysticks.append(joystick)
+
+    def open(self, path, joy_id):
+        return EvdevDevice.open(path, joy_id)
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, sink):
+        """Handles the pending inotify events, in the interface of
+        ``EvdevDevice.read``."""
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(
+                    data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].split(b'\0', 1)[0]
+                offset += length
+                if not name.startswith(b'event'):
+                    continue
+                path = os.path.join(self.directory, name.decode())
+                if mask & IN_DELETE:
+                    self.removed(path)
+                else:
+                    self.added(path)
+
+    def removed(self, path):
+        self.appeared.pop(path, None)
+        now = self.clock()
+        for joystick in self.joysticks:
+            device = joystick._joy
+            if device.path == path and joystick not in self.lost:
+                device.connected = False
+                poller.unregister(device)
+                device.close()
+                self.lost[joystick] = now
+                logging.warn("Joystick %d (%s) unplugged, holding the "
+                             "failsafe values", device.joy_id, device.name)
+
+    def added(self, path):
+        if not self.lost or any(joystick._joy.path == path
+                                and joystick not in self.lost
+                                for joystick in self.joysticks):
+            return
+        now = self.clock()
+        self.appeared.setdefault(path, now)
+        try:
+            device = self.open(path, -1)
+        except (IOError, OSError):
+            # not accessible yet, udev sets it up (IN_ATTRIB follows)
+            return
+        for joystick in sorted(self.lost, key=lambda joy: joy._joy.joy_id):
+            if joystick._joy.name == device.name:
+                device.joy_id = joystick._joy.joy_id
+                joystick._joy = device
+                poller.register(device)
+                bound = self.clock()
+                self.reattached.append((device.name,
+                                        bound - self.lost.pop(joystick),
+                                        bound - self.appeared.pop(path)))
+                logging.warn("Joystick %d (%s) reattached after %.1f s, "
+                             "in %.0f ms", device.joy_id, device.name,
+                             self.reattached[-1][1],
+                             self.reattached[-1][2] * 1e3)
+                return
+        device.close()
+
+
+_monitor = None
+
+
+def hotplug_monitor():
+    """The ``HotplugMonitor`` of /dev/input, or None if inotify isn't
+    available."""
+    global _monitor
+    if _monitor is None:
+        try:
+            _monitor = HotplugMonitor()
+        except OSError as e:
+            logging.warn("No joystick hot-plug: %s", e)
+            _monitor = False
+        else:
+            poller.register(_monitor)
+    return _monitor or None
+
+
+def joystick_paths():
+    """Event devices that look like joysticks, in a stable order."""
+    paths = sorted(glob.glob('/dev/input/event*'),
+                   key=lambda path: int(path[len('/dev/input/event'):]))
+    return [path for path in paths if EvdevDevice.is_joystick(path)]
+
+
+class EvdevJoystick(Joystick):
+    """``Joystick`` backed by evdev. ``joy_id`` is the index among
+    ``joystick_paths()``, like the pygame index. Constructing one again
+    with the same ``joy_id`` returns the same joystick: a second fd on
+    the device would get, and route, every event twice."""
+    def __new__(cls, joy_id, device=None):
+        joystick = Joystick.instances.get((cls, joy_id))
+        if joystick is None or device is not None:
+            joystick = object.__new__(cls)
+            Joystick.instances[(cls, joy_id)] = joystick
+        return joystick
+
+    def __init__(self, joy_id, device=None):
+        if hasattr(self, '_joy'):
+            # reused
+            return
+        if device is None:
+            device = EvdevDevice.open(joystick_paths()[joy_id], joy_id)
+        self._joy = device
+        poller.register(device)
+        monitor = hotplug_monitor()
+        if monitor:
+            monitor.watch(self)
@@ -0,0 +1,220 @@
+"""
+Oversampled, filtered joystick axes, against the jitter of noisy gimbals.
+
+An axis read through a filter, e.g. ``joystick.axis(0, Median(.004))``,
+is sampled ``AXIS_SAMPLE_HZ`` times a second while the main loop sleeps
+until the next frame (``Oversampler.wrap`` wraps the input backend's
+sleep, which keeps reading evdev events or pumping pygame meanwhile).
+The samples go to a small ring buffer per axis, and every frame reads one
+filtered value of them.
+
+A filter's ``latency`` is its budget: about how far its value lags behind
+the stick, instead of a whole frame of averaging. The lag actually added
+is measured every frame as the frame time minus the (weighted) time of
+the samples making up the value.
+"""
+import array
+import math
+import time
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# samples kept per axis
+CAPACITY = 64
+
+
+class Filter(object):
+    """Base of the axis filters: the latest samples in a ring buffer, and
+    the added latency of the values read (``last_added``, ``max_added``,
+    ``mean_added()``, in seconds)."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.times = array.array('d', [0.]) * CAPACITY
+        self.values = array.array('d', [0.]) * CAPACITY
+        # samples ever, and since the previous frame
+        self.count = self.fresh = 0
+        self.read = None
+        self.clock = _clock
+        self.frames = 0
+        self.last_added = self.max_added = self._added = 0.
+
+    def attach(self, read, sampler=None):
+        """Filters the samples of ``read()`` taken by ``sampler``
+        (``oversampler``). Returns the reader of the filtered value, for
+        the mixer. A filter is for one axis only."""
+        if self.read is not None:
+            raise ValueError("The filter is already used on another axis")
+        sampler = sampler or oversampler
+        self.read = read
+        self.clock = sampler.clock
+        sampler.add(self)
+        return self.value
+
+    def add(self, now, value):
+        i = self.count % CAPACITY
+        self.times[i] = now
+        self.values[i] = value
+        self.count += 1
+        self.fresh += 1
+
+    def value(self):
+        """The filtered value for the current frame."""
+        now = self.clock()
+        if not self.fresh:
+            # not sampled since the previous frame, e.g. late
+            self.add(now, self.read())
+        self.fresh = 0
+        value, at = self.filtered(now)
+        added = self.last_added = max(now - at, 0.)
+        self._added += added
+        self.frames += 1
+        if added > self.max_added:
+            self.max_added = added
+        return value
+
+    def mean_added(self):
+        return self._added / self.frames if self.frames else 0.
+
+    def window(self, now, span):
+        """The number of samples, newest first, taken within ``span``
+        seconds of ``now``, at least one."""
+        times, newest, since = self.times, self.count - 1, now - span
+        limit = min(self.count, CAPACITY)
+        n = 1
+        while n < limit and times[(newest - n) % CAPACITY] >= since:
+            n += 1
+        return n
+
+    def filtered(self, now):
+        """Returns the (value, time of the value)."""
+        raise NotImplementedError
+
+
+class MovingAverage(Filter):
+    """Mean of the samples of the last 2 * ``latency`` seconds."""
+    def filtered(self, now):
+        n = self.window(now, 2 * self.latency)
+        times, values, newest = self.times, self.values, self.count - 1
+        value = at = 0.
+        for k in range(n):
+            i = (newest - k) % CAPACITY
+            value += values[i]
+            at += times[i]
+        return value / n, at / n
+
+
+class Median(Filter):
+    """Median of the samples of the last 2 * ``latency`` seconds, which
+    drops single-sample spikes entirely."""
+    def __init__(self, latency):
+        Filter.__init__(self, latency)
+        # ring indices of the window by value, sorted in place every frame
+        self.order = array.array('i', [0]) * CAPACITY
+
+    def filtered(self, now):
+        n = self.window(now, 2 * self.latency)
+        values, order, newest = self.values, self.order, self.count - 1
+        for k in range(n):
+            i = (newest - k) % CAPACITY
+            value = values[i]
+            j = k
+            while j and values[order[j - 1]] > value:
+                order[j] = order[j - 1]
+                j -= 1
+            order[j] = i
+        i = order[n // 2]
+        return values[i], self.times[i]
+
+
+class OneEuro(Filter):
+    """The 1-euro filter (Casiez et al. 2012): a low-pass with a cutoff
+    rising with the stick speed, so it smooths at rest and lags little on
+    moves. At rest it lags about ``latency``; ``beta`` is how fast the
+    cutoff rises (Hz per unit/s), ``d_cutoff`` the speed's cutoff (Hz)."""
+    def __init__(self, latency, beta=.5, d_cutoff=1.):
+        Filter.__init__(self, latency)
+        self.min_cutoff = 1 / (2 * math.pi * latency)
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.x = self.dx = self.t = self.prev = None
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1 / (2 * math.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+    def add(self, now, value):
+        Filter.add(self, now, value)
+        if self.x is None or now <= self.prev:
+            if self.x is None:
+                self.x, self.dx, self.t = value, 0., now
+            self.prev = now
+            return
+        dt = now - self.prev
+        self.prev = now
+        a = self._alpha(self.d_cutoff, dt)
+        self.dx += a * ((value - self.x) / dt - self.dx)
+        a = self._alpha(self.min_cutoff + self.beta * abs(self.dx), dt)
+        self.x += a * (value - self.x)
+        # the sample times through the same low-pass: the value's time
+        self.t += a * (now - self.t)
+
+    def filtered(self, now):
+        return self.x, self.t
+
+
+class Oversampler(object):
+    """Samples the attached filters every ``1 / rate`` seconds while the
+    main loop sleeps. Like ``EventRouter``, filters attached between
+    ``stage()`` and ``staged()`` go to a new list instead, for replacing
+    ``filters`` at once on config reload."""
+    def __init__(self, rate=500., clock=_clock):
+        self.interval = 1. / rate
+        self.clock = clock
+        self.filters = []
+        self.samples = 0
+        self._staging = None
+
+    def add(self, filter):
+        (self.filters if self._staging is None else self._staging).append(
+            filter)
+
+    def stage(self):
+        self._staging = []
+
+    def staged(self):
+        filters, self._staging = self._staging, None
+        return filters
+
+    def sample(self):
+        now = self.clock()
+        for filter in self.filters:
+            filter.add(now, filter.read())
+        self.samples += 1
+
+    def wrap(self, sleep):
+        """``sleep(timeout)`` sampling the filters in between."""
+        clock = self.clock
+
+        def oversampling_sleep(timeout):
+            deadline = clock() + timeout
+            while True:
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    return
+                if not self.filters:
+                    sleep(remaining)
+                    return
+                sleep(min(remaining, self.interval))
+                self.sample()
+        return oversampling_sleep
+
+    def added_latency(self):
+        """The worst (mean, max) added latency of the filters, seconds."""
+        if not self.filters:
+            return 0., 0.
+        return (max(f.mean_added() for f in self.filters),
+                max(f.max_added for f in self.filters))
+
+
+oversampler = Oversampler()
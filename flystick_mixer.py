@@ -0,0 +1,344 @@
+"""
+Compiles the ``CHANNELS`` mixes into one flat function.
+
+Every ``Ch`` is a chain of nested closures, so evaluating ``CHANNELS``
+naively costs dozens of python calls per frame and reads the same joystick
+axis once for every channel that uses it. ``compile_channels`` walks the
+expression nodes recorded by ``Ch`` once at startup, folds constants,
+reads every distinct input exactly once and generates a single function
+returning the whole (clamped) output tuple, or with ``out`` filling the
+same array every frame.
+
+With ``matrix``, the channels that are linear in the inputs (sums of
+weighted axes, buttons and switches plus offsets) are instead computed
+together as one numpy matrix-vector product over the inputs of the frame.
+That pays off with many channels, see ``python flystick_bench.py matrix``.
+"""
+import array
+import logging
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+_BINARY = {'add': '+', 'sub': '-', 'mul': '*'}
+
+
+def fold(node):
+    """Folds constant sub-expressions of ``node``."""
+    op = node[0]
+    if op in ('const', 'input', 'event'):
+        return node
+    if op in ('neg', 'pos'):
+        arg = fold(node[1])
+        if arg[0] == 'const':
+            value = arg[1]
+            return ('const', -value if op == 'neg' else .5 + value / 2)
+        return (op, arg)
+    if op == 'curve':
+        arg, curve = fold(node[1]), node[2]
+        if arg[0] == 'const':
+            return ('const', curve(arg[1]))
+        if arg[0] == 'curve':
+            # one lookup for stacked curves
+            return ('curve', arg[1], arg[2].then(curve))
+        return (op, arg, curve)
+    if op in _BINARY:
+        a, b = fold(node[1]), fold(node[2])
+        if a[0] == 'const' and b[0] == 'const':
+            if op == 'add':
+                return ('const', a[1] + b[1])
+            elif op == 'sub':
+                return ('const', a[1] - b[1])
+            return ('const', a[1] * b[1])
+        # identities, never dropping the other operand (may be stateful)
+        if b[0] == 'const' and (op in ('add', 'sub') and b[1] == 0
+                                or op == 'mul' and b[1] == 1):
+            return a
+        if a[0] == 'const' and (op == 'add' and a[1] == 0
+                                or op == 'mul' and a[1] == 1):
+            return b
+        return (op, a, b)
+    raise ValueError("Unknown mix node %r" % (op,))
+
+
+def linear(node):
+    """Returns the (weights by input key, offset) of a folded ``node``
+    that is linear in its inputs, or None."""
+    op = node[0]
+    if op == 'const':
+        return {}, node[1]
+    elif op == 'input':
+        return {node[1]: 1.}, 0.
+    elif op in ('event', 'curve'):
+        return None
+    elif op in ('neg', 'pos'):
+        arg = linear(node[1])
+        if arg is None:
+            return None
+        scale, shift = (-1., 0.) if op == 'neg' else (.5, .5)
+        weights, offset = arg
+        return (dict((key, w * scale) for key, w in weights.items()),
+                offset * scale + shift)
+    a, b = linear(node[1]), linear(node[2])
+    if a is None or b is None:
+        return None
+    if op == 'mul':
+        if a[0] and b[0]:
+            # product of two inputs
+            return None
+        (weights, offset), factor = (a, b[1]) if a[0] else (b, a[1])
+        return (dict((key, w * factor) for key, w in weights.items()),
+                offset * factor)
+    sign = 1. if op == 'add' else -1.
+    weights = dict(a[0])
+    for key, w in b[0].items():
+        weights[key] = weights.get(key, 0.) + sign * w
+    return weights, a[1] + sign * b[1]
+
+
+def _args(node):
+    """The sub-nodes of ``node``."""
+    op = node[0]
+    if op in ('const', 'input', 'event'):
+        return ()
+    elif op == 'curve':
+        return node[1:2]
+    return node[1:]
+
+
+def _input_leaves(node):
+    if node[0] == 'input':
+        yield node
+    else:
+        for arg in _args(node):
+            for leaf in _input_leaves(arg):
+                yield leaf
+
+
+class _Generator(object):
+
+    def __init__(self, inputs=None):
+        self.names = {}
+        self.namespace = {}
+        self.reads = []
+        self.inputs = inputs
+        self.input_keys = []
+        self.tables = 0
+
+    def leaf(self, node):
+        op, key, fn = node
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = '%s%d' % (op[0], len(self.names))
+            self.namespace['_' + name] = fn
+            if op == 'input':
+                self.reads.append(self.read(name, key))
+            else:
+                self.reads.append('    %s = _%s(evts)' % (name, name))
+        return name
+
+    def read(self, name, key):
+        index = len(self.input_keys)
+        self.input_keys.append(key)
+        if self.inputs == 'keep':
+            return '    %s = _inputs[%d] = _%s()' % (name, index, name)
+        elif self.inputs == 'replay':
+            return '    %s = _inputs[%d]' % (name, index)
+        return '    %s = _%s()' % (name, name)
+
+    def expr(self, node):
+        op = node[0]
+        if op == 'const':
+            return repr(float(node[1]))
+        elif op in ('input', 'event'):
+            return self.leaf(node)
+        elif op == 'neg':
+            return '(-%s)' % (self.expr(node[1]),)
+        elif op == 'pos':
+            return '(.5 + %s / 2)' % (self.expr(node[1]),)
+        elif op == 'curve':
+            # Curve.__call__, inlined
+            curve = node[2]
+            name = '_t%d' % (self.tables,)
+            self.tables += 1
+            self.namespace[name] = curve.table
+            return '%s[int((max(min(%s, 1.), -1.) + 1.) * %r + .5)]' % (
+                name, self.expr(node[1]), curve.scale)
+        return '(%s %s %s)' % (self.expr(node[1]), _BINARY[op],
+                               self.expr(node[2]))
+
+
+def _matrix(gen, nodes, clamp, out=None):
+    """Expressions of the folded ``nodes``, the linear ones taken from the
+    matrix product, and the lines computing it. None if there's nothing to
+    gain. With an ``out`` array, the product goes there instead and the
+    linear ones are None."""
+    linears = [linear(node) for node in nodes]
+    rows = [i for i, lin in enumerate(linears) if lin is not None]
+    if len(rows) < 2:
+        return None
+    for i in rows:
+        for leaf in _input_leaves(nodes[i]):
+            gen.leaf(leaf)
+    exprs = []
+    for i, node in enumerate(nodes):
+        if linears[i] is None:
+            e = gen.expr(node)
+            exprs.append('max(min(%s, 1.), -1.)' % (e,) if clamp else e)
+        elif out is not None:
+            exprs.append(None)
+        else:
+            exprs.append('_l[%d]' % (rows.index(i),))
+    keys = gen.input_keys
+    # the offsets are the weights of a last input that is always 1
+    weights = numpy.zeros((len(rows), len(keys) + 1))
+    for row, i in enumerate(rows):
+        for key, w in linears[i][0].items():
+            weights[row, keys.index(key)] = w
+        weights[row, -1] = linears[i][1]
+    ns = gen.namespace
+    ns['_x'] = x = numpy.zeros(len(keys) + 1)
+    x[-1] = 1.
+    ns['_dot'] = weights.dot
+    lines = ['    _x[%d] = %s' % (col, gen.names[key])
+             for col, key in enumerate(keys)]
+    lines.append('    _dot(_x, _y)')
+    if clamp:
+        lines.append('    _y.clip(-1., 1., _y)')
+    if out is None:
+        ns['_y'] = y = numpy.zeros(len(rows))
+        ns['_tolist'] = y.tolist
+        lines.append('    _l = _tolist()')
+    elif rows == list(range(len(nodes))):
+        # the product right into the array
+        ns['_y'] = numpy.frombuffer(out)
+    else:
+        ns['_y'] = numpy.zeros(len(rows))
+        ns['_out_view'] = numpy.frombuffer(out)
+        ns['_rows'] = numpy.array(rows)
+        lines.append('    _out_view[_rows] = _y')
+    return exprs, lines
+
+
+def compile_channels(channels, clamp=True, inputs=None, matrix=False,
+                     out=False):
+    """Returns ``mix(evts)`` computing the output tuple of ``channels``.
+
+    With ``clamp`` each value is limited to [-1..1], as the main loop
+    does. The generated source is available as ``mix.source``.
+
+    ``mix.input_keys`` are the keys of the distinct inputs read, in
+    order. With ``inputs='keep'`` the values read in the last frame are
+    kept in the same order in ``mix.inputs``, e.g. for recording; with
+    ``'replay'`` they are taken from there instead of read.
+
+    ``matrix`` computes the linear channels with numpy, when available.
+
+    With ``out``, every frame's values are written to the same
+    ``array('d')``, ``mix.out``, which is returned instead of a new tuple.
+    """
+    if inputs not in (None, 'keep', 'replay'):
+        raise ValueError("Unknown inputs mode %r" % (inputs,))
+    gen = _Generator(inputs)
+    nodes = [fold(ch.node) for ch in channels]
+    output = array.array('d', [0.]) * len(nodes) if out else None
+    product = None
+    if matrix and numpy is None:
+        logging.warn("No numpy, mixing without the matrix")
+    elif matrix:
+        product = _matrix(gen, nodes, clamp, output)
+    if product:
+        exprs, lines = product
+    else:
+        exprs = [gen.expr(node) for node in nodes]
+        if clamp:
+            exprs = ['max(min(%s, 1.), -1.)' % (e,) for e in exprs]
+        lines = []
+    if out:
+        lines += ['    _out[%d] = %s' % (i, e)
+                  for i, e in enumerate(exprs) if e is not None]
+        result = '_out'
+    elif product and exprs == ['_l[%d]' % (i,) for i in range(len(exprs))]:
+        # all linear
+        result = 'tuple(_l)'
+    else:
+        result = '(%s%s)' % (', '.join(exprs), ',' if len(exprs) == 1 else '')
+    source = '\n'.join(
+        ['def mix(evts):'] + gen.reads + lines +
+        ['    return ' + result]) + '\n'
+    namespace = dict(gen.namespace)
+    namespace['_inputs'] = values = [0.] * len(gen.input_keys)
+    namespace['_out'] = output
+    exec(compile(source, '<flystick mixer>', 'exec'), namespace)
+    mix = namespace['mix']
+    mix.source = source
+    mix.input_keys = gen.input_keys
+    mix.inputs = values
+    mix.out = output
+    return mix
+
+
+def sources(node):
+    """The objects whose state the 'input' leaves of ``node`` read, e.g.
+    the ``Joystick`` of an axis."""
+    if node[0] == 'input':
+        return set([node[1][0]])
+    return set().union(*[sources(arg) for arg in _args(node)])
+
+
+def failsafe_mix(mix, channels, failsafe):
+    """Wraps ``mix`` of ``channels`` to output the ``failsafe`` value of
+    every channel reading a joystick that isn't ``connected``. Values in
+    an array (``out``) are replaced in place."""
+    affected = {}
+    for i, ch in enumerate(channels):
+        for source in sources(ch.node):
+            if hasattr(source, 'connected'):
+                affected.setdefault(source, []).append(i)
+    if not affected:
+        return mix
+    joysticks = tuple(affected.items())
+
+    def guarded(evts):
+        values = mix(evts)
+        for joystick, _ in joysticks:
+            if not joystick.connected:
+                break
+        else:
+            return values
+        frozen = isinstance(values, tuple)
+        if frozen:
+            values = list(values)
+        for joystick, channels in joysticks:
+            if not joystick.connected:
+                for i in channels:
+                    values[i] = failsafe[i]
+        return tuple(values) if frozen else values
+
+    # source, inputs etc. of the wrapped mixer
+    guarded.__dict__.update(mix.__dict__)
+    return guarded
+
+
+def benchmark(channels, evts=([], []), frames=5000):
+    """Measures the per-frame cost of the closure chain against the
+    compiled mixer. Returns seconds per frame for both.
+    """
+    mix = compile_channels(channels)
+
+    def closures(evts):
+        return tuple(max(min(ch(evts), 1.), -1.) for ch in channels)
+
+    result = {}
+    for name, fn in (('closures', closures), ('compiled', mix)):
+        fn(evts)
+        start = _clock()
+        for _ in range(frames):
+            fn(evts)
+        result[name] = (_clock() - start) / frames
+    return result
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+"""
+Joystick input over the network, for flying from a PC or a simulator rig
+at the ground station instead of a USB stick plugged into the Pi.
+
+The ground station sends its stick (axes, buttons and hats) in one small
+UDP packet per update, numbered and timestamped, see ``Sender``.
+``NetworkJoystick`` is a ``Joystick`` of those, used in ``CHANNELS`` like
+any other:
+
+    ground = NetworkJoystick(10, port=5005)
+    CHANNELS = (ground.axis(0) + roll_trim * 0.2, ...)
+
+The packets that arrived are read right before every frame is mixed,
+without a thread or any waiting, and the frame gets the newest one: the
+link adds no latency of its own. Packets older (by sequence number) than
+one already taken are dropped, and so are the ones more than ``max_age``
+seconds old when read, counted from the fastest trip seen (the clocks of
+the sender and the Pi needn't agree). Packets are stamped with the
+sender's monotonic clock, so setting the time (NTP on a Pi without an
+RTC) doesn't make them look late. Without packets for ``timeout``
+seconds the joystick is disconnected, i.e. its channels output their
+``FAILSAFE`` values, until packets arrive again.
+
+    python flystick_network.py send HOST [PORT] [RATE]
+    python flystick_network.py listen [PORT]
+"""
+from __future__ import print_function
+
+import errno
+import logging
+import socket
+import struct
+import sys
+import time
+
+from flystick_conf_models import (EventSource, InputDevice, InputEvent,
+                                   Joystick)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+DEFAULT_PORT = 5005
+MAGIC = b'FLYN'
+# magic, sequence number, send time (the sender's monotonic clock) and the
+# number of axes, buttons and hats. Then the axes as int16 (1. is 32767),
+# the buttons as a uint32 bit mask and the hats as int8 (x, y) pairs.
+HEADER = struct.Struct('<4sIdBBB')
+AXIS_SCALE = 32767.
+MAX_BUTTONS = 32
+MAX_PACKET = 1024
+# how long the smallest delay seen is the base of the packet ages, so
+# that the clocks of the sender and the Pi may drift apart
+BASE_WINDOW = 10.
+
+_bodies = {}
+
+
+def body(axes, hats):
+    """The ``struct.Struct`` of the packet body after the header."""
+    layout = _bodies.get((axes, hats))
+    if layout is None:
+        layout = _bodies[(axes, hats)] = struct.Struct(
+            '<%dhI%db' % (axes, 2 * hats))
+    return layout
+
+
+def pack(seq, stamp, axes, buttons=(), hats=()):
+    """The packet of a stick state."""
+    if len(buttons) > MAX_BUTTONS:
+        raise ValueError("At most %d buttons" % (MAX_BUTTONS,))
+    mask = 0
+    for i, pressed in enumerate(buttons):
+        if pressed:
+            mask |= 1 << i
+    values = [int(round(max(min(value, 1.), -1.) * AXIS_SCALE))
+              for value in axes]
+    values.append(mask)
+    for hat in hats:
+        values.extend(hat)
+    return (HEADER.pack(MAGIC, seq & 0xffffffff, stamp, len(axes),
+                        len(buttons), len(hats)) +
+            body(len(axes), len(hats)).pack(*values))
+
+
+class Sender(object):
+    """Sends stick states to a ``NetworkJoystick`` at ``host``."""
+    def __init__(self, host, port=DEFAULT_PORT):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.seq = 0
+
+    def send(self, axes, buttons=(), hats=(), stamp=None):
+        self.seq = (self.seq + 1) & 0xffffffff
+        self.sock.sendto(pack(self.seq,
+                              _clock() if stamp is None else stamp,
+                              axes, buttons, hats), self.address)
+
+    def close(self):
+        self.sock.close()
+
+
+class NetworkDevice(InputDevice):
+    """The stick of a ground station sending to UDP ``port``, in the
+    interface of ``pygame.joystick.Joystick``. The first ``axes``,
+    ``buttons`` and ``hats`` of the packets are taken, the rest are left
+    at rest.
+
+    ``read()`` takes the packets arrived since the previous call. The
+    counters are the packets taken, and those dropped as ``reordered``
+    (or duplicated), ``stale`` or ``malformed``; ``losses`` is how many
+    times the link timed out. ``age`` is how old the last packet taken
+    was when read, beyond the fastest trip seen, seconds.
+    """
+    def __init__(self, joy_id, port=DEFAULT_PORT, host='', axes=8,
+                 buttons=32, hats=1, timeout=.25, max_age=.1, name=None):
+        self.joy_id = joy_id
+        self.name = name or "Network Joystick %d" % (joy_id,)
+        self.axes = [0.] * axes
+        self.buttons = [False] * buttons
+        self.hats = [(0, 0)] * hats
+        self.timeout = timeout
+        self.max_age = max_age
+        self.clock = _clock
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind((host, port))
+        # the actual one with port 0
+        self.port = self.sock.getsockname()[1]
+        self.connected = False
+        self.seq = self.last = self.stamp = None
+        self.age = 0.
+        self.packets = self.reordered = self.stale = self.malformed = 0
+        self.losses = 0
+        self._buffer = bytearray(MAX_PACKET)
+        # the smallest delay (self.clock() - stamp) seen in this and the
+        # previous BASE_WINDOW, i.e. the clock offset plus the fastest trip
+        self._base = self._next_base = None
+        self._window_end = 0.
+
+    def read(self, sink):
+        """Takes the packets that arrived, appending button presses and
+        hat moves to ``sink.clicks``/``sink.hats``."""
+        now = self.clock()
+        while True:
+            try:
+                size = self.sock.recv_into(self._buffer)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            self._packet(size, sink, now)
+        if self.connected and now - self.last > self.timeout:
+            self.connected = False
+            self.losses += 1
+            logging.warn("%s: no packets for %.2f s, failsafe",
+                         self.name, now - self.last)
+
+    def _packet(self, size, sink, now):
+        buf = self._buffer
+        if size < HEADER.size:
+            self.malformed += 1
+            return
+        magic, seq, stamp, axes, buttons, hats = HEADER.unpack_from(buf)
+        # before body(), which keeps a struct for every layout seen
+        if (magic != MAGIC or buttons > MAX_BUTTONS
+                or size != HEADER.size + 2 * axes + 4 + 2 * hats):
+            self.malformed += 1
+            return
+        layout = body(axes, hats)
+        # a sender starting over is taken once the link timed out
+        if (self.connected and now - self.last <= self.timeout
+                and not 0 < (seq - self.seq) & 0xffffffff < 1 << 31):
+            self.reordered += 1
+            return
+        if not self.connected:
+            # maybe a restarted sender, its clock starting over
+            self._base = self._next_base = None
+        delay = now - stamp
+        if now >= self._window_end:
+            self._base, self._next_base = self._next_base, None
+            self._window_end = now + BASE_WINDOW
+        if self._base is None or delay < self._base:
+            self._base = delay
+        if self._next_base is None or delay < self._next_base:
+            self._next_base = delay
+        age = delay - self._base
+        if age > self.max_age:
+            self.stale += 1
+            return
+        values = layout.unpack_from(buf, HEADER.size)
+        for i in range(min(axes, len(self.axes))):
+            self.axes[i] = values[i] / AXIS_SCALE
+        mask = values[axes]
+        for i in range(min(buttons, len(self.buttons))):
+            pressed = bool(mask >> i & 1)
+            if pressed and not self.buttons[i]:
+                sink.clicks.append(InputEvent(self.joy_id, i, None, 1, now))
+            self.buttons[i] = pressed
+        for i in range(min(hats, len(self.hats))):
+            value = values[axes + 1 + 2 * i:axes + 3 + 2 * i]
+            if value != self.hats[i]:
+                self.hats[i] = value
+                if any(value):
+                    sink.hats.append(InputEvent(self.joy_id, None, i, value,
+                                                now))
+        self.seq, self.last, self.stamp, self.age = seq, now, stamp, age
+        self.packets += 1
+        if not self.connected:
+            self.connected = True
+            logging.warn("%s: receiving on port %d", self.name, self.port)
+
+    def close(self):
+        self.sock.close()
+
+
+class NetworkInput(EventSource):
+    """Reads the packets of all network devices before every frame, next
+    to the input backend's events."""
+    def __init__(self):
+        EventSource.__init__(self)
+        self.devices = []
+
+    def register(self, device):
+        self.devices.append(device)
+
+    def collect(self):
+        for device in self.devices:
+            device.read(self)
+
+    def wrap(self, events):
+        """The backend's ``events()``, reading the network first (its
+        button presses and hat moves are routed, not returned)."""
+        def network_events():
+            if self.devices:
+                self.events()
+            return events()
+        return network_events
+
+    def counters(self):
+        """The packets taken and dropped, of all devices."""
+        devices = self.devices
+        return {
+            'packets': sum(device.packets for device in devices),
+            'reordered': sum(device.reordered for device in devices),
+            'stale': sum(device.stale for device in devices),
+            'malformed': sum(device.malformed for device in devices),
+            'losses': sum(device.losses for device in devices),
+        }
+
+
+receiver = NetworkInput()
+
+
+class NetworkJoystick(Joystick):
+    """``Joystick`` of a ground station sending to UDP ``port``. The
+    ``joy_id`` only tells its switches (``hat_switch``, ``button_switch``)
+    apart from those of the local joysticks, so it must not be one of
+    theirs. Keyword arguments are passed to ``NetworkDevice``."""
+    def __init__(self, joy_id, **device):
+        if hasattr(self, '_joy'):
+            # reused
+            return
+        self._joy = NetworkDevice(joy_id, **device)
+        receiver.register(self._joy)
+
+
+def send_joystick(host, port=DEFAULT_PORT, rate=100.):
+    """Sends the first pygame joystick, or a virtual one without any,
+    ``rate`` times a second."""
+    try:
+        import pygame
+        pygame.init()
+        pygame.joystick.init()
+        joy = pygame.joystick.Joystick(0)
+        joy.init()
+        pump = pygame.event.pump
+        axes = range(joy.get_numaxes())
+        buttons = range(min(joy.get_numbuttons(), MAX_BUTTONS))
+        hats = range(joy.get_numhats())
+    except Exception as e:
+        logging.warn("No joystick (%s), sending a virtual one", e)
+        from flystick_virtual import VirtualDevice, VirtualInput
+        joy = VirtualDevice(0)
+        source = VirtualInput()
+        source.register(joy)
+        pump = source.events
+        axes, buttons, hats = (range(len(joy.axes)), range(len(joy.buttons)),
+                               range(len(joy.hats)))
+    sender = Sender(host, port)
+    print("Sending %s to %s:%d, %g times a second"
+          % (joy.get_name(), host, port, rate))
+    interval = 1. / rate
+    deadline = _clock()
+    while True:
+        pump()
+        sender.send([joy.get_axis(i) for i in axes],
+                    [joy.get_button(i) for i in buttons],
+                    [joy.get_hat(i) for i in hats])
+        deadline += interval
+        time.sleep(max(deadline - _clock(), 0))
+
+
+def listen(port=DEFAULT_PORT):
+    """Prints what arrives at ``port``, ten times a second."""
+    device = NetworkDevice(0, port)
+    network = NetworkInput()
+    network.register(device)
+    while True:
+        time.sleep(.1)
+        network.events()
+        print("%s axes %s buttons %s hats %s age %.1f ms %r" % (
+            "up  " if device.connected else "down",
+            " ".join("%+.2f" % (value,) for value in device.axes),
+            "".join("1" if pressed else "0" for pressed in device.buttons),
+            device.hats, device.age * 1e3, network.counters()))
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    try:
+        if command == 'send' and len(sys.argv) > 2:
+            send_joystick(sys.argv[2],
+                          int(sys.argv[3]) if len(sys.argv) > 3
+                          else DEFAULT_PORT,
+                          float(sys.argv[4]) if len(sys.argv) > 4 else 100.)
+        elif command == 'listen':
+            listen(int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT)
+        else:
+            print(__doc__.strip().split('\n\n')[-1])
+            sys.exit(2)
+    except KeyboardInterrupt:
+        pass
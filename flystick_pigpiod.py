@@ -0,0 +1,242 @@
+"""
+Pipelined client for the pigpiod socket interface, and a fake pigpiod
+speaking the same protocol for measuring it without a Pi.
+
+The ``pigpio`` module waits for the reply of every command, so a PPM
+update (add pulses, create, send, delete) costs four round-trips.
+``PipelinedPi`` queues commands whose result isn't needed right away and
+writes the queue at once with the next command whose result is, reading
+all the replies with one read.
+
+The id of a created wave is needed by the send that follows it, and
+pigpiod picks it by resources (control blocks) that the client can't
+tell for sure: the id could only be predicted safely when no deleted
+wave is left to reuse, i.e. when the create needs new wave memory and
+has to wait for its reply anyway. So ``wave_create`` waits for the id,
+and a new frame costs two round-trips: the pulses and the create, then
+the send and the deletes. A cached frame is one.
+"""
+import os
+import socket
+import struct
+import threading
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+# command codes, see pigpio.py
+MODES = 0
+WVCLR = 27
+WVAG = 28
+WVTX = 51
+WVTXR = 52
+WVNEW = 53
+WVCRE = 49
+WVDEL = 50
+NOIB = 99
+WVTXM = 100
+
+PI_BAD_WAVE_ID = -66
+PI_TOO_MANY_CBS = -67
+PI_WAVE_MODE_ONE_SHOT = 0
+PI_WAVE_MODE_REPEAT = 1
+
+COMMAND = struct.Struct('<IIII')
+REPLY = struct.Struct('<IIIi')
+PULSE = struct.Struct('<III')
+
+_NAMES = {MODES: 'set_mode', WVCLR: 'wave_clear', WVAG: 'wave_add_generic',
+          WVTX: 'wave_send_once', WVTXR: 'wave_send_repeat',
+          WVNEW: 'wave_add_new', WVCRE: 'wave_create', WVDEL: 'wave_delete',
+          NOIB: 'notify_open_in_band', WVTXM: 'wave_send_using_mode'}
+
+
+class PigpiodError(pigpio.error if pigpio else Exception):
+    """A failed command, a ``pigpio.error`` like those of ``pigpio``."""
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        data = sock.recv(size)
+        if not data:
+            raise PigpiodError("pigpiod closed the connection")
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+class PipelinedPi(object):
+    """The wave subset of ``pigpio.pi`` over one persistent connection,
+    with pipelining. Queued commands are written with the next command
+    whose result is needed (``wave_create``, a send) or on ``flush()``;
+    their errors are raised from there as ``PigpiodError``, running out
+    of wave memory from ``wave_create``, like with ``pigpio``, so that
+    ``WaveCache`` can evict and retry.
+
+    ``pipelined=False`` does a round-trip per command like ``pigpio``.
+    """
+    def __init__(self, host=None, port=None, pipelined=True):
+        host = host or os.getenv('PIGPIO_ADDR', 'localhost')
+        port = port or int(os.getenv('PIGPIO_PORT', 8888))
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pipelined = pipelined
+        self.writes = self.commands = 0
+        self._queue = []
+
+    def _command(self, cmd, p1=0, p2=0, ext=b'', flush=False):
+        self._queue.append((cmd, p1, p2, ext))
+        if flush or not self.pipelined:
+            return self.flush()[-1]
+
+    def flush(self):
+        """Writes all queued commands and reads their replies. Returns
+        the results."""
+        queue, self._queue = self._queue, []
+        if not queue:
+            return []
+        self.sock.sendall(b''.join(COMMAND.pack(cmd, p1, p2, len(ext)) + ext
+                                   for cmd, p1, p2, ext in queue))
+        self.writes += 1
+        self.commands += len(queue)
+        data = _recv_exactly(self.sock, REPLY.size * len(queue))
+        results = [REPLY.unpack_from(data, i * REPLY.size)[3]
+                   for i in range(len(queue))]
+        errors = ["%s: %d" % (_NAMES.get(cmd, cmd), result)
+                  for (cmd, p1, p2, ext), result in zip(queue, results)
+                  if result < 0]
+        if errors:
+            raise PigpiodError(", ".join(errors))
+        return results
+
+    # pigpio.pi interface
+
+    def set_mode(self, gpio, mode):
+        self._command(MODES, gpio, mode, flush=True)
+
+    def wave_add_new(self):
+        self._command(WVNEW)
+
+    def wave_add_generic(self, pulses):
+        self._command(WVAG, ext=b''.join(
+            PULSE.pack(pulse.gpio_on, pulse.gpio_off, pulse.delay)
+            for pulse in pulses))
+
+    def wave_create(self):
+        return self._command(WVCRE, flush=True)
+
+    def wave_clear(self):
+        self._command(WVCLR, flush=True)
+
+    def wave_delete(self, wave_id):
+        self._command(WVDEL, wave_id)
+
+    def wave_send_using_mode(self, wave_id, mode):
+        self._command(WVTXM, wave_id, mode, flush=True)
+
+    def wave_send_repeat(self, wave_id):
+        self.wave_send_using_mode(wave_id, PI_WAVE_MODE_REPEAT)
+
+    def stop(self):
+        self.flush()
+        self.sock.close()
+
+
+class FakePigpiod(threading.Thread):
+    """Local stand-in for pigpiod serving the wave commands over TCP,
+    with pigpiod's wave id allocation. Replies are sent per command, like
+    pigpiod does. ``port=0`` picks a free port, see ``self.port``.
+    ``max_pulses`` limits the wave memory, in pulses."""
+    def __init__(self, host='localhost', port=0, max_pulses=None):
+        threading.Thread.__init__(self, name="fake-pigpiod")
+        self.daemon = True
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(4)
+        self.port = self.server.getsockname()[1]
+        self.max_pulses = max_pulses
+        self.commands = 0
+        self.sent = []
+        self._lock = threading.Lock()
+        self._pulses = 0
+        self._waves = {}
+        self._out_count = 0
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            serve = threading.Thread(target=self._serve, args=(conn,))
+            serve.daemon = True
+            serve.start()
+
+    def stop(self):
+        self.server.close()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                header = conn.recv(COMMAND.size, socket.MSG_WAITALL)
+                if len(header) < COMMAND.size:
+                    return
+                cmd, p1, p2, p3 = COMMAND.unpack(header)
+                ext = _recv_exactly(conn, p3) if p3 else b''
+                with self._lock:
+                    self.commands += 1
+                    result = self._execute(cmd, p1, p2, ext)
+                conn.sendall(REPLY.pack(cmd, p1, p2, result))
+        except (socket.error, PigpiodError):
+            pass
+        finally:
+            conn.close()
+
+    def _execute(self, cmd, p1, p2, ext):
+        if cmd == WVNEW:
+            self._pulses = 0
+        elif cmd == WVCLR:
+            self._pulses = 0
+            self._waves.clear()
+            self._out_count = 0
+        elif cmd == WVAG:
+            self._pulses += len(ext) // PULSE.size
+            return self._pulses
+        elif cmd == WVCRE:
+            pulses, self._pulses = self._pulses, 0
+            for wave_id in range(self._out_count):
+                wave = self._waves.get(wave_id)
+                if wave and wave[1] and wave[0] == pulses:
+                    break
+            else:
+                wave_id = self._out_count
+                if self.max_pulses is not None and pulses + sum(
+                        self._waves[i][0] for i in range(wave_id)) \
+                        > self.max_pulses:
+                    return PI_TOO_MANY_CBS
+                self._out_count += 1
+            self._waves[wave_id] = [pulses, False]
+            return wave_id
+        elif cmd == WVDEL:
+            wave = self._waves.get(p1)
+            if wave is None or wave[1]:
+                return PI_BAD_WAVE_ID
+            wave[1] = True
+            while self._out_count and self._waves[self._out_count - 1][1]:
+                self._out_count -= 1
+                del self._waves[self._out_count]
+        elif cmd in (WVTXM, WVTXR, WVTX):
+            wave = self._waves.get(p1)
+            if wave is None or wave[1]:
+                return PI_BAD_WAVE_ID
+            self.sent.append(p1)
+            return wave[0]
+        elif cmd == NOIB:
+            # notification handle for the pigpio module's callback thread
+            return 0
+        return 0
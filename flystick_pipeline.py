@@ -0,0 +1,83 @@
+"""
+The per-frame work of the main loop: input events, mixing, pulse
+conditioning and PPM output, timing every stage.
+"""
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def trim_percent(output, channel, reference):
+    """Trim of ``channel`` in %, i.e. the difference to its untrimmed
+    ``reference`` channel."""
+    return int((output[channel] - output[reference]) * 100)
+
+
+class TrimText(object):
+    """The LCD lines of a trim, e.g. 'rll 5%', made once up front for all
+    the trims of values within [-1..1], not every time the trim changes."""
+    def __init__(self, label, limit=200):
+        self.label = label
+        self._texts = dict((trim, "%s %d%%" % (label, trim))
+                           for trim in range(-limit, limit + 1))
+
+    def __call__(self, trim):
+        text = self._texts.get(trim)
+        if text is None:
+            text = "%s %d%%" % (self.label, trim)
+        return text
+
+
+class FramePipeline(object):
+    """Runs one frame per ``run()``.
+
+    ``events()`` returns the (clicks, hats) of the frame, ``mix`` and
+    ``condition`` are the compiled mixer and ``PulseConditioner``, and
+    ``send(widths)`` outputs the frame if any width changed (None for
+    debug mode). Without ``condition``, ``send(values)`` gets the mixed
+    values every frame instead, for the serial outputs. Channels in
+    ``excluded`` are left out of the output.
+    ``timings`` holds the seconds spent in each of ``STAGES`` in the last
+    frame.
+    """
+    STAGES = ('input', 'mix', 'condition', 'output')
+
+    def __init__(self, events, mix, condition, send=None, excluded=()):
+        self.events = events
+        self.mix = mix
+        self.condition = condition
+        self.send = send
+        self.excluded = frozenset(excluded)
+        self.output = ()
+        self.widths = ()
+        self.changed = False
+        self.frames = 0
+        self.timings = [0.] * len(self.STAGES)
+
+    def run(self):
+        t0 = _clock()
+        evts = self.events()
+        t1 = _clock()
+        # a tuple, or the mixer's own array overwritten every frame
+        self.output = output = self.mix(evts)
+        t2 = _clock()
+        if self.condition:
+            self.widths, self.changed = self.condition(output)
+            frame = self.widths
+        else:
+            self.changed = True
+            frame = output
+        t3 = _clock()
+        if self.changed and self.send:
+            if self.excluded:
+                frame = tuple(value for i, value in enumerate(frame)
+                              if i not in self.excluded)
+            self.send(frame)
+        t4 = _clock()
+        timings = self.timings
+        timings[0] = t1 - t0
+        timings[1] = t2 - t1
+        timings[2] = t3 - t2
+        timings[3] = t4 - t3
+        self.frames += 1
+        return output
@@ -0,0 +1,200 @@
+"""
+PPM frame construction and pigpio wave management.
+"""
+import time
+from collections import OrderedDict
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+# length of the separator (low) pulse preceding every channel
+PPM_SEPARATOR_US = 300
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def ppm_pulses(widths, gpio_mask, frame_us):
+    """Builds the pulse list of one PPM frame of channel ``widths`` (us)."""
+    pulses, pos = [], 0
+    for us in widths:
+        pulses += [pigpio.pulse(0, gpio_mask, PPM_SEPARATOR_US),
+                   pigpio.pulse(gpio_mask, 0, us - PPM_SEPARATOR_US)]
+        pos += us
+    pulses += [pigpio.pulse(0, gpio_mask, PPM_SEPARATOR_US),
+               pigpio.pulse(gpio_mask, 0,
+                            frame_us - PPM_SEPARATOR_US - pos)]
+    return pulses
+
+
+class PpmTemplate(object):
+    """Builds the pulses of PPM frames like ``ppm_pulses``, but into one
+    pulse list made once and updated in place, for ``WaveCache`` (pigpio
+    copies the pulses when a wave is added)."""
+    def __init__(self, gpio_mask, frame_us):
+        self.gpio_mask = gpio_mask
+        self.frame_us = frame_us
+        self.pulses = []
+
+    def __call__(self, widths):
+        pulses = self.pulses
+        if len(pulses) != 2 * len(widths) + 2:
+            pulses[:] = ppm_pulses(widths, self.gpio_mask, self.frame_us)
+            return pulses
+        pos, i = 0, 1
+        for us in widths:
+            pulses[i].delay = us - PPM_SEPARATOR_US
+            pos += us
+            i += 2
+        pulses[i].delay = self.frame_us - PPM_SEPARATOR_US - pos
+        return pulses
+
+
+def start_ppm(pi, gpio, widths, frame_us):
+    """Forgets the waves left by a previous run, sets up ``gpio`` and
+    starts repeating a PPM frame of ``widths``. Returns the wave, to be
+    handed to ``WaveCache`` as ``idle``, and when it started (``_clock``,
+    within the reply's trip), the epoch of the frame boundaries: the
+    waves sent after it take over on them."""
+    pi.wave_clear()
+    pi.set_mode(gpio, pigpio.OUTPUT)
+    pi.wave_add_generic(ppm_pulses(widths, 1 << gpio, frame_us))
+    wave = pi.wave_create()
+    pi.wave_send_repeat(wave)
+    return wave, _clock()
+
+
+class PulseConditioner(object):
+    """Converts channel values [-1..1] to pulse widths at the output's
+    real resolution of 1 us, ignoring jitter.
+
+    A channel only moves once its unrounded width is more than
+    ``deadband`` us past the rounding point of the width being sent, so
+    float noise from the sticks doesn't cause a new frame every loop.
+    ``deadband`` is either one value for all channels or one per channel.
+
+    While no channel moves, the same widths tuple is returned again
+    without building anything.
+    """
+    def __init__(self, center_us, range_us, deadband=0):
+        self.center = center_us
+        self.range = range_us
+        self.deadband = deadband
+        self.widths = None
+        # deadband of every channel, and the ``deadband`` it's made of
+        self._bands = self._banded = None
+
+    def __call__(self, values):
+        """Returns the widths of ``values`` and whether any of them
+        changed since the previous call."""
+        deadband = self.deadband
+        if deadband is not self._banded or len(self._bands) != len(values):
+            self._banded = deadband
+            self._bands = tuple(deadband) if isinstance(
+                deadband, (tuple, list)) else (deadband,) * len(values)
+        deadband = self._bands
+        prev = self.widths
+        if prev is None or len(prev) != len(values):
+            widths = tuple(int(round(self.center + self.range * value))
+                           for value in values)
+        else:
+            center, scale, i = self.center, self.range, 0
+            for value in values:
+                if abs(center + scale * value - prev[i]) >= .5 + deadband[i]:
+                    break
+                i += 1
+            else:
+                return prev, False
+            widths = tuple(
+                last if abs(raw - last) < .5 + band else int(round(raw))
+                for raw, last, band in zip(
+                    (self.center + self.range * value for value in values),
+                    prev, deadband))
+        changed = widths != prev
+        self.widths = widths
+        return widths, changed
+
+
+class WaveCache(object):
+    """Keeps created pigpio waves keyed by the tuple of channel widths, so
+    a frame that was already sent (e.g. sticks centered) is re-sent
+    without re-uploading it to pigpiod.
+
+    Waves are evicted least recently used first when there are more than
+    ``capacity`` of them, or when pigpiod runs out of wave memory. The wave
+    being transmitted and the one it replaced (which may still be running
+    until the sync point) are never evicted. All our frames have the same
+    number of pulses, so pigpiod can reuse the memory of a deleted wave
+    for the next one.
+
+    ``idle`` is a wave that was being sent before this cache took over,
+    deleted once no longer transmitting.
+    """
+    def __init__(self, pi, build, capacity=32, idle=None):
+        if capacity < 3:
+            raise ValueError("Invalid wave cache capacity %r" % (capacity,))
+        self.pi = pi
+        self.build = build
+        self.capacity = capacity
+        self.hits = self.misses = self.evictions = 0
+        self.created = self.deleted = 0
+        self.current = self.previous = None
+        self.idle = idle
+        self._waves = OrderedDict()
+
+    def wave(self, key):
+        """Returns the wave id for ``key``, creating the wave if needed."""
+        wave_id = self._waves.pop(key, None)
+        if wave_id is None:
+            self.misses += 1
+            wave_id = self._create(key)
+            while len(self._waves) >= self.capacity and self._evict():
+                pass
+        else:
+            self.hits += 1
+        # most recently used last
+        self._waves[key] = wave_id
+        return wave_id
+
+    def send(self, key):
+        """Switches the output to the frame ``key`` at the end of the
+        running frame. Does nothing if it's already being sent."""
+        wave_id = self.wave(key)
+        if wave_id != self.current:
+            self.pi.wave_send_using_mode(wave_id,
+                                         pigpio.WAVE_MODE_REPEAT_SYNC)
+            self.previous, self.current = self.current, wave_id
+            if self.idle is not None and self.previous is not None:
+                self.pi.wave_delete(self.idle)
+                self.deleted += 1
+                self.idle = None
+        return wave_id
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'waves': len(self._waves)}
+
+    def _create(self, key):
+        pulses = self.build(key)
+        while True:
+            try:
+                self.pi.wave_add_generic(pulses)
+                wave_id = self.pi.wave_create()
+                self.created += 1
+                return wave_id
+            except pigpio.error:
+                # out of pulses/control blocks, make room and retry
+                self.pi.wave_add_new()
+                if not self._evict():
+                    raise
+
+    def _evict(self):
+        for key, wave_id in self._waves.items():
+            if wave_id not in (self.current, self.previous):
+                del self._waves[key]
+                self.pi.wave_delete(wave_id)
+                self.evictions += 1
+                self.deleted += 1
+                return True
+        return False
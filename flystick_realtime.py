@@ -0,0 +1,139 @@
+"""
+Real-time mode of the frame loop (``flystick.py --realtime``), so that
+pigpiod, the LCD I2C traffic, system daemons and the garbage collector
+don't delay frames:
+
+- SCHED_FIFO priority and a CPU of its own (the last one by default) for
+  the thread calling ``enable()``, i.e. just the loop if called after the
+  helper threads were started,
+- all memory locked, no page faults mid-frame,
+- ``GcControl``: the objects loaded with the config frozen out of the
+  collections (Python 3.7+), and the collections the collector would
+  have run mid-frame run in the idle time after each frame instead.
+
+Needs root (or CAP_SYS_NICE and CAP_IPC_LOCK). What can't be set is
+logged and skipped.
+"""
+import ctypes
+import ctypes.util
+import gc
+import logging
+import multiprocessing
+import os
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# sched.h, sys/mman.h
+SCHED_FIFO = 1
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# a generation put off for taking longer than the time left is collected
+# anyway once its count reaches this many times its threshold
+DEFER_LIMIT = 4
+
+_libc = None
+
+
+def _call(name, *args):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    if getattr(_libc, name)(*args) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "%s: %s" % (name, os.strerror(errno)))
+
+
+def set_fifo(priority):
+    if hasattr(os, 'sched_setscheduler'):
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    else:
+        _call('sched_setscheduler', 0, SCHED_FIFO,
+              ctypes.byref(ctypes.c_int(priority)))
+
+
+def set_affinity(cpus):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    else:
+        mask = ctypes.c_ulong(sum(1 << cpu for cpu in cpus))
+        _call('sched_setaffinity', 0, ctypes.sizeof(mask),
+              ctypes.byref(mask))
+
+
+def lock_memory():
+    _call('mlockall', MCL_CURRENT | MCL_FUTURE)
+
+
+def enable(priority=50, cpus=None):
+    """Makes the calling thread real-time on ``cpus`` (default: the last
+    CPU) and locks the memory. Returns what could be set."""
+    if cpus is None:
+        cpus = (multiprocessing.cpu_count() - 1,)
+    applied = []
+    for name, setup, args in (
+            ("SCHED_FIFO %d" % (priority,), set_fifo, (priority,)),
+            ("CPU %s" % (",".join(str(cpu) for cpu in cpus),),
+             set_affinity, (cpus,)),
+            ("mlockall", lock_memory, ())):
+        try:
+            setup(*args)
+            applied.append(name)
+        except (OSError, ValueError) as e:
+            logging.warn("Realtime mode without %s: %s", name, e)
+    return applied
+
+
+class GcControl(object):
+    """Runs the garbage collection only when ``idle()`` is called, i.e.
+    between frames. ``histogram`` gets the time of every collection."""
+    def __init__(self, histogram=None):
+        self.histogram = histogram
+        self.collections = self.deferred = 0
+        self.thresholds = gc.get_threshold()
+        # how long the last collection of each generation took
+        self.durations = [0., 0., 0.]
+
+    def start(self):
+        """Collects and freezes what's there (the config, modules etc.),
+        then stops the automatic collections."""
+        start = _clock()
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        else:
+            # what a full collection costs with all of it
+            self.durations[2] = _clock() - start
+        gc.disable()
+
+    def idle(self, remaining=None):
+        """Runs the collection the collector would have run by now, the
+        oldest generation due as it does. With ``remaining`` seconds until
+        the next frame, a generation that took longer than that the last
+        time is put off, collecting a younger one, up to ``DEFER_LIMIT``
+        times its threshold."""
+        counts, thresholds = gc.get_count(), self.thresholds
+        for generation in (2, 1, 0):
+            if counts[generation] > thresholds[generation]:
+                break
+        else:
+            return
+        if remaining is not None:
+            while generation and self.durations[generation] > remaining \
+                    and counts[generation] < \
+                    DEFER_LIMIT * thresholds[generation]:
+                generation -= 1
+                self.deferred += 1
+        start = _clock()
+        gc.collect(generation)
+        spent = self.durations[generation] = _clock() - start
+        self.collections += 1
+        if self.histogram is not None:
+            self.histogram.add(spent)
+
+    def stop(self):
+        gc.enable()
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
@@ -0,0 +1,337 @@
+#!/usr/bin/python
+"""
+Flight data recorder: what went in and out of every frame, for finding
+out what happened after a crash with the read-only root (see
+read-only-fs.sh).
+
+The frames are written into a ring buffer in a memory-mapped file on a
+tmpfs (/tmp, kept until power-off) or a writable partition, so the kernel
+keeps the data when the process dies and nothing is allocated per frame.
+A record holds the time, frame number, missed frames, stage timings, the
+distinct inputs read by the mixer, the channel values and the pulse
+widths. The previous recording is kept as ``<path>.1``, e.g. the one
+before a crash and restart.
+
+    python flystick_recorder.py export [path] [out.csv|out.npz|out.npy]
+    python flystick_recorder.py replay [path]
+
+``replay`` runs the recorded inputs through the ``CHANNELS`` of
+flystick_config.py again, with virtual joysticks of the recorded names,
+and reports where the output differs from the recorded one.
+"""
+from __future__ import print_function
+
+import collections
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from flystick_conf_models import Joystick, Switch
+
+DEFAULT_PATH = '/tmp/flystick-recorder.bin'
+
+MAGIC = b'FLYREC01'
+# magic, header size, record size, capacity, columns length, records written
+HEADER = struct.Struct('<8sIIIIQ')
+COUNT = struct.Struct('<Q')
+COUNT_OFFSET = 24
+# the header is followed by the columns as JSON, up to this size
+HEADER_SIZE = 4096
+
+Record = collections.namedtuple(
+    'Record', 'time frame missed timings inputs outputs widths')
+
+
+def input_labels(keys):
+    """Names of the mixer ``input_keys``, e.g. 'js0.axis1', stable between
+    runs of the same config."""
+    labels = []
+    for key in keys:
+        source = key[0]
+        if isinstance(source, Switch) and source.key is None:
+            label = 'switch'
+        elif isinstance(source, Switch):
+            # e.g. (0, 'hat', 0, 1): 'js0.hat0.1.switch'
+            key = source.key
+            label = 'js%s.%s%s%s.switch' % (key[:3] + (''.join(
+                '.%s' % (part,) for part in key[3:]),))
+        elif isinstance(source, Joystick):
+            label = 'js%d.%s%d' % (source._joy.get_id(), key[1], key[2])
+        else:
+            label = '.'.join(str(part) for part in key[1:]) or 'input'
+        if label in labels:
+            label += '#%d' % (labels.count(label) + 1,)
+        labels.append(label)
+    return labels
+
+
+def joystick_names():
+    return dict((str(joystick._joy.get_id()), joystick.get_name())
+                for joystick in Joystick.instances.values()
+                if hasattr(joystick, '_joy'))
+
+
+class _Layout(object):
+    """Record structs of the ``columns``."""
+    def __init__(self, columns):
+        self.columns = columns
+        inputs = len(columns['inputs'])
+        channels = columns['channels']
+        # time, frame, missed frames, stage timings
+        self.fixed = struct.Struct('<dII%df' % (len(columns['timings']),))
+        self.inputs = struct.Struct('<%dd' % (inputs,))
+        self.outputs = struct.Struct('<%dd' % (channels,))
+        self.widths = struct.Struct('<%dH' % (channels,))
+        self.inputs_at = self.fixed.size
+        self.outputs_at = self.inputs_at + self.inputs.size
+        self.widths_at = self.outputs_at + self.outputs.size
+        # 8-byte aligned
+        self.size = (self.widths_at + self.widths.size + 7) & ~7
+
+
+class Recorder(object):
+    """Writes ``frames`` records to a new ring buffer file ``path``.
+
+    ``labels`` name the mixer inputs, recorded from ``inputs`` (the
+    ``inputs`` of a mixer compiled with ``inputs='keep'``).
+    """
+    def __init__(self, path, frames, channels, inputs, labels,
+                 stages=('input', 'mix', 'condition', 'output')):
+        if os.path.exists(path):
+            os.rename(path, path + '.1')
+        self.path = path
+        self.capacity = frames
+        self.labels = list(labels)
+        columns = {
+            'inputs': self.labels,
+            'channels': channels,
+            'timings': list(stages),
+            'joysticks': joystick_names(),
+        }
+        data = json.dumps(columns).encode('utf-8')
+        if HEADER.size + len(data) > HEADER_SIZE:
+            raise ValueError("Too many inputs to record")
+        self.layout = layout = _Layout(columns)
+        size = HEADER_SIZE + frames * layout.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.map, 0, MAGIC, HEADER_SIZE, layout.size,
+                         frames, len(data), 0)
+        self.map[HEADER.size:HEADER.size + len(data)] = data
+        self.inputs = inputs
+        self._no_widths = (0,) * channels
+        self.count = 0
+
+    def attach(self, mix, labels):
+        """Records the inputs of ``mix`` (e.g. a reloaded one) from now on.
+        NaN if they are not the recorded ones."""
+        if list(labels) == self.labels:
+            self.inputs = mix.inputs
+        else:
+            logging.warn("Mixer inputs changed, not recording them until "
+                         "restart")
+            self.inputs = [float('nan')] * len(self.labels)
+
+    def record(self, now, frame, missed, timings, outputs, widths):
+        """Writes a record over the oldest one. ``widths`` may be empty
+        (no PPM)."""
+        layout, buf = self.layout, self.map
+        offset = HEADER_SIZE + (self.count % self.capacity) * layout.size
+        layout.fixed.pack_into(buf, offset, now, frame, missed, *timings)
+        layout.inputs.pack_into(buf, offset + layout.inputs_at, *self.inputs)
+        layout.outputs.pack_into(buf, offset + layout.outputs_at, *outputs)
+        layout.widths.pack_into(buf, offset + layout.widths_at,
+                                *(widths or self._no_widths))
+        # only now, a record torn by a crash isn't counted
+        self.count += 1
+        COUNT.pack_into(buf, COUNT_OFFSET, self.count)
+
+    def close(self):
+        self.map.close()
+
+
+class Recording(object):
+    """A recorder file, read-only. Iterates the ``Record``s oldest
+    first."""
+    def __init__(self, path=DEFAULT_PATH):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.header_size, size, self.capacity, length,
+         self.count) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a flystick recording" % (path,))
+        self.columns = json.loads(self.map[
+            HEADER.size:HEADER.size + length].decode('utf-8'))
+        self.layout = _Layout(self.columns)
+        if self.layout.size != size:
+            raise ValueError("%s has a different record layout" % (path,))
+
+    @property
+    def labels(self):
+        return self.columns['inputs']
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _offsets(self):
+        first = self.count - len(self)
+        for n in range(first, self.count):
+            yield self.header_size + (n % self.capacity) * self.layout.size
+
+    def __iter__(self):
+        layout, buf = self.layout, self.map
+        for offset in self._offsets():
+            fixed = layout.fixed.unpack_from(buf, offset)
+            yield Record(
+                fixed[0], fixed[1], fixed[2], fixed[3:],
+                layout.inputs.unpack_from(buf, offset + layout.inputs_at),
+                layout.outputs.unpack_from(buf, offset + layout.outputs_at),
+                layout.widths.unpack_from(buf, offset + layout.widths_at))
+
+    def header(self):
+        """CSV column names."""
+        channels = range(1, self.columns['channels'] + 1)
+        return (['time', 'frame', 'missed'] +
+                ['%s_ms' % (stage,) for stage in self.columns['timings']] +
+                self.labels + ['ch%d' % (ch,) for ch in channels] +
+                ['ch%d_us' % (ch,) for ch in channels])
+
+    def write_csv(self, out):
+        import csv
+        writer = csv.writer(out)
+        writer.writerow(self.header())
+        for record in self:
+            writer.writerow(
+                ['%.6f' % (record.time,), record.frame, record.missed] +
+                ['%.3f' % (t * 1e3,) for t in record.timings] +
+                ['%.6f' % (v,) for v in record.inputs + record.outputs] +
+                list(record.widths))
+
+    def to_numpy(self):
+        """The records as a numpy structured array, oldest first."""
+        if numpy is None:
+            raise RuntimeError("numpy is not installed")
+        layout = self.layout
+        fields = [
+            ('time', '<f8', (), 0),
+            ('frame', '<u4', (), 8),
+            ('missed', '<u4', (), 12),
+            ('timings', '<f4', (len(self.columns['timings']),), 16),
+            ('inputs', '<f8', (len(self.labels),), layout.inputs_at),
+            ('outputs', '<f8', (self.columns['channels'],),
+             layout.outputs_at),
+            ('widths', '<u2', (self.columns['channels'],),
+             layout.widths_at),
+        ]
+        dtype = numpy.dtype({
+            'names': [name for name, _, _, _ in fields],
+            'formats': [(fmt, shape) if shape else fmt
+                        for _, fmt, shape, _ in fields],
+            'offsets': [offset for _, _, _, offset in fields],
+            'itemsize': layout.size,
+        })
+        records = numpy.frombuffer(self.map, dtype, self.capacity,
+                                   self.header_size)
+        # oldest first
+        records = numpy.roll(records, -(self.count % self.capacity)) \
+            if self.count > self.capacity else records[:self.count]
+        return records.copy()
+
+    def export(self, out):
+        """Writes the records to ``out``: .npz (an array per field, and
+        the input labels), .npy (a structured array) or else CSV."""
+        if out.endswith('.npz'):
+            records = self.to_numpy()
+            numpy.savez(out, input_labels=numpy.array(self.labels), **dict(
+                (name, records[name]) for name in records.dtype.names))
+        elif out.endswith('.npy'):
+            numpy.save(out, self.to_numpy())
+        else:
+            with open(out, 'w') as f:
+                self.write_csv(f)
+
+
+def replay(recording, channels):
+    """Runs the recorded inputs through the mixer of ``channels``,
+    yielding each ``Record`` with the output mixed again. Inputs that
+    weren't recorded are read live (e.g. unplugged virtual joysticks)."""
+    from flystick_mixer import compile_channels
+    mix = compile_channels(channels, inputs='replay')
+    labels = recording.labels
+    index = [labels.index(label) if label in labels else None
+             for label in input_labels(mix.input_keys)]
+    missing = [key for key, i in zip(mix.input_keys, index) if i is None]
+    if missing:
+        logging.warn("Not recorded: %s", ", ".join(
+            input_labels(missing)))
+        live = compile_channels(channels, inputs='keep')
+    evts = ([], [])
+    for record in recording:
+        if missing:
+            live(evts)
+            mix.inputs[:] = live.inputs
+        for i, j in enumerate(index):
+            if j is not None:
+                mix.inputs[i] = record.inputs[j]
+        yield record, mix(evts)
+
+
+def replay_config(recording, path):
+    """The ``CHANNELS`` of the config ``path``, run with virtual joysticks
+    named like the recorded ones (the config may pick them by name)."""
+    import runpy
+    import flystick_virtual
+    os.environ['FLYSTICK_INPUT'] = 'virtual'
+    flystick_virtual.DEFAULTS['rate'] = 0
+    for joy_id, name in recording.columns['joysticks'].items():
+        flystick_virtual.NAMES[int(joy_id)] = name
+    return runpy.run_path(path)['CHANNELS']
+
+
+def print_replay(recording, channels, tolerance=1e-9, shown=20):
+    worst = [0.] * recording.columns['channels']
+    differing = frames = 0
+    for record, output in replay(recording, channels):
+        frames += 1
+        diffs = [abs(a - b) for a, b in zip(record.outputs, output)]
+        if max(diffs or [0.]) <= tolerance:
+            continue
+        differing += 1
+        worst = [max(w, d) for w, d in zip(worst, diffs)]
+        if differing <= shown:
+            print("frame %d: recorded %s, replayed %s" % (
+                record.frame,
+                " ".join("%+.3f" % (v,) for v in record.outputs),
+                " ".join("%+.3f" % (v,) for v in output)))
+    print("%d of %d frames differ, max difference per channel: %s" % (
+        differing, frames, " ".join("%.3f" % (w,) for w in worst)))
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_PATH
+    if command == 'export':
+        recording = Recording(path)
+        if len(sys.argv) > 3:
+            recording.export(sys.argv[3])
+        else:
+            recording.write_csv(sys.stdout)
+    elif command == 'replay':
+        recording = Recording(path)
+        from flystick_boot import CONFIG
+        print_replay(recording, replay_config(recording, CONFIG))
+    else:
+        print(__doc__.strip().split('\n\n')[2])
+        sys.exit(2)
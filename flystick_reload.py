@@ -0,0 +1,142 @@
+"""
+Reloads the mixing from ``flystick_config.py`` while flying.
+
+The config file is checked for changes in the background. A changed one
+is run again (the joysticks are reused, see ``Joystick.reuse``), and the
+new mixer is compiled and tried out there too, so the main loop only
+swaps it in between two frames. Switches keep their positions when the
+new config has them on the same hat axis or button.
+
+Only CHANNELS, FAILSAFE, PPM_DEADBAND_US and DISPLAY are reloaded; the
+number of channels can't change without a restart.
+"""
+import collections
+import logging
+import os
+import runpy
+import threading
+import time
+
+from flystick_conf_models import Ch, Joystick, Switch, router
+from flystick_filter import oversampler
+from flystick_mixer import compile_channels, failsafe_mix, sources
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+Reload = collections.namedtuple(
+    'Reload', 'channels mix failsafe deadband display table filters')
+
+
+def switches(channels):
+    """The switches read by ``channels``, by their key."""
+    found = {}
+    for ch in channels:
+        for source in sources(ch.node):
+            if isinstance(source, Switch) and source.key is not None:
+                found[source.key] = source
+    return found
+
+
+def carry_switches(old, new):
+    """Moves the switches of ``new`` channels to the values of the
+    matching ones in ``old``, to the nearest position if the number of
+    positions changed."""
+    previous = switches(old)
+    for key, switch in switches(new).items():
+        if key in previous:
+            value = previous[key].value()
+            switch.pos = int(round((value + 1) / 2 * (switch.positions - 1)))
+
+
+def load(path, outputs, **mixing):
+    """Runs the config ``path`` and checks it. Returns a ``Reload``, or
+    raises ValueError. ``mixing`` is passed to ``compile_channels``."""
+    Joystick.reuse = True
+    router.stage()
+    oversampler.stage()
+    try:
+        settings = runpy.run_path(path)
+    finally:
+        Joystick.reuse = False
+        table = router.staged()
+        filters = oversampler.staged()
+    channels = tuple(settings['CHANNELS'])
+    failsafe = tuple(settings['FAILSAFE'])
+    deadband = settings['PPM_DEADBAND_US']
+    if not all(isinstance(ch, Ch) for ch in channels):
+        raise ValueError("CHANNELS must be channels")
+    if len(channels) != outputs:
+        raise ValueError("%d CHANNELS instead of %d, restart to change"
+                         % (len(channels), outputs))
+    if len(failsafe) != outputs:
+        raise ValueError("FAILSAFE must have a value per channel")
+    if isinstance(deadband, (tuple, list)) and len(deadband) != outputs:
+        raise ValueError("PPM_DEADBAND_US must have a value per channel")
+    mix = failsafe_mix(compile_channels(channels, **mixing), channels,
+                      failsafe)
+    # reads the sticks, but routed switches only move from events
+    values = mix(([], []))
+    if not all(-1. <= float(value) <= 1. for value in values):
+        raise ValueError("CHANNELS output %r" % (values,))
+    return Reload(channels, mix, failsafe, deadband,
+                  settings.get('DISPLAY', ()), table, filters)
+
+
+class ConfigReloader(threading.Thread):
+    """Checks ``path`` for changes every ``interval`` seconds and
+    prepares a ``Reload`` of it, for ``take()`` between frames.
+    ``channels`` are the ones in use, ``mixing`` as in ``load()``."""
+    def __init__(self, path, channels, interval=1., **mixing):
+        threading.Thread.__init__(self, name="config-reloader")
+        self.daemon = True
+        self.path = path
+        self.channels = channels
+        self.interval = interval
+        self.mixing = mixing
+        self.reloads = self.failures = 0
+        self.swap_time = 0.
+        self._mtime = self._stat()
+        self._pending = None
+        self._stopped = threading.Event()
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            mtime = self._stat()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                self._pending = load(self.path, len(self.channels),
+                                     **self.mixing)
+            except Exception as e:
+                self.failures += 1
+                logging.warn("Not reloading %s: %s", self.path, e,
+                             exc_info=not isinstance(e, ValueError))
+
+    def stop(self):
+        self._stopped.set()
+
+    def take(self):
+        """Returns the prepared ``Reload``, if any, after carrying the
+        switch positions over, routing events to its switches and sampling
+        its filtered axes. Call between frames and swap the rest in right
+        away."""
+        update = self._pending
+        if update is None:
+            return None
+        start = _clock()
+        self._pending = None
+        carry_switches(self.channels, update.channels)
+        router.table = update.table
+        oversampler.filters = update.filters
+        self.channels = update.channels
+        self.reloads += 1
+        self.swap_time = _clock() - start
+        logging.warn("Reloaded %s", self.path)
+        return update
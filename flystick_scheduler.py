@@ -0,0 +1,88 @@
+"""
+Paces the main loop to the PPM frame.
+
+pigpio repeats the current wave until the next one is sent with
+``WAVE_MODE_REPEAT_SYNC``, which takes over at the end of the running
+frame. Anything computed more than once per frame is wasted, so the loop
+sleeps until ``phase`` before the next frame boundary, samples the inputs
+and builds the wave in the remaining time. The smaller the phase, the
+lower the stick-to-pulse latency, as long as a frame still fits in it.
+"""
+import logging
+import math
+import time
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class FrameScheduler(object):
+    """Wakes the loop ``phase_us`` before every ``period_us`` frame
+    boundary, counted from ``start()``.
+    """
+    def __init__(self, period_us, phase_us, report_every=250,
+                 clock=_clock, sleep=time.sleep):
+        if not 0 <= phase_us < period_us:
+            raise ValueError("Invalid frame phase %r" % (phase_us,))
+        self.period = period_us / 1e6
+        self.phase = phase_us / 1e6
+        self.report_every = report_every
+        self.clock = clock
+        self.sleep = sleep
+        self.frames = 0
+        self.overruns = 0
+        self.max_late = 0.
+        # of the last wake-up, seconds
+        self.late = 0.
+        self._epoch = None
+        self._deadline = None
+        self._reported = 0
+
+    def start(self, now=None):
+        """Sets the frame boundary reference, i.e. when the first wave
+        started transmitting."""
+        self._epoch = self.clock() if now is None else now
+        self._deadline = self._epoch + self.period - self.phase
+
+    def follow(self, epoch):
+        """Starts on the frame boundaries of a scheduler started at
+        ``epoch`` (e.g. in another process), from the next one on."""
+        now = self.clock()
+        self.start(epoch + math.ceil((now - epoch) / self.period)
+                   * self.period)
+
+    def wait(self):
+        """Sleeps until the next wake-up. Returns the number of frame
+        slots missed since the previous call (0 when on time): woken
+        ``phase`` late or more, the frame can't make its boundary."""
+        if self._deadline is None:
+            self.start()
+        now = self.clock()
+        missed = 0
+        if now < self._deadline:
+            self.sleep(self._deadline - now)
+            # how late the sleep returned
+            self.late = self.clock() - self._deadline
+        else:
+            late = self.late = now - self._deadline
+            # frames that went out with a stale wave: the one at the
+            # boundary ``phase`` after the deadline and the ones after it
+            missed = int((late + self.period - self.phase) / self.period)
+            if missed:
+                self.overruns += missed
+                self.max_late = max(self.max_late, late)
+            self._deadline += missed * self.period
+        self._deadline += self.period
+        self.frames += 1
+        if self.report_every and self.frames % self.report_every == 0:
+            self.report()
+        return missed
+
+    def remaining(self):
+        """Seconds until the next wake-up."""
+        return self._deadline - self.clock()
+
+    def report(self):
+        if self.overruns != self._reported:
+            logging.warn("%d frame overruns in %d frames (max %.1f ms late)",
+                         self.overruns, self.frames, self.max_late * 1e3)
+            self._reported = self.overruns
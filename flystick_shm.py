@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""
+Latest channel values shared between processes, for running input/mixing
+and output in separate processes (``MULTIPROCESS`` in flystick_config).
+
+The buffer is a file in ``/dev/shm`` mapped by every process: a sequence
+number, the number of channels, the publish time and the values as
+doubles. There is one writer, protected by a seqlock: the sequence number
+is odd while the values are being written, and readers retry until they
+copied the values between two reads of the same even number. Readers
+never block the writer, so any number of them (display, telemetry) can
+attach read-only:
+
+    python flystick_shm.py [path]
+"""
+from __future__ import print_function
+
+import mmap
+import os
+import struct
+import sys
+import time
+
+DEFAULT_PATH = '/dev/shm/flystick-output'
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# sequence number, channel count, publish time
+HEADER = struct.Struct('=IId')
+SEQ = struct.Struct('=I')
+
+
+class ChannelBuffer(object):
+    """Seqlock-protected channel values in the shared file ``path``.
+
+    ``channels`` creates (or resets) the buffer for that many values, to
+    ``publish()`` into. Without it the buffer is attached read-only and
+    its size is taken from the file.
+    """
+    def __init__(self, path=DEFAULT_PATH, channels=None):
+        self.path = path
+        self.writable = channels is not None
+        if self.writable:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            size = HEADER.size + 8 * channels
+            os.ftruncate(fd, size)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            channels = HEADER.unpack(os.read(fd, HEADER.size))[1]
+            size = HEADER.size + 8 * channels
+        try:
+            self.map = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE
+                                 if self.writable else mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self.channels = channels
+        self.values = struct.Struct('=d%dd' % (channels,))
+        self.seq = 0
+        self.retries = 0
+        if self.writable:
+            self.map[:] = b'\0' * size
+            HEADER.pack_into(self.map, 0, 0, channels, 0.)
+
+    def publish(self, values, now=None):
+        """Makes ``values`` the latest, timestamped ``now``."""
+        if len(values) != self.channels:
+            raise ValueError("Expected %d channels, got %d"
+                             % (self.channels, len(values)))
+        seq = self.seq
+        SEQ.pack_into(self.map, 0, seq + 1)
+        self.values.pack_into(self.map, 8, _clock() if now is None else now,
+                              *values)
+        SEQ.pack_into(self.map, 0, seq + 2)
+        self.seq = (seq + 2) & 0xffffffff
+
+    def read(self):
+        """Returns the latest (sequence number, time, values). The
+        sequence number is 0 until the first ``publish()``."""
+        unpack_seq = SEQ.unpack_from
+        unpack_values = self.values.unpack_from
+        while True:
+            seq = unpack_seq(self.map, 0)[0]
+            if seq & 1:
+                # the writer may have been preempted mid-write
+                self.retries += 1
+                time.sleep(0)
+                continue
+            data = unpack_values(self.map, 8)
+            if unpack_seq(self.map, 0)[0] == seq:
+                return seq, data[0], data[1:]
+            self.retries += 1
+
+    def close(self):
+        self.map.close()
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    buf = ChannelBuffer(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
+    seq = None
+    while True:
+        latest, stamp, values = buf.read()
+        if latest != seq:
+            seq = latest
+            print("%10d %7.1f ms  %s" % (
+                seq // 2, (_clock() - stamp) * 1e3,
+                " ".join("%+.3f" % (value,) for value in values)))
+        time.sleep(.1)
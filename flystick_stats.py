@@ -0,0 +1,149 @@
+#!/usr/bin/python
+"""
+Live statistics of the running flystick: per-stage latency histograms and
+counters, served as JSON on a local Unix socket so that they can be read
+without disturbing the flight loop:
+
+    python flystick_stats.py [socket path]
+"""
+from __future__ import print_function
+
+import bisect
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+DEFAULT_SOCKET = '/tmp/flystick-stats.sock'
+
+# bucket upper bounds in microseconds, the last bucket is everything above
+BUCKETS_US = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000)
+
+
+class Histogram(object):
+    """Fixed-bucket latency histogram. Recording is a bisect and an
+    increment, no allocation."""
+    def __init__(self, bounds_us=BUCKETS_US):
+        self.bounds = tuple(us / 1e6 for us in bounds_us)
+        self.bounds_us = tuple(bounds_us)
+        self.counts = [0] * (len(bounds_us) + 1)
+        self.max = 0.
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return {'bounds_us': self.bounds_us, 'counts': list(self.counts),
+                'max_us': self.max * 1e6}
+
+
+class Stats(object):
+    """Histograms by stage name and counters read from their owners when
+    a snapshot is taken."""
+    def __init__(self, stages=()):
+        self.histograms = dict((stage, Histogram()) for stage in stages)
+        self.counters = {}
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        return histogram
+
+    def counter(self, name, read):
+        """Registers ``read()`` as the value of counter ``name``."""
+        self.counters[name] = read
+
+    def record(self, stages, timings):
+        """Adds one frame's ``timings`` of ``stages``, and their total as
+        'frame'."""
+        histograms = self.histograms
+        total = 0.
+        for stage, spent in zip(stages, timings):
+            histograms[stage].add(spent)
+            total += spent
+        histograms['frame'].add(total)
+
+    def snapshot(self):
+        return {
+            'histograms': dict((stage, histogram.snapshot())
+                               for stage, histogram
+                               in self.histograms.items()),
+            'counters': dict((name, read())
+                             for name, read in self.counters.items()),
+        }
+
+
+class StatsServer(threading.Thread):
+    """Answers every connection to the Unix socket ``path`` with a JSON
+    snapshot of ``stats``, from a background thread."""
+    def __init__(self, stats, path):
+        threading.Thread.__init__(self, name="stats-server")
+        self.daemon = True
+        self.stats = stats
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                # closed
+                return
+            try:
+                conn.sendall(json.dumps(self.stats.snapshot()).encode())
+            except socket.error as e:
+                logging.info("stats client went away: %s", e)
+            finally:
+                conn.close()
+
+    def stop(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def read_stats(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        chunks.append(data)
+    sock.close()
+    return json.loads(b''.join(chunks).decode())
+
+
+def print_stats(snapshot):
+    for name, value in sorted(snapshot['counters'].items()):
+        print("%-20s %d" % (name, value))
+    for stage, histogram in sorted(snapshot['histograms'].items()):
+        total = sum(histogram['counts'])
+        print("\n%s (%d, max %.0f us)" % (stage, total, histogram['max_us']))
+        low = 0
+        for bound, count in zip(list(histogram['bounds_us']) + [None],
+                                histogram['counts']):
+            if count:
+                label = ("%d-%d us" % (low, bound) if bound is not None
+                         else ">%d us" % (low,))
+                print("  %-14s %8d %5.1f%%"
+                      % (label, count, 100. * count / total))
+            low = bound
+
+
+if __name__ == '__main__':
+    print_stats(read_stats(sys.argv[1] if len(sys.argv) > 1
+                           else DEFAULT_SOCKET))
@@ -0,0 +1,143 @@
+"""
+Virtual joysticks, for running flystick without any input devices, e.g.
+on a dev box in the pigpio-less debug mode:
+
+    INPUT_BACKEND = 'virtual'
+
+Each device generates a random (or scripted) stream of axis moves, button
+presses and hat clicks at a given event rate. With many axes/buttons and
+high rates, this doubles as a load generator for the mixer and output.
+"""
+import random
+import time
+
+from flystick_conf_models import (EventSource, InputDevice, InputEvent,
+                                   Joystick)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class VirtualDevice(InputDevice):
+    """A generated device, in the interface of
+    ``pygame.joystick.Joystick``.
+
+    ``rate`` is events per second. ``script`` replaces the random events
+    with (time, kind, index, value) tuples, time in seconds from the first
+    poll and kind one of 'axis', 'button', 'hat' (value an (x, y)) or
+    'plug' (value whether connected).
+    """
+    def __init__(self, joy_id, name=None, axes=4, buttons=12, hats=1,
+                 rate=50., script=None, seed=None):
+        self.joy_id = joy_id
+        self.name = name or "Virtual Joystick %d" % (joy_id,)
+        self.axes = [0.] * axes
+        self.buttons = [False] * buttons
+        self.hats = [(0, 0)] * hats
+        self.connected = True
+        self.rate = rate
+        self.script = sorted(script or (), key=lambda event: event[0])
+        self.random = random.Random(seed)
+        self.generated = 0
+        self._start = self._last = None
+        self._due = 0.
+        self._next = 0
+
+    def poll(self, sink, now=None):
+        """Generates the events due by ``now``, appending button presses
+        and hat moves to ``sink.clicks``/``sink.hats``."""
+        now = _clock() if now is None else now
+        if self._start is None:
+            self._start = self._last = now
+        if self.script:
+            script = self.script
+            while (self._next < len(script)
+                   and script[self._next][0] <= now - self._start):
+                self._apply(sink, now, *script[self._next][1:])
+                self._next += 1
+            return
+        self._due += (now - self._last) * self.rate
+        self._last = now
+        while self._due >= 1:
+            self._due -= 1
+            self._random_event(sink, now)
+
+    def _random_event(self, sink, now):
+        rnd = self.random
+        kinds = ([('axis', len(self.axes))] * 8 +
+                 [('button', len(self.buttons)), ('hat', len(self.hats))])
+        kind, count = rnd.choice(kinds)
+        if not count:
+            return
+        index = rnd.randrange(count)
+        if kind == 'axis':
+            # random walk
+            value = max(-1., min(1., self.axes[index] + rnd.gauss(0, .1)))
+        elif kind == 'button':
+            value = not self.buttons[index]
+        else:
+            value = rnd.choice(((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)))
+        self._apply(sink, now, kind, index, value)
+
+    def _apply(self, sink, now, kind, index, value):
+        self.generated += 1
+        if kind == 'axis':
+            self.axes[index] = value
+        elif kind == 'button':
+            if value and not self.buttons[index]:
+                sink.clicks.append(InputEvent(self.joy_id, index, None, 1,
+                                              now))
+            self.buttons[index] = bool(value)
+        elif kind == 'plug':
+            self.connected = bool(value)
+        elif kind == 'hat':
+            self.hats[index] = tuple(value)
+            if any(value):
+                sink.hats.append(InputEvent(self.joy_id, None, index,
+                                            tuple(value), now))
+        else:
+            raise ValueError("Invalid virtual event %r" % (kind,))
+
+
+class VirtualInput(EventSource):
+    """Event source of all virtual devices, like ``EvdevPoller``.
+    ``clock`` can be replaced to generate events in simulated time."""
+    def __init__(self, clock=_clock):
+        EventSource.__init__(self)
+        self.clock = clock
+        self.devices = {}
+
+    def register(self, device):
+        self.devices[device.joy_id] = device
+
+    def wait(self, timeout):
+        time.sleep(max(timeout, 0))
+        # the devices move on meanwhile, for oversampled axes
+        now = self.clock()
+        for device in self.devices.values():
+            device.poll(self, now)
+
+    def collect(self):
+        now = self.clock()
+        for device in self.devices.values():
+            device.poll(self, now)
+
+
+virtual_input = VirtualInput()
+
+# device settings used by ``VirtualJoystick`` when not given
+DEFAULTS = dict(axes=8, buttons=32, hats=1, rate=50.)
+# device names by joystick id, when not given (e.g. the recorded ones)
+NAMES = {}
+
+
+class VirtualJoystick(Joystick):
+    """``Joystick`` of a generated device. Keyword arguments are passed to
+    ``VirtualDevice``, defaulting to ``DEFAULTS``."""
+    def __init__(self, joy_id, **device):
+        if hasattr(self, '_joy'):
+            # reused
+            return
+        settings = dict(DEFAULTS, name=NAMES.get(joy_id))
+        settings.update(device)
+        self._joy = VirtualDevice(joy_id, **settings)
+        virtual_input.register(self._joy)
@@ -1,9 +1,10 @@
-import smbus2 as smbus
+import logging
+import threading
 import time
 
 class LCD:
 
-    def __init__(self):
+    def __init__(self, bus=None, i2c_msg=None):
         # Define some device parameters
         self.I2C_ADDR = 0x27     # I2C device address, if any error, change this address to 0x3f
         self.LCD_WIDTH = 16      # Maximum characters per line
@@ -24,26 +25,46 @@ class LCD:
         # Timing constants
         self.E_PULSE = 0.0001
         self.E_DELAY = 0.0001
+        self.INIT_DELAY = 0.005
         
-        # Open I2C interface
-        # bus = smbus.SMBus(0)  # Rev 1 Pi uses 0
-        self.bus = smbus.SMBus(1)    # Rev 2 Pi uses 1
+        # Open I2C interface, smbus2 only imported for it so that a fake
+        # bus and i2c_msg run without it
+        if bus is None or i2c_msg is None:
+            import smbus2
+            # bus = smbus2.SMBus(0)  # Rev 1 Pi uses 0
+            bus = bus or smbus2.SMBus(1)    # Rev 2 Pi uses 1
+            i2c_msg = i2c_msg or smbus2.i2c_msg
+        self.bus = bus
+        self.i2c_msg = i2c_msg
         self.lcd_init()
     
     
     def lcd_init(self):
         # Initialise display
         self.lcd_byte(0x33, self.LCD_CMD)     # 110011 Initialise
+        time.sleep(self.INIT_DELAY)
         self.lcd_byte(0x32, self.LCD_CMD)     # 110010 Initialise
+        time.sleep(self.E_DELAY)
         self.lcd_byte(0x06, self.LCD_CMD)     # 000110 Cursor move direction
+        time.sleep(self.E_DELAY)
         self.lcd_byte(0x0C, self.LCD_CMD)     # 001100 Display On,Cursor Off, Blink Off
+        time.sleep(self.E_DELAY)
         self.lcd_byte(0x28, self.LCD_CMD)     # 101000 Data length, number of lines, font size
-        self.lcd_byte(0x01, self.LCD_CMD)     # 000001 Clear display
         time.sleep(self.E_DELAY)
+        self.lcd_byte(0x01, self.LCD_CMD)     # 000001 Clear display
+        time.sleep(self.INIT_DELAY)
+        # Shadow of the display contents, all blank after clear
+        self.framebuffer = dict((line, [" "] * self.LCD_WIDTH)
+                                for line in (self.LCD_LINE_1, self.LCD_LINE_2,
+                                             self.LCD_LINE_3, self.LCD_LINE_4))
     
     
-    def lcd_byte(self, bits, mode):
-        # Send byte to data pins
+    def lcd_bytes(self, bits, mode):
+        # Expanded I2C bytes for sending a byte to data pins: for both
+        # nibbles the data, enable high, enable low. Each I2C byte takes
+        # ~90us at 100kHz, longer than the enable pulse and the command
+        # execution time (37us) require, so no sleeps are needed between
+        # them.
         # bits = the data
         # mode = 1 for data
         #        0 for command
@@ -51,32 +72,89 @@ class LCD:
         bits_high = mode | (bits & 0xF0) | self.LCD_BACKLIGHT
         bits_low = mode | ((bits << 4) & 0xF0) | self.LCD_BACKLIGHT
     
-        # High bits
-        self.bus.write_byte(self.I2C_ADDR, bits_high)
-        self.lcd_toggle_enable(bits_high)
+        return [bits_high, bits_high | self.ENABLE, bits_high & ~self.ENABLE,
+                bits_low, bits_low | self.ENABLE, bits_low & ~self.ENABLE]
     
-        # Low bits
-        self.bus.write_byte(self.I2C_ADDR, bits_low)
-        self.lcd_toggle_enable(bits_low)
     
+    def lcd_byte(self, bits, mode):
+        # Send byte to data pins, as one I2C transaction
+        self.lcd_write(self.lcd_bytes(bits, mode))
     
-    def lcd_toggle_enable(self, bits):
-        # Toggle enable
-        time.sleep(self.E_DELAY)
-        self.bus.write_byte(self.I2C_ADDR, (bits | self.ENABLE))
-        time.sleep(self.E_PULSE)
-        self.bus.write_byte(self.I2C_ADDR, (bits & ~self.ENABLE))
-        time.sleep(self.E_DELAY)
+    
+    def lcd_write(self, data):
+        self.bus.i2c_rdwr(self.i2c_msg.write(self.I2C_ADDR, data))
     
     
     def lcd_string(self, message, line):
-        # Send string to display
+        # Send string to display, only the characters that differ from
+        # what's on the display. Every run of changed characters is sent
+        # as one I2C transaction, starting with its DDRAM address.
         message = message.ljust(self.LCD_WIDTH, " ")
+        shown = self.framebuffer[line]
     
-        self.lcd_byte(line, self.LCD_CMD)
-    
-        for i in range(self.LCD_WIDTH):
-            self.lcd_byte(ord(message[i]), self.LCD_CHR)
+        col = 0
+        while col < self.LCD_WIDTH:
+            if message[col] == shown[col]:
+                col += 1
+                continue
+            start = col
+            run = self.lcd_bytes(line + col, self.LCD_CMD)
+            while col < self.LCD_WIDTH and message[col] != shown[col]:
+                run += self.lcd_bytes(ord(message[col]), self.LCD_CHR)
+                col += 1
+            self.lcd_write(run)
+            shown[start:col] = message[start:col]
+
+
+class LCDWriter(threading.Thread):
+    """Writes to the LCD in the background so that the caller never waits
+    for I2C.
+
+    Only the latest text posted for each line is kept: rapid updates
+    collapse into a single refresh, at most ``max_rate`` times a second.
+    The duration of every refresh is added to ``histogram``, if given.
+    """
+
+    def __init__(self, lcd, max_rate=10., histogram=None):
+        threading.Thread.__init__(self, name="lcd-writer")
+        self.daemon = True
+        self.lcd = lcd
+        self.interval = 1. / max_rate
+        self.refreshes = 0
+        self.histogram = histogram
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def post(self, message, line):
+        """Sets the text of ``line``, replacing any not yet written."""
+        with self._cond:
+            self._pending[line] = message
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                pending, self._pending = self._pending, {}
+            start = time.time()
+            try:
+                for line in sorted(pending):
+                    self.lcd.lcd_string(pending[line], line)
+            except IOError as e:
+                logging.warn("LCD write failed: %s", e)
+            self.refreshes += 1
+            if self.histogram is not None:
+                self.histogram.add(time.time() - start)
+            time.sleep(self.interval)
 
 
 if __name__ == '__main__':